@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+🖤 GOLDEN COBRA XTR - МИКРОБЕНЧМАРКИ 🖤
+Слой данных (XTRDatabase) и платежи (XTRPaymentSystem) на заполненной базе.
+
+База заполняется один раз под заданный масштаб и кэшируется в
+.benchmarks/data; каждый прогон работает на копии. Каждый случай
+меряется при 1..256 одновременных корутинах. Результаты пишутся одной
+JSON-строкой в .benchmarks/history.jsonl и сравниваются с медианой
+прошлых прогонов того же масштаба на той же машине.
+
+    python benchmark.py                                   # малый масштаб
+    python benchmark.py --users 1000000 --transactions 20000000 --ownership 5000000
+    python benchmark.py --cases fetchone,process_deposit --concurrency 1,64
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import sqlite3
+import asyncio
+import argparse
+import platform
+import importlib
+import itertools
+import statistics
+import subprocess
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BENCH_DIR = os.path.join(ROOT, '.benchmarks')
+DATA_DIR = os.path.join(BENCH_DIR, 'data')
+HISTORY_FILE = os.path.join(BENCH_DIR, 'history.jsonl')
+
+SEED_CHUNK = 200_000  # Строк на транзакцию при заполнении
+SEED_BALANCE_XTR = 1_000_000
+SEED_BALANCE_STARS = 1_000_000_000
+SEED_PERIOD = 365 * 86400  # История транзакций за год
+
+# Модуль bot импортируется после выбора файла БД (он читает DB_FILE при импорте)
+app = None
+
+# ============================================================================
+# ЗАПОЛНЕНИЕ БАЗЫ
+# ============================================================================
+
+def seed_database(path: str, users: int, transactions: int, ownership: int, seed: int):
+    """Пользователи, история xtr_transactions и владение NFT в масштабе"""
+    rng = random.Random(seed)
+    now = int(time.time())
+    started = time.perf_counter()
+    
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA cache_size=-262144")
+    
+    def chunked(rows, statement: str, label: str, total: int):
+        done = 0
+        while True:
+            chunk = list(itertools.islice(rows, SEED_CHUNK))
+            if not chunk:
+                break
+            with conn:
+                conn.executemany(statement, chunk)
+            done += len(chunk)
+            print(f"\r  {label}: {done}/{total}", end="", flush=True)
+        print()
+    
+    chunked(
+        ((user_id, f"bench{user_id}", f"Bench{user_id}", SEED_BALANCE_STARS, SEED_BALANCE_XTR)
+         for user_id in range(1, users + 1)),
+        '''
+            INSERT INTO users (user_id, username, first_name, balance_stars, balance_xtr)
+            VALUES (?, ?, ?, ?, ?)
+        ''',
+        "users", users
+    )
+    
+    # Распределение типов близко к боевому: в основном депозиты и покупки
+    types = ('deposit',) * 12 + ('purchase',) * 5 + ('withdrawal', 'withdrawal', 'reward')
+    
+    def transaction_rows():
+        for index in range(transactions):
+            kind = types[index % len(types)]
+            amount = rng.randint(10, 5000)
+            yield (
+                rng.randint(1, users),
+                -amount if kind == 'purchase' else amount,
+                kind,
+                'pending' if kind == 'withdrawal' and index % 7 == 0 else 'completed',
+                f"seed-{index}" if kind == 'deposit' else None,
+                now - SEED_PERIOD + index * SEED_PERIOD // max(1, transactions),
+            )
+    
+    chunked(
+        transaction_rows(),
+        '''
+            INSERT INTO xtr_transactions (user_id, amount, type, status, telegram_charge_id, created_at)
+            VALUES (?, ?, ?, ?, ?, datetime(?, 'unixepoch'))
+        ''',
+        "xtr_transactions", transactions
+    )
+    
+    # UNIQUE(user_id, nft_id): k-й проход по пользователям берет k-й предмет
+    items = [row[0] for row in conn.execute("SELECT id FROM nft_items ORDER BY id")]
+    ownership = min(ownership, users * len(items))
+    chunked(
+        ((1 + index % users, items[index // users], rng.randint(100, 100000), 'stars')
+         for index in range(ownership)),
+        '''
+            INSERT INTO nft_ownership (user_id, nft_id, purchase_price, purchase_type)
+            VALUES (?, ?, ?, ?)
+        ''',
+        "nft_ownership", ownership
+    )
+    
+    # Сводная статистика как после rollups.bootstrap()
+    with conn:
+        for statement in app.XTRStatsRollup.REBUILD_STATEMENTS:
+            conn.execute(statement)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.execute("ANALYZE")
+    conn.close()
+    print(f"  seeded in {time.perf_counter() - started:.1f}s")
+
+
+def add_bench_items(path: str, count: int) -> List[int]:
+    """Отдельный предмет на каждый уровень параллелизма: покупки не упираются в UNIQUE"""
+    conn = sqlite3.connect(path)
+    with conn:
+        ids = []
+        for level in range(count):
+            cursor = conn.execute('''
+                INSERT INTO nft_items (name, description, price_stars, price_xtr, rarity, emoji)
+                VALUES (?, 'benchmark', 1, 1, 'common', '🧪')
+            ''', (f"Bench NFT {level}",))
+            ids.append(cursor.lastrowid)
+    conn.close()
+    return ids
+
+
+def prepare_database(args) -> str:
+    """Копия заполненной базы для прогона; заполнение при первом запуске масштаба"""
+    global app
+    os.makedirs(DATA_DIR, exist_ok=True)
+    seed_path = os.path.join(DATA_DIR, f"seed_u{args.users}_t{args.transactions}_o{args.ownership}.db")
+    work_path = os.path.join(DATA_DIR, 'work.db')
+    
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(work_path + suffix):
+            os.remove(work_path + suffix)
+    
+    if os.path.exists(seed_path):
+        shutil.copyfile(seed_path, work_path)
+    
+    os.environ['DB_FILE'] = work_path
+    app = importlib.import_module('bot')
+    # INFO бота (миграции, каждый депозит) шла бы в консоль и logs/ во время замеров
+    app.logger.setLevel(logging.WARNING)
+    
+    if not os.path.exists(seed_path):
+        print(f"Seeding {seed_path}")
+        seed_database(work_path, args.users, args.transactions, args.ownership, args.seed)
+        shutil.copyfile(work_path, seed_path)
+    return work_path
+
+# ============================================================================
+# СЛУЧАИ
+# ============================================================================
+# Случай получает номер операции и уровень параллелизма; результат - успех.
+
+def make_cases(args, bench_items: Dict[int, int]) -> Dict[str, Callable[[int, int], Awaitable[bool]]]:
+    rng = random.Random(args.seed)
+    run_id = f"{int(time.time())}-{os.getpid()}"
+    
+    def random_user() -> int:
+        return rng.randint(1, args.users)
+    
+    async def fetchone(index: int, level: int) -> bool:
+        return await app.db.fetchone("SELECT * FROM users WHERE user_id = ?", (random_user(),)) is not None
+    
+    async def fetchall(index: int, level: int) -> bool:
+        await app.db.fetchall('''
+            SELECT * FROM xtr_transactions
+            WHERE user_id = ?
+            ORDER BY created_at DESC
+            LIMIT 5
+        ''', (random_user(),))
+        return True
+    
+    async def process_deposit(index: int, level: int) -> bool:
+        result = await app.XTRPaymentSystem.process_deposit(
+            random_user(), 10, "", f"bench-{run_id}-{level}-{index}"
+        )
+        return result is app.XTRDepositResult.CREDITED
+    
+    async def process_withdrawal(index: int, level: int) -> bool:
+        success, _, _ = await app.XTRPaymentSystem.process_withdrawal(
+            random_user(), app.XTRConfig.MIN_WITHDRAWAL, "bench-wallet"
+        )
+        return success
+    
+    async def process_nft_purchase(index: int, level: int) -> bool:
+        # Каждый покупатель берет предмет уровня один раз
+        success, _, _ = await app.XTRPaymentSystem.process_nft_purchase(
+            1 + index % args.users, bench_items[level], 'stars', 1
+        )
+        return success
+    
+    return {
+        'fetchone': fetchone,
+        'fetchall': fetchall,
+        'process_deposit': process_deposit,
+        'process_withdrawal': process_withdrawal,
+        'process_nft_purchase': process_nft_purchase,
+    }
+
+# ============================================================================
+# ИЗМЕРЕНИЕ
+# ============================================================================
+
+def summarize(samples: List[float], elapsed: float, failures: int) -> Dict[str, float]:
+    """Статистика в духе pytest-benchmark (секунды) плюс p99 и ops/s по стене"""
+    samples.sort()
+    quartiles = statistics.quantiles(samples, n=4) if len(samples) > 1 else [samples[0]] * 3
+    return {
+        "rounds": len(samples),
+        "failures": failures,
+        "min": samples[0],
+        "max": samples[-1],
+        "mean": statistics.fmean(samples),
+        "stddev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "median": statistics.median(samples),
+        "iqr": quartiles[2] - quartiles[0],
+        "p99": samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+        "ops": len(samples) / elapsed if elapsed else 0.0,
+    }
+
+
+async def measure(case: Callable[[int, int], Awaitable[bool]], level: int, rounds: int, warmup: int) -> Dict[str, float]:
+    """rounds операций в level корутинах; время каждой операции и общая пропускная способность"""
+    for index in range(warmup):
+        await case(rounds + index, level)
+    
+    counter = itertools.count()
+    samples: List[float] = []
+    failures = 0
+    
+    async def worker():
+        nonlocal failures
+        while (index := next(counter)) < rounds:
+            started = time.perf_counter()
+            if not await case(index, level):
+                failures += 1
+            samples.append(time.perf_counter() - started)
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(level)))
+    return summarize(samples, time.perf_counter() - started, failures)
+
+
+async def run_benchmarks(args, bench_items: Dict[int, int]) -> Dict[str, Dict[str, float]]:
+    cases = make_cases(args, bench_items)
+    results = {}
+    try:
+        for name in args.cases:
+            for level in args.concurrency:
+                key = f"{name}[c={level}]"
+                results[key] = await measure(cases[name], level, args.rounds, args.warmup)
+                stats = results[key]
+                print(
+                    f"{key:<34} {stats['ops']:>10.0f} ops/s  median {stats['median'] * 1000:>8.3f} ms  "
+                    f"p99 {stats['p99'] * 1000:>8.3f} ms  failures {stats['failures']}"
+                )
+    finally:
+        await app.db.close()
+    return results
+
+# ============================================================================
+# ИСТОРИЯ
+# ============================================================================
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, timeout=5
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def load_history(scale: Dict[str, int], machine: Dict[str, str]) -> List[Dict[str, Any]]:
+    """Прошлые прогоны, сравнимые с текущим: тот же масштаб и та же машина"""
+    if not os.path.exists(HISTORY_FILE):
+        return []
+    runs = []
+    with open(HISTORY_FILE) as f:
+        for line in f:
+            if line.strip():
+                run = json.loads(line)
+                if run.get('scale') == scale and run.get('machine') == machine:
+                    runs.append(run)
+    return runs
+
+
+def compare(results: Dict[str, Dict[str, float]], history: List[Dict[str, Any]],
+            tolerance: float, floor_ms: float) -> List[str]:
+    """Регрессии против медианы прошлых прогонов по ops/s и p99"""
+    regressions = []
+    for key, stats in results.items():
+        past = [run['results'][key] for run in history if key in run['results']]
+        if not past:
+            continue
+        
+        ops = statistics.median(run['ops'] for run in past)
+        if stats['ops'] < ops * (1 - tolerance):
+            regressions.append(f"{key}: {stats['ops']:.0f} ops/s < {ops:.0f} ops/s")
+        
+        # Рост p99 меньше floor_ms считается шумом
+        p99 = statistics.median(run['p99'] for run in past)
+        if stats['p99'] > max(p99 * (1 + tolerance), p99 + floor_ms / 1000):
+            regressions.append(f"{key}: p99 {stats['p99'] * 1000:.3f} ms > {p99 * 1000:.3f} ms")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Микробенчмарки XTRDatabase и XTRPaymentSystem")
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--transactions', type=int, default=2_000_000)
+    parser.add_argument('--ownership', type=int, default=500_000)
+    parser.add_argument('--seed', type=int, default=42, help="зерно генератора данных")
+    parser.add_argument('--cases', default='fetchone,fetchall,process_deposit,process_withdrawal,process_nft_purchase')
+    parser.add_argument('--concurrency', default='1,4,16,64,256', help="уровни параллелизма через запятую")
+    parser.add_argument('--rounds', type=int, default=2000, help="операций на уровень")
+    parser.add_argument('--warmup', type=int, default=50, help="операций прогрева на уровень")
+    parser.add_argument('--history-window', type=int, default=5, help="прошлых прогонов для медианы")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="допустимое ухудшение (доля)")
+    parser.add_argument('--floor-ms', type=float, default=0.5, help="рост p99 меньше этого не считается")
+    parser.add_argument('--json', help="записать результат прогона в файл")
+    parser.add_argument('--no-save', action='store_true', help="не добавлять прогон в историю")
+    args = parser.parse_args()
+    args.cases = [name.strip() for name in args.cases.split(',') if name.strip()]
+    args.concurrency = [int(level) for level in args.concurrency.split(',')]
+    
+    if args.rounds + args.warmup > args.users:
+        parser.error("--rounds + --warmup must not exceed --users (each NFT buyer purchases once per level)")
+    
+    work_path = prepare_database(args)
+    bench_items = dict(zip(args.concurrency, add_bench_items(work_path, len(args.concurrency))))
+    
+    unknown = set(args.cases) - set(make_cases(args, bench_items))
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(sorted(unknown))}")
+    
+    results = asyncio.run(run_benchmarks(args, bench_items))
+    
+    scale = {"users": args.users, "transactions": args.transactions, "ownership": args.ownership}
+    machine = {"node": platform.node(), "machine": platform.machine(), "python": platform.python_version()}
+    run = {
+        "datetime": datetime.now().isoformat(timespec='seconds'),
+        "commit": git_commit(),
+        "scale": scale,
+        "machine": machine,
+        "rounds": args.rounds,
+        "results": results,
+    }
+    
+    history = load_history(scale, machine)[-args.history_window:]
+    regressions = compare(results, history, args.tolerance, args.floor_ms)
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    print(f"{len(results)} benchmarks, {len(history)} runs in history, {len(regressions)} regressions")
+    
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(run, f, indent=2)
+    if not args.no_save:
+        with open(HISTORY_FILE, 'a') as f:
+            f.write(json.dumps(run) + "\n")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,41 +10,57 @@ import os
 import sys
 import asyncio
 import logging
+import atexit
+import gzip
+import shutil
 import sqlite3
 import random
 import time
 import json
 import hashlib
+import re
+import heapq
 import aiosqlite
 import uuid
+import bisect
+import hmac
+import struct
+import base64
+import secrets
+from collections import deque, OrderedDict
+from queue import Queue, Full
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List, Tuple, Any, Union
+from typing import Optional, Dict, List, Tuple, Any, Union, Callable, Awaitable
 from contextlib import asynccontextmanager
 from decimal import Decimal
 from enum import Enum
 from dataclasses import dataclass
 
 # Telegram Bot с поддержкой Stars
-from aiogram import Bot, Dispatcher, F, Router, html
+from aiogram import Bot, Dispatcher, F, Router, html, BaseMiddleware
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton,
     WebAppInfo, LabeledPrice, PreCheckoutQuery, SuccessfulPayment,
     ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove,
     ShippingOption, ShippingQuery, ShippingAddress,
-    InputFile, Poll, PollAnswer, MenuButtonWebApp
+    InputFile, Poll, PollAnswer, MenuButtonWebApp, TelegramObject, Update, BotCommand
 )
 from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
 from aiogram.enums import ParseMode, ContentType
 from aiogram.client.default import DefaultBotProperties
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
-from aiogram.methods import SetMyCommands, BotCommand
+from aiogram.methods import SetMyCommands
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+from aiogram.client.session.base import BaseSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 
 # Web Server
 from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
@@ -66,12 +82,14 @@ class XTRConfig:
     
     # Курс обмена (1 XTR = 1000 внутренних звезд)
     STARS_EXCHANGE_RATE = 1000
+    EXCHANGE_RATE_TTL = int(os.getenv('EXCHANGE_RATE_TTL', 60))  # Время жизни курса в кэше (сек)
     
     # Минимальные/максимальные суммы
     MIN_STARS_PURCHASE = 10  # Минимальная покупка в XTR
     MAX_STARS_PURCHASE = 10000  # Максимальная покупка в XTR
     MIN_WITHDRAWAL = 100  # Минимальный вывод в XTR
     MAX_WITHDRAWAL = 5000  # Максимальный вывод в XTR
+    UNVERIFIED_WITHDRAWAL_LIMIT = 500  # Максимальный вывод без верификации в XTR
     
     # Комиссии
     PURCHASE_FEE_PERCENT = 0  # Комиссия при покупке (%)
@@ -79,19 +97,75 @@ class XTRConfig:
     
     # База данных
     DB_FILE = os.getenv('DB_FILE', 'golden_cobra_xtr.db')
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))  # Соединений в пуле
+    DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 5))  # Ожидание свободного соединения (сек)
+    DB_STATEMENT_CACHE = int(os.getenv('DB_STATEMENT_CACHE', 256))  # Подготовленных запросов на соединение
+    DB_WRITE_BATCH = int(os.getenv('DB_WRITE_BATCH', 256))  # Максимум заданий в одном коммите
+    DB_WRITE_TICK = float(os.getenv('DB_WRITE_TICK', 0.002))  # Накопление заданий перед коммитом (сек)
+    
+    # Таблица лидеров
+    LEADERBOARD_TOP_K = int(os.getenv('LEADERBOARD_TOP_K', 100))  # Мест в кэше
+    LEADERBOARD_RESYNC = int(os.getenv('LEADERBOARD_RESYNC', 3600))  # Полная перезагрузка (сек)
+    LEADERBOARD_PAGE_SIZE = 10  # Мест на странице в боте
+    
+    # История операций
+    HISTORY_PAGE_SIZE = 10  # Строк на странице в боте
+    
+    # Реферальная программа
+    REFERRAL_PERCENT = int(os.getenv('REFERRAL_PERCENT', 10))  # Доля реферера от депозитов (%)
+    REFERRAL_BATCH_SIZE = int(os.getenv('REFERRAL_BATCH_SIZE', 1000))  # Депозитов в пакете выплат
+    REFERRAL_INTERVAL = float(os.getenv('REFERRAL_INTERVAL', 60))  # Период пакетных выплат (сек)
+    
+    # Активность пользователей
+    ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', 5))  # Период сброса last_active (сек)
+    PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', 100000))  # Профилей в кэше /start
+    
+    # FSM
+    FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', 50000))  # Записей в LRU-кэше
+    FSM_TTL = int(os.getenv('FSM_TTL', 86400))  # Время жизни брошенного состояния (сек)
+    FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', 0.5))  # Период сброса в БД (сек)
+    FSM_REVALIDATE = float(os.getenv('FSM_REVALIDATE', 0.5))  # Через сколько перечитать запись из БД (сек)
     
     # Веб-сервер
     WEB_PORT = int(os.getenv('WEB_PORT', 8000))
     WEB_HOST = os.getenv('WEB_HOST', '0.0.0.0')
     
+    # Прием апдейтов: polling или webhook
+    BOT_MODE = os.getenv('BOT_MODE', 'polling')
+    WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # Публичный адрес, например https://example.com
+    WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram/webhook')
+    WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '') or uuid.uuid4().hex  # X-Telegram-Bot-Api-Secret-Token
+    WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 16))  # Обработчиков апдейтов
+    WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 4096))  # Апдейтов в очередях всего
+    WEBHOOK_DEDUP_WINDOW = int(os.getenv('WEBHOOK_DEDUP_WINDOW', 100000))  # Последних update_id для отсева повторов
+    
+    # Исходящие сообщения
+    OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 8))  # Параллельных отправителей
+    OUTBOX_QUEUE_SIZE = int(os.getenv('OUTBOX_QUEUE_SIZE', 10000))  # Сообщений в очереди всего
+    OUTBOX_MAX_RETRIES = int(os.getenv('OUTBOX_MAX_RETRIES', 5))  # Повторов при сетевых ошибках
+    
+    # Платежи
+    CHARGE_DEDUP_WINDOW = int(os.getenv('CHARGE_DEDUP_WINDOW', 100000))  # Последних charge id в памяти
+    
+    # Логирование
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # text или json (одна запись - одна строка)
+    LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))  # Записей в очереди на запись
+    LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', 10))  # При перегрузке проходит каждая N-я INFO
+    LOG_BACKUP_DAYS = int(os.getenv('LOG_BACKUP_DAYS', 14))  # Хранить сжатых файлов за дней
+    
     # Папки
     BACKUP_DIR = 'backups'
-    LOGS_DIR = 'logs'
+    LOGS_DIR = os.getenv('LOGS_DIR', 'logs')
     STATIC_DIR = 'static'
     CERTIFICATES_DIR = 'certificates'
     
     # Настройки безопасности
     PAYMENT_TIMEOUT = 300  # 5 минут на оплату
+    INVOICE_SECRET = os.getenv('INVOICE_SECRET', '')  # Ключ подписи payload инвойсов
+    DEPOSIT_PRESETS = (10, 50, 100, 500)  # Фиксированные суммы пополнения (XTR)
+    INVOICE_LINK_TTL = int(os.getenv('INVOICE_LINK_TTL', 3600))  # Срок общих ссылок на оплату (сек)
+    INVOICE_SWEEP_INTERVAL = float(os.getenv('INVOICE_SWEEP_INTERVAL', 30))  # Период очистки инвойсов (сек)
+    INVOICE_RETENTION = int(os.getenv('INVOICE_RETENTION', 86400))  # Хранение закрытых инвойсов (сек)
     MAX_PAYMENT_ATTEMPTS = 3
     ANTI_FRAUD_ENABLED = True
     
@@ -107,48 +181,924 @@ class XTRConfig:
         if not cls.ADMIN_IDS:
             cls.ADMIN_IDS = [123456789]
         
+        if cls.BOT_MODE not in ('polling', 'webhook'):
+            raise ValueError(f"Invalid BOT_MODE: {cls.BOT_MODE}")
+        
+        if cls.BOT_MODE == 'webhook' and not cls.WEBHOOK_URL:
+            raise ValueError("WEBHOOK_URL is required in webhook mode")
+        
         # Создаем необходимые директории
         for directory in [cls.BACKUP_DIR, cls.LOGS_DIR, cls.STATIC_DIR, cls.CERTIFICATES_DIR]:
             os.makedirs(directory, exist_ok=True)
         
         return True
+    
+    @classmethod
+    def invoice_secret(cls) -> bytes:
+        """Ключ подписи payload (по умолчанию выводится из токена бота)"""
+        if cls.INVOICE_SECRET:
+            return cls.INVOICE_SECRET.encode()
+        return hashlib.sha256(b"xtr-invoice-payload:" + cls.BOT_TOKEN.encode()).digest()
 
 # ============================================================================
 # СИСТЕМА ЛОГИРОВАНИЯ
 # ============================================================================
 
+class XTRJsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class XTRLogQueueHandler(QueueHandler):
+    """
+    Неблокирующая постановка записей в ограниченную очередь.
+    
+    Выше high_water записи ниже WARNING прореживаются (проходит каждая
+    sample_every), при полной очереди запись отбрасывается - цикл событий
+    никогда не ждет диск. Число пропущенных записей сообщается
+    предупреждением, как только очередь разгрузится.
+    """
+    
+    def __init__(self, log_queue: Queue, sample_every: int):
+        super().__init__(log_queue)
+        self.high_water = max(1, log_queue.maxsize * 4 // 5)
+        self.sample_every = sample_every
+        
+        self._sampled = 0
+        self._unreported = 0
+        self.dropped_total = 0
+    
+    def _drop(self):
+        self._unreported += 1
+        self.dropped_total += 1
+    
+    def enqueue(self, record: logging.LogRecord):
+        if record.levelno < logging.WARNING and self.queue.qsize() >= self.high_water:
+            self._sampled += 1
+            if self._sampled % self.sample_every:
+                self._drop()
+                return
+        
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self._drop()
+            return
+        
+        if self._unreported and self.queue.qsize() < self.high_water:
+            dropped, self._unreported = self._unreported, 0
+            notice = logging.makeLogRecord({
+                "name": record.name,
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "msg": f"Перегрузка лога: пропущено {dropped} записей",
+            })
+            try:
+                self.queue.put_nowait(notice)
+            except Full:
+                self._unreported += dropped
+
+
+class XTRLogListener(QueueListener):
+    """Фоновая запись в обработчики (поток листенера)"""
+    
+    def enqueue_sentinel(self):
+        # Очередь ограничена: ждем места, листенер ее разбирает
+        self.queue.put(self._sentinel)
+
+
 class XTRLogger:
     """Система логирования для XTR"""
     
+    _handler: Optional[XTRLogQueueHandler] = None
+    _listener: Optional[XTRLogListener] = None
+    
     @staticmethod
-    def setup():
-        """Настройка логгера"""
+    def _compress(source: str, dest: str):
+        """Сжатие файла при ротации (выполняется в потоке листенера)"""
+        with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+    
+    @classmethod
+    def setup(cls):
+        """Настройка логгера: очередь в цикле событий, запись в фоновом потоке"""
         logger = logging.getLogger('GoldenCobraXTR')
         logger.setLevel(logging.INFO)
         
         # Формат логов
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S'
-        )
+        if XTRConfig.LOG_FORMAT == 'json':
+            formatter = XTRJsonFormatter()
+        else:
+            formatter = logging.Formatter(
+                '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                datefmt='%Y-%m-%d %H:%M:%S'
+            )
         
         # Консольный вывод
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(formatter)
-        logger.addHandler(console_handler)
         
-        # Файловый вывод
-        file_handler = logging.FileHandler(
-            f'{XTRConfig.LOGS_DIR}/xtr_{datetime.now().strftime("%Y%m%d")}.log',
+        # Файловый вывод: ротация в полночь, старые файлы сжимаются
+        os.makedirs(XTRConfig.LOGS_DIR, exist_ok=True)
+        file_handler = TimedRotatingFileHandler(
+            f'{XTRConfig.LOGS_DIR}/xtr.log',
+            when='midnight',
+            backupCount=XTRConfig.LOG_BACKUP_DAYS,
             encoding='utf-8'
         )
+        file_handler.namer = lambda name: name + '.gz'
+        file_handler.rotator = cls._compress
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        
+        cls._handler = XTRLogQueueHandler(Queue(XTRConfig.LOG_QUEUE_SIZE), XTRConfig.LOG_SAMPLE_EVERY)
+        logger.addHandler(cls._handler)
+        
+        cls._listener = XTRLogListener(cls._handler.queue, console_handler, file_handler)
+        cls._listener.start()
+        atexit.register(cls.shutdown)
         
         return logger
+    
+    @classmethod
+    def shutdown(cls):
+        """Дописать очередь и остановить поток записи"""
+        if cls._listener is not None:
+            listener, cls._listener = cls._listener, None
+            listener.stop()
+    
+    @classmethod
+    def stats(cls) -> Dict[str, Any]:
+        """Статистика очереди лога"""
+        if cls._handler is None:
+            return {}
+        return {
+            "queued": cls._handler.queue.qsize(),
+            "dropped_total": cls._handler.dropped_total,
+        }
 
 logger = XTRLogger.setup()
 
+# ============================================================================
+# МЕТРИКИ
+# ============================================================================
+
+class XTRHistogram:
+    """
+    Гистограмма Prometheus с метками.
+    
+    Все вызовы идут из одного цикла событий, поэтому счетчики - обычные
+    списки без блокировок; observe() - bisect и два сложения.
+    """
+    
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...],
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        
+        # метки -> [счетчики по корзинам (+Inf последней), сумма, количество]
+        self._series: Dict[Tuple[str, ...], list] = {}
+    
+    def observe(self, value: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in self._series.items():
+            base = XTRMetrics.format_labels(self.labelnames, labels)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{base}{"," if base else ""}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{base}{"," if base else ""}le="+Inf"}} {count}')
+            suffix = f"{{{base}}}" if base else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {count}")
+        return lines
+
+
+class XTRCounter:
+    """Счетчик Prometheus с метками"""
+    
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], int] = {}
+    
+    def inc(self, *labels: str, amount: int = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{{{XTRMetrics.format_labels(self.labelnames, labels)}}} {value}")
+        return lines
+
+
+class XTRGauge:
+    """Датчик Prometheus: значения снимаются callback'ом при чтении /metrics"""
+    
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...],
+                 collect: Callable[[], Dict[Tuple[str, ...], float]]):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.collect = collect
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.collect()
+        except Exception as e:
+            logger.error(f"Ошибка сбора метрики {self.name}: {e}")
+            values = {}
+        for labels, value in values.items():
+            lines.append(f"{self.name}{{{XTRMetrics.format_labels(self.labelnames, labels)}}} {value}")
+        return lines
+
+
+class XTRMetrics:
+    """Реестр метрик и текстовый формат Prometheus для /metrics (без зависимостей)"""
+    
+    FINGERPRINT_CACHE_SIZE = 1024
+    _IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+    
+    def __init__(self):
+        self._metrics: List[Any] = []
+        self._fingerprints: Dict[str, str] = {}
+        self._lag_task: Optional[asyncio.Task] = None
+        self._loop_lag = 0.0
+        
+        self.handler_latency = self.register(XTRHistogram(
+            "xtr_handler_duration_seconds", "Время обработчика апдейта", ("handler",)))
+        self.handler_errors = self.register(XTRCounter(
+            "xtr_handler_errors_total", "Исключения обработчиков", ("handler",)))
+        self.db_latency = self.register(XTRHistogram(
+            "xtr_db_query_duration_seconds", "Время запроса к БД (write - до коммита пачки)",
+            ("method", "statement")))
+        self.api_latency = self.register(XTRHistogram(
+            "xtr_telegram_api_duration_seconds", "Время запроса к Bot API", ("method",)))
+        self.api_errors = self.register(XTRCounter(
+            "xtr_telegram_api_errors_total", "Ошибки запросов к Bot API", ("method",)))
+        self.loop_lag = self.register(XTRHistogram(
+            "xtr_event_loop_lag_seconds", "Опоздание пробуждения цикла событий", (),
+            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)))
+    
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def gauge(self, name: str, help_text: str, labelnames: Tuple[str, ...],
+              collect: Callable[[], Dict[Tuple[str, ...], float]]) -> XTRGauge:
+        return self.register(XTRGauge(name, help_text, labelnames, collect))
+    
+    @staticmethod
+    def _escape(value: Any) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+    
+    @classmethod
+    def format_labels(cls, labelnames: Tuple[str, ...], labels: Tuple[str, ...]) -> str:
+        return ",".join(f'{name}="{cls._escape(value)}"' for name, value in zip(labelnames, labels))
+    
+    def fingerprint(self, query: str) -> str:
+        """Нормализованный текст запроса: пробелы схлопнуты, списки IN (?,?,...) свернуты"""
+        fp = self._fingerprints.get(query)
+        if fp is None:
+            if len(self._fingerprints) >= self.FINGERPRINT_CACHE_SIZE:
+                self._fingerprints.clear()
+            fp = self._IN_LIST.sub("(?+)", " ".join(query.split()))[:160]
+            self._fingerprints[query] = fp
+        return fp
+    
+    @staticmethod
+    def job_name(job: Callable) -> str:
+        """Имя задания писателя: функция, создавшая замыкание"""
+        return job.__qualname__.replace(".<locals>", "").rsplit(".", 1)[0]
+    
+    async def _watch_loop(self, interval: float):
+        """Замер опоздания пробуждения после sleep(interval)"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            self._loop_lag = max(0.0, loop.time() - started - interval)
+            self.loop_lag.observe(self._loop_lag)
+    
+    def start(self, interval: float = 0.5):
+        """Запустить замер лага в текущем цикле событий"""
+        if self._lag_task is None or self._lag_task.done():
+            self._lag_task = asyncio.get_running_loop().create_task(self._watch_loop(interval))
+    
+    async def close(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        lines.append("# HELP xtr_event_loop_lag_last_seconds Последний замер лага цикла событий")
+        lines.append("# TYPE xtr_event_loop_lag_last_seconds gauge")
+        lines.append(f"xtr_event_loop_lag_last_seconds {self._loop_lag}")
+        return "\n".join(lines) + "\n"
+
+metrics = XTRMetrics()
+
+
+class XTRHandlerMetricsMiddleware(BaseMiddleware):
+    """Inner middleware: гистограмма времени по обработчикам"""
+    
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object is not None else 'unknown'
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.handler_errors.inc(name)
+            raise
+        finally:
+            metrics.handler_latency.observe(time.perf_counter() - started, name)
+
+
+class XTRApiMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии: время и ошибки запросов к Bot API по методам"""
+    
+    async def __call__(self, make_request, bot: Bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            metrics.api_errors.inc(name)
+            raise
+        finally:
+            metrics.api_latency.observe(time.perf_counter() - started, name)
+
+# ============================================================================
+# ПУЛ СОЕДИНЕНИЙ
+# ============================================================================
+
+class XTRPoolTimeout(Exception):
+    """Свободное соединение не получено за DB_POOL_TIMEOUT"""
+
+
+class XTRConnectionPool:
+    """Ограниченный пул долгоживущих соединений aiosqlite"""
+    
+    # PRAGMA применяются один раз при открытии соединения
+    CONNECTION_PRAGMAS = (
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA busy_timeout=5000",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-16000",
+    )
+    
+    def __init__(self, db_path: str, size: int, acquire_timeout: float, statement_cache_size: int):
+        self.db_path = db_path
+        self.size = max(1, size)
+        self.acquire_timeout = acquire_timeout
+        self.statement_cache_size = statement_cache_size
+        
+        self._idle: List[aiosqlite.Connection] = []
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._in_use = 0
+        self._open_count = 0
+        self._closed = False
+        
+        # Счетчики для статистики
+        self._opened_total = 0
+        self._acquired_total = 0
+        self._waited_total = 0
+        self._timeouts_total = 0
+        self._wait_time_total = 0.0
+    
+    async def _open(self) -> aiosqlite.Connection:
+        """Открыть новое соединение и применить PRAGMA"""
+        # cached_statements - кэш подготовленных запросов sqlite3 на соединение
+        conn = aiosqlite.connect(self.db_path, cached_statements=self.statement_cache_size)
+        conn.daemon = True  # Не блокируем завершение процесса
+        await conn
+        conn.row_factory = aiosqlite.Row
+        
+        for pragma in self.CONNECTION_PRAGMAS:
+            await conn.execute(pragma)
+        
+        self._open_count += 1
+        self._opened_total += 1
+        return conn
+    
+    async def _discard(self, conn: aiosqlite.Connection):
+        """Закрыть соединение, не возвращая его в пул"""
+        self._open_count -= 1
+        try:
+            await conn.close()
+        except Exception as e:
+            logger.warning(f"Ошибка закрытия соединения: {e}")
+    
+    async def acquire(self) -> aiosqlite.Connection:
+        """Взять соединение из пула"""
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
+        
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+        
+        if not self._semaphore.locked():
+            # Быстрый путь: свободное место есть, ожидания нет
+            await self._semaphore.acquire()
+        else:
+            self._waited_total += 1
+            started = time.perf_counter()
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.acquire_timeout)
+            except asyncio.TimeoutError:
+                self._timeouts_total += 1
+                raise XTRPoolTimeout(
+                    f"Нет свободных соединений за {self.acquire_timeout} сек (пул: {self.size})"
+                )
+            self._wait_time_total += time.perf_counter() - started
+        
+        try:
+            conn = self._idle.pop() if self._idle else await self._open()
+        except BaseException:
+            self._semaphore.release()
+            raise
+        
+        self._in_use += 1
+        self._acquired_total += 1
+        return conn
+    
+    async def release(self, conn: aiosqlite.Connection):
+        """Вернуть соединение в пул"""
+        try:
+            # Незавершенная транзакция не должна достаться следующему владельцу
+            if conn.in_transaction:
+                await conn.rollback()
+        except Exception as e:
+            logger.warning(f"Соединение исключено из пула: {e}")
+            await self._discard(conn)
+        else:
+            if self._closed:
+                await self._discard(conn)
+            else:
+                self._idle.append(conn)
+        finally:
+            self._in_use -= 1
+            self._semaphore.release()
+    
+    @asynccontextmanager
+    async def connection(self):
+        """Соединение на время блока with"""
+        conn = await self.acquire()
+        try:
+            yield conn
+        finally:
+            await self.release(conn)
+    
+    async def close(self):
+        """Закрыть все свободные соединения"""
+        self._closed = True
+        while self._idle:
+            await self._discard(self._idle.pop())
+    
+    def stats(self) -> Dict[str, Any]:
+        """Статистика пула"""
+        return {
+            "size": self.size,
+            "open": self._open_count,
+            "idle": len(self._idle),
+            "in_use": self._in_use,
+            "opened_total": self._opened_total,
+            "acquired_total": self._acquired_total,
+            "waited_total": self._waited_total,
+            "timeouts_total": self._timeouts_total,
+            "avg_wait_ms": round(self._wait_time_total / self._acquired_total * 1000, 3)
+            if self._acquired_total else 0.0,
+            "statement_cache_size": self.statement_cache_size,
+        }
+
+# ============================================================================
+# ДВИЖОК ЗАПИСИ (ОДИН ПИСАТЕЛЬ, ГРУППОВОЙ КОММИТ)
+# ============================================================================
+
+class XTRWriteEngine:
+    """Единственный писатель: задания из очереди коммитятся пачками"""
+    
+    def __init__(self, db_path: str, max_batch: int, tick: float):
+        self.db_path = db_path
+        self.max_batch = max(1, max_batch)
+        self.tick = tick
+        
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._start_lock: Optional[asyncio.Lock] = None
+        self._start_loop: Optional[asyncio.AbstractEventLoop] = None
+        
+        # Счетчики для статистики
+        self._batches_total = 0
+        self._jobs_total = 0
+        self._jobs_failed = 0
+        self._batches_failed = 0
+    
+    async def _open(self) -> aiosqlite.Connection:
+        """Открыть соединение писателя (транзакции управляются явно)"""
+        conn = aiosqlite.connect(self.db_path, isolation_level=None)
+        conn.daemon = True
+        await conn
+        conn.row_factory = aiosqlite.Row
+        
+        for pragma in XTRConnectionPool.CONNECTION_PRAGMAS:
+            await conn.execute(pragma)
+        
+        return conn
+    
+    async def _ensure_started(self):
+        """Запустить корутину писателя в текущем цикле событий"""
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._task.get_loop() is loop:
+            return
+        
+        # Первые submit() приходят пачкой: без блокировки каждый открыл бы
+        # свое соединение, и все, кроме последнего, утекли бы
+        if self._start_lock is None or self._start_loop is not loop:
+            self._start_lock = asyncio.Lock()
+            self._start_loop = loop
+        
+        async with self._start_lock:
+            # Писатель мог стартовать, пока ждали блокировку
+            if self._task is not None and not self._task.done() and self._task.get_loop() is loop:
+                return
+            
+            if self._conn is None:
+                self._conn = await self._open()
+            
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+    
+    async def submit(self, job: Callable[[aiosqlite.Connection], Awaitable[Any]]) -> Any:
+        """
+        Поставить задание в очередь и дождаться группового коммита.
+        
+        Задание получает соединение писателя и не должно вызывать commit.
+        Исключение в задании откатывает только его изменения и
+        пробрасывается вызывающему.
+        """
+        await self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((job, future))
+        return await future
+    
+    async def _run(self):
+        """Основной цикл писателя"""
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                break
+            
+            batch = [item]
+            if self.tick > 0:
+                await asyncio.sleep(self.tick)
+            
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            
+            try:
+                await self._commit_batch(batch)
+            except Exception as e:
+                logger.error(f"Сбой писателя: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            
+            if stop:
+                break
+    
+    async def _commit_batch(self, batch: List[Tuple[Callable, asyncio.Future]]):
+        """Выполнить пачку заданий в одной транзакции"""
+        conn = self._conn
+        outcomes = []
+        
+        try:
+            await conn.execute("BEGIN IMMEDIATE")
+            
+            for job, future in batch:
+                # Точка сохранения изолирует ошибку задания от остальных
+                await conn.execute("SAVEPOINT write_job")
+                try:
+                    result = await job(conn)
+                except Exception as e:
+                    await conn.execute("ROLLBACK TO write_job")
+                    await conn.execute("RELEASE write_job")
+                    outcomes.append((future, None, e))
+                else:
+                    await conn.execute("RELEASE write_job")
+                    outcomes.append((future, result, None))
+            
+            await conn.execute("COMMIT")
+            
+        except Exception as e:
+            logger.error(f"Ошибка группового коммита: {e}")
+            self._batches_failed += 1
+            self._jobs_failed += len(batch)
+            try:
+                if conn.in_transaction:
+                    await conn.rollback()
+            except Exception as rollback_error:
+                logger.error(f"Ошибка отката пачки: {rollback_error}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        self._batches_total += 1
+        self._jobs_total += len(batch)
+        
+        # Результаты отдаем только после коммита
+        for future, result, error in outcomes:
+            if error is not None:
+                self._jobs_failed += 1
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+    
+    async def close(self):
+        """Дописать очередь и закрыть соединение писателя"""
+        if self._task is not None and not self._task.done():
+            self._queue.put_nowait(None)
+            await self._task
+        self._task = None
+        
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+    
+    def stats(self) -> Dict[str, Any]:
+        """Статистика писателя"""
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "batches_total": self._batches_total,
+            "jobs_total": self._jobs_total,
+            "jobs_failed": self._jobs_failed,
+            "batches_failed": self._batches_failed,
+            "avg_batch_size": round(self._jobs_total / self._batches_total, 2)
+            if self._batches_total else 0.0,
+        }
+
+# ============================================================================
+# SQL ГОРЯЧИХ ЗАПРОСОВ
+# ============================================================================
+
+class XTRQueries:
+    """
+    Тексты запросов, которые код выполняет чаще всего.
+    
+    Одни и те же строки используют вызывающий код и
+    XTRDatabase.QUERY_PLAN_SUITE, поэтому проверка планов видит ровно то,
+    что уходит в SQLite.
+    """
+    
+    USER_BY_ID = "SELECT * FROM users WHERE user_id = ?"
+    EXCHANGE_RATE = "SELECT stars_per_xtr FROM exchange_rates WHERE id = 1"
+    
+    # /balance: последние транзакции
+    LAST_TRANSACTIONS = '''
+        SELECT * FROM xtr_transactions
+        WHERE user_id = ?
+        ORDER BY created_at DESC
+        LIMIT 5
+    '''
+    
+    # Страницы истории (XTRHistory) - источник: (таблица, колонки, допустимые фильтры)
+    HISTORY_SOURCES = {
+        'xtr': (
+            'xtr_transactions',
+            'id, amount, type, status, description, created_at, completed_at',
+            ('type', 'status'),
+        ),
+        'stars': (
+            'star_transactions',
+            'id, amount, type, description, created_at',
+            ('type',),
+        ),
+        'withdrawals': (
+            'withdrawals',
+            'id, amount, fee, net_amount, status, wallet_address, created_at, processed_at',
+            ('status',),
+        ),
+    }
+    
+    PENDING_WITHDRAWALS_COUNT = "SELECT COUNT(*) as count FROM withdrawals WHERE status = 'pending'"
+    
+    NFT_SHOP = '''
+        SELECT * FROM nft_items
+        WHERE available = 1
+        ORDER BY price_xtr ASC
+    '''
+    NFT_ITEM = "SELECT * FROM nft_items WHERE id = ?"
+    USER_NFTS = '''
+        SELECT no.*, ni.name, ni.description, ni.rarity, ni.emoji
+        FROM nft_ownership no
+        JOIN nft_items ni ON no.nft_id = ni.id
+        WHERE no.user_id = ?
+        ORDER BY no.purchased_at DESC
+    '''
+    API_USER = '''
+        SELECT u.*,
+               (SELECT COUNT(*) FROM nft_ownership WHERE user_id = u.user_id) as nft_count,
+               (SELECT SUM(amount) FROM xtr_transactions WHERE user_id = u.user_id AND type = 'deposit') as total_deposited
+        FROM users u
+        WHERE user_id = ?
+    '''
+    
+    STATS_TOTALS = "SELECT key, value FROM stats_totals"
+    STATS_TODAY = "SELECT key, value FROM stats_daily WHERE day = date('now')"
+    ACTIVE_USERS = '''
+        SELECT COUNT(*) as count FROM users
+        WHERE last_active > datetime('now', '-7 days')
+    '''
+    
+    # Пересчет сводной статистики (/admin rebuild_stats)
+    STATS_REBUILD_TOTALS = '''
+        INSERT INTO stats_totals (key, value)
+        SELECT 'users', COUNT(*) FROM users
+        UNION ALL SELECT 'balance_xtr', COALESCE(SUM(balance_xtr), 0) FROM users
+        UNION ALL SELECT 'deposits_xtr', COALESCE(SUM(amount), 0) FROM xtr_transactions WHERE type = 'deposit'
+        UNION ALL SELECT 'deposits_count', COUNT(*) FROM xtr_transactions WHERE type = 'deposit'
+        UNION ALL SELECT 'withdrawals_xtr', COALESCE(SUM(amount), 0) FROM withdrawals
+                  WHERE status NOT IN ('rejected', 'cancelled')
+        UNION ALL SELECT 'withdrawals_count', COUNT(*) FROM withdrawals
+                  WHERE status NOT IN ('rejected', 'cancelled')
+        UNION ALL SELECT 'nft_sales', COUNT(*) FROM nft_ownership
+        UNION ALL SELECT 'market_trades', COUNT(*) FROM nft_market WHERE sold_at IS NOT NULL
+        UNION ALL SELECT 'market_volume_stars', COALESCE(SUM(price_stars), 0) FROM nft_market
+                  WHERE sold_at IS NOT NULL
+        UNION ALL SELECT 'referral_payouts_xtr', COALESCE(SUM(amount_xtr), 0) FROM referral_payouts
+                  WHERE status = 'paid'
+    '''
+    STATS_REBUILD_DAILY = '''
+        INSERT INTO stats_daily (day, key, value)
+        SELECT date(created_at), 'users', COUNT(*) FROM users GROUP BY 1
+        UNION ALL SELECT date(created_at), 'deposits_xtr', SUM(amount) FROM xtr_transactions
+                  WHERE type = 'deposit' GROUP BY 1
+        UNION ALL SELECT date(created_at), 'deposits_count', COUNT(*) FROM xtr_transactions
+                  WHERE type = 'deposit' GROUP BY 1
+        UNION ALL SELECT date(created_at), 'withdrawals_xtr', SUM(amount) FROM withdrawals
+                  WHERE status NOT IN ('rejected', 'cancelled') GROUP BY 1
+        UNION ALL SELECT date(created_at), 'withdrawals_count', COUNT(*) FROM withdrawals
+                  WHERE status NOT IN ('rejected', 'cancelled') GROUP BY 1
+        UNION ALL SELECT date(purchased_at), 'nft_sales', COUNT(*) FROM nft_ownership GROUP BY 1
+        UNION ALL SELECT date(sold_at), 'market_trades', COUNT(*) FROM nft_market
+                  WHERE sold_at IS NOT NULL GROUP BY 1
+        UNION ALL SELECT date(sold_at), 'market_volume_stars', SUM(price_stars) FROM nft_market
+                  WHERE sold_at IS NOT NULL GROUP BY 1
+        UNION ALL SELECT date(paid_at), 'referral_payouts_xtr', SUM(amount_xtr) FROM referral_payouts
+                  WHERE status = 'paid' GROUP BY 1
+    '''
+    
+    FSM_LOAD = "SELECT state, data, expires_at FROM fsm_states WHERE key = ?"
+    FSM_SWEEP = "DELETE FROM fsm_states WHERE expires_at < ?"
+    
+    LEADERBOARD_LOAD = '''
+        SELECT user_id, total_deposited_xtr, balance_stars, referrals FROM users
+        WHERE total_deposited_xtr > 0 OR balance_stars > 0 OR referrals > 0
+    '''
+    LEADERBOARD_LOAD_NFTS = "SELECT user_id, COUNT(*) as count FROM nft_ownership GROUP BY user_id"
+    
+    MARKET_LOAD_ASKS = '''
+        SELECT m.id, m.seller_id, m.price_stars, o.id AS ownership_id, o.nft_id
+        FROM nft_market m
+        JOIN nft_ownership o ON o.id = m.nft_ownership_id
+        WHERE m.sold_at IS NULL AND o.is_listed = 1 AND o.user_id = m.seller_id
+    '''
+    MARKET_LOAD_BIDS = '''
+        SELECT id, nft_id, bidder_id, price_stars FROM nft_bids
+        WHERE status = 'open'
+    '''
+    MARKET_MY_LISTINGS = '''
+        SELECT m.id, m.price_stars, ni.name, ni.emoji
+        FROM nft_market m
+        JOIN nft_ownership o ON o.id = m.nft_ownership_id
+        JOIN nft_items ni ON ni.id = o.nft_id
+        WHERE m.seller_id = ? AND m.sold_at IS NULL
+        ORDER BY m.id
+    '''
+    MARKET_MY_BIDS = '''
+        SELECT b.id, b.price_stars, ni.name, ni.emoji
+        FROM nft_bids b
+        JOIN nft_items ni ON ni.id = b.nft_id
+        WHERE b.bidder_id = ? AND b.status = 'open'
+        ORDER BY b.id
+    '''
+    
+    CHARGES_RECENT = '''
+        SELECT telegram_charge_id FROM xtr_transactions
+        WHERE type = 'deposit' AND status = 'completed'
+        ORDER BY id DESC
+        LIMIT ?
+    '''
+    
+    INVOICE_BY_KEY = "SELECT user_id, amount_xtr, state, attempts, expires_at FROM pending_invoices WHERE key = ?"
+    INVOICES_EXPIRE = '''
+        UPDATE pending_invoices SET state = 'expired', updated_at = ?
+        WHERE state IN ('pending', 'pre_checked') AND expires_at < ?
+        RETURNING key
+    '''
+    INVOICES_PURGE = '''
+        DELETE FROM pending_invoices
+        WHERE state IN ('paid', 'expired', 'failed') AND updated_at < ?
+    '''
+    INVOICES_LOAD = '''
+        SELECT key, user_id, amount_xtr, state, attempts, expires_at FROM pending_invoices
+        WHERE state IN ('pending', 'pre_checked')
+    '''
+    
+    REFERRAL_WATERMARK = "SELECT value FROM job_watermarks WHERE name = ?"
+    # Окно пакета: следующие batch_size депозитов после водяного знака
+    REFERRAL_WINDOW = '''
+        SELECT id FROM xtr_transactions
+        WHERE id > ? AND type = 'deposit' AND status = 'completed'
+        ORDER BY id
+        LIMIT ?
+    '''
+    REFERRAL_BATCH = '''
+        INSERT INTO referral_payouts (referrer_id, referred_id, amount_xtr, percentage, status, paid_at)
+        SELECT u.referral_id, t.user_id, SUM(t.amount) * ? / 100, ?, 'paid', CURRENT_TIMESTAMP
+        FROM xtr_transactions t
+        JOIN users u ON u.user_id = t.user_id
+        WHERE t.id > ? AND t.id <= ? AND t.type = 'deposit' AND t.status = 'completed'
+          AND u.referral_id IS NOT NULL
+        GROUP BY u.referral_id, t.user_id
+        HAVING SUM(t.amount) * ? / 100 > 0
+        RETURNING id, referrer_id, amount_xtr
+    '''
+    REFERRAL_CREDIT = '''
+        UPDATE users SET balance_xtr = balance_xtr + p.amount
+        FROM (
+            SELECT referrer_id, SUM(amount_xtr) AS amount FROM referral_payouts
+            WHERE id >= ? GROUP BY referrer_id
+        ) AS p
+        WHERE users.user_id = p.referrer_id
+    '''
+    
+    @classmethod
+    def history_page(cls, source: str, with_cursor: bool, filters: Tuple[str, ...] = ()) -> str:
+        """Страница истории: строки с id меньше курсора, по убыванию id"""
+        table, columns, _ = cls.HISTORY_SOURCES[source]
+        conditions = ["user_id = ?"]
+        if with_cursor:
+            conditions.append("id < ?")
+        conditions.extend(f"{name} = ?" for name in filters)
+        return f'''
+            SELECT {columns} FROM {table}
+            WHERE {' AND '.join(conditions)}
+            ORDER BY id DESC
+            LIMIT ?
+        '''
+    
+    @staticmethod
+    def leaderboard_names(count: int) -> str:
+        """Имена участников страницы таблицы лидеров"""
+        return f"SELECT user_id, username, first_name FROM users WHERE user_id IN ({','.join('?' * count)})"
+
 # ============================================================================
 # БАЗА ДАННЫХ XTR - УЛУЧШЕННАЯ
 # ============================================================================
@@ -156,9 +1106,181 @@ logger = XTRLogger.setup()
 class XTRDatabase:
     """База данных для XTR системы"""
     
+    # Версионированный набор индексов (версия хранится в PRAGMA user_version)
+    INDEX_MIGRATIONS = (
+        (1, (
+            # История транзакций в /balance и /api/user
+            "CREATE INDEX IF NOT EXISTS idx_xtr_transactions_user_created "
+            "ON xtr_transactions(user_id, created_at)",
+            # Суммы депозитов/выводов в /admin stats
+            "CREATE INDEX IF NOT EXISTS idx_xtr_transactions_type_amount "
+            "ON xtr_transactions(type, amount)",
+            # Заявки пользователя и очередь на вывод
+            "CREATE INDEX IF NOT EXISTS idx_withdrawals_user_created "
+            "ON withdrawals(user_id, created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_withdrawals_status "
+            "ON withdrawals(status)",
+            # Коллекция пользователя и владельцы NFT
+            "CREATE INDEX IF NOT EXISTS idx_nft_ownership_user_purchased "
+            "ON nft_ownership(user_id, purchased_at)",
+            "CREATE INDEX IF NOT EXISTS idx_nft_ownership_nft "
+            "ON nft_ownership(nft_id)",
+            # Витрина магазина
+            "CREATE INDEX IF NOT EXISTS idx_nft_items_available_price "
+            "ON nft_items(available, price_xtr)",
+            # Активные пользователи
+            "CREATE INDEX IF NOT EXISTS idx_users_last_active "
+            "ON users(last_active)",
+        )),
+        (2, (
+            # Очистка истекших состояний FSM
+            "CREATE INDEX IF NOT EXISTS idx_fsm_states_expires "
+            "ON fsm_states(expires_at)",
+        )),
+        (3, (
+            # Стаканы вторичного рынка NFT
+            "CREATE INDEX IF NOT EXISTS idx_nft_market_open "
+            "ON nft_market(nft_ownership_id) WHERE sold_at IS NULL",
+            "CREATE INDEX IF NOT EXISTS idx_nft_market_seller_open "
+            "ON nft_market(seller_id) WHERE sold_at IS NULL",
+            "CREATE INDEX IF NOT EXISTS idx_nft_bids_open "
+            "ON nft_bids(nft_id, price_stars) WHERE status = 'open'",
+            "CREATE INDEX IF NOT EXISTS idx_nft_bids_bidder "
+            "ON nft_bids(bidder_id, status)",
+        )),
+        (4, (
+            # Окно депозитов после водяного знака реферальных выплат (rowid - хвост индекса)
+            "CREATE INDEX IF NOT EXISTS idx_xtr_transactions_type_status "
+            "ON xtr_transactions(type, status)",
+        )),
+        (5, (
+            # Повторы платежей из-за старой ошибки двойного зачисления: более поздние
+            # строки сохраняются в журнал и теряют charge id, иначе индекс не создать
+            "CREATE TABLE IF NOT EXISTS duplicate_charges_audit ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "transaction_id INTEGER NOT NULL, "
+            "first_transaction_id INTEGER NOT NULL, "
+            "user_id INTEGER NOT NULL, "
+            "amount INTEGER NOT NULL, "
+            "telegram_charge_id TEXT NOT NULL, "
+            "detected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+            "INSERT INTO duplicate_charges_audit "
+            "(transaction_id, first_transaction_id, user_id, amount, telegram_charge_id) "
+            "SELECT t.id, d.first_id, t.user_id, t.amount, t.telegram_charge_id "
+            "FROM xtr_transactions t JOIN ("
+            "SELECT telegram_charge_id, MIN(id) AS first_id FROM xtr_transactions "
+            "WHERE telegram_charge_id IS NOT NULL "
+            "GROUP BY telegram_charge_id HAVING COUNT(*) > 1"
+            ") d ON d.telegram_charge_id = t.telegram_charge_id "
+            "WHERE t.id > d.first_id",
+            "UPDATE xtr_transactions SET telegram_charge_id = NULL "
+            "WHERE id IN (SELECT transaction_id FROM duplicate_charges_audit)",
+            # Один платеж Telegram - одно зачисление
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_xtr_transactions_charge "
+            "ON xtr_transactions(telegram_charge_id) WHERE telegram_charge_id IS NOT NULL",
+        )),
+        (6, (
+            # Истечение открытых и удаление закрытых инвойсов
+            "CREATE INDEX IF NOT EXISTS idx_pending_invoices_open "
+            "ON pending_invoices(expires_at) WHERE state IN ('pending', 'pre_checked')",
+            "CREATE INDEX IF NOT EXISTS idx_pending_invoices_closed "
+            "ON pending_invoices(updated_at) WHERE state IN ('paid', 'expired', 'failed')",
+        )),
+        (7, (
+            # Постраничная история: keyset по (user_id, id), id - rowid в хвосте индекса
+            "CREATE INDEX IF NOT EXISTS idx_xtr_transactions_user "
+            "ON xtr_transactions(user_id)",
+            "CREATE INDEX IF NOT EXISTS idx_xtr_transactions_user_type "
+            "ON xtr_transactions(user_id, type)",
+            "CREATE INDEX IF NOT EXISTS idx_star_transactions_user "
+            "ON star_transactions(user_id)",
+            "CREATE INDEX IF NOT EXISTS idx_withdrawals_user "
+            "ON withdrawals(user_id)",
+        )),
+        (8, (
+            # Индексы, которые не использует ни один запрос (см. check_query_plans):
+            # заявки пользователя читаются по idx_withdrawals_user, владельцев NFT
+            # и лоты по владению никто не ищет
+            "DROP INDEX IF EXISTS idx_withdrawals_user_created",
+            "DROP INDEX IF EXISTS idx_nft_ownership_nft",
+            "DROP INDEX IF EXISTS idx_nft_market_open",
+        )),
+        (9, (
+            # Фильтр истории по статусу: keyset по (user_id, status, id) вместо
+            # проверки status на каждой строке истории пользователя
+            "CREATE INDEX IF NOT EXISTS idx_xtr_transactions_user_status "
+            "ON xtr_transactions(user_id, status)",
+            "CREATE INDEX IF NOT EXISTS idx_withdrawals_user_status "
+            "ON withdrawals(user_id, status)",
+        )),
+    )
+    
+    # Запросы бота для проверки планов: (имя, запрос, параметры, допустим ли полный скан)
+    QUERY_PLAN_SUITE = (
+        ("user_by_id", XTRQueries.USER_BY_ID, (1,), False),
+        ("exchange_rate", XTRQueries.EXCHANGE_RATE, (), False),
+        ("balance_last_transactions", XTRQueries.LAST_TRANSACTIONS, (1,), False),
+        # Страницы истории: без сортировки во временном B-дереве
+        ("history_xtr", XTRQueries.history_page('xtr', True), (1, 100, 21), False),
+        ("history_xtr_type", XTRQueries.history_page('xtr', True, ('type',)), (1, 100, 'deposit', 21), False),
+        ("history_xtr_status", XTRQueries.history_page('xtr', True, ('status',)),
+         (1, 100, 'failed', 21), False),
+        ("history_xtr_status_first", XTRQueries.history_page('xtr', False, ('status',)),
+         (1, 'failed', 21), False),
+        ("history_stars", XTRQueries.history_page('stars', True), (1, 100, 21), False),
+        ("history_withdrawals", XTRQueries.history_page('withdrawals', True), (1, 100, 21), False),
+        ("history_withdrawals_status", XTRQueries.history_page('withdrawals', True, ('status',)),
+         (1, 100, 'pending', 21), False),
+        ("history_withdrawals_status_first", XTRQueries.history_page('withdrawals', False, ('status',)),
+         (1, 'pending', 21), False),
+        ("pending_withdrawals_count", XTRQueries.PENDING_WITHDRAWALS_COUNT, (), False),
+        ("nft_shop", XTRQueries.NFT_SHOP, (), False),
+        ("nft_item", XTRQueries.NFT_ITEM, (1,), False),
+        ("user_nfts", XTRQueries.USER_NFTS, (1,), False),
+        ("api_user", XTRQueries.API_USER, (1,), False),
+        # Десяток строк счетчиков
+        ("stats_totals", XTRQueries.STATS_TOTALS, (), True),
+        ("stats_today", XTRQueries.STATS_TODAY, (), False),
+        ("stats_active_users", XTRQueries.ACTIVE_USERS, (), False),
+        # Пересчет по всей истории: только по команде администратора
+        ("stats_rebuild_totals", XTRQueries.STATS_REBUILD_TOTALS, (), True),
+        ("stats_rebuild_daily", XTRQueries.STATS_REBUILD_DAILY, (), True),
+        ("fsm_state", XTRQueries.FSM_LOAD, ("",), False),
+        ("fsm_sweep", XTRQueries.FSM_SWEEP, (0,), False),
+        # Полная загрузка таблиц лидеров: при старте и раз в LEADERBOARD_RESYNC
+        ("leaderboard_load", XTRQueries.LEADERBOARD_LOAD, (), True),
+        ("leaderboard_load_nfts", XTRQueries.LEADERBOARD_LOAD_NFTS, (), True),
+        ("leaderboard_names", XTRQueries.leaderboard_names(2), (1, 2), False),
+        # Открытые заявки: скан частичного индекса, а не таблицы
+        ("market_load_asks", XTRQueries.MARKET_LOAD_ASKS, (), False),
+        ("market_load_bids", XTRQueries.MARKET_LOAD_BIDS, (), False),
+        ("market_my_listings", XTRQueries.MARKET_MY_LISTINGS, (1,), False),
+        ("market_my_bids", XTRQueries.MARKET_MY_BIDS, (1,), False),
+        ("charges_recent", XTRQueries.CHARGES_RECENT, (1000,), False),
+        ("invoice_by_key", XTRQueries.INVOICE_BY_KEY, ("",), False),
+        ("invoices_expire", XTRQueries.INVOICES_EXPIRE, (0, 0), False),
+        ("invoices_purge", XTRQueries.INVOICES_PURGE, (0,), False),
+        ("invoices_load", XTRQueries.INVOICES_LOAD, (), False),
+        ("referral_watermark", XTRQueries.REFERRAL_WATERMARK, ("",), False),
+        ("referral_window", XTRQueries.REFERRAL_WINDOW, (0, 1000), False),
+        ("referral_batch", XTRQueries.REFERRAL_BATCH, (10, 10, 0, 1000, 10), False),
+        ("referral_credit", XTRQueries.REFERRAL_CREDIT, (0,), False),
+    )
+    
     def __init__(self, db_path: str):
         self.db_path = db_path
         self._initialize_database()
+        self.pool = XTRConnectionPool(
+            db_path,
+            size=XTRConfig.DB_POOL_SIZE,
+            acquire_timeout=XTRConfig.DB_POOL_TIMEOUT,
+            statement_cache_size=XTRConfig.DB_STATEMENT_CACHE
+        )
+        self.writer = XTRWriteEngine(
+            db_path,
+            max_batch=XTRConfig.DB_WRITE_BATCH,
+            tick=XTRConfig.DB_WRITE_TICK
+        )
     
     def _initialize_database(self):
         """Инициализация базы данных"""
@@ -301,6 +1423,23 @@ class XTRDatabase:
                     )
                 ''')
                 
+                # Заявки на покупку NFT (звезды зарезервированы до исполнения/отмены)
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS nft_bids (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        nft_id INTEGER NOT NULL,
+                        bidder_id INTEGER NOT NULL,
+                        price_stars INTEGER NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'open'
+                            CHECK (status IN ('open', 'filled', 'cancelled')),
+                        fill_price INTEGER,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        closed_at TIMESTAMP,
+                        FOREIGN KEY (nft_id) REFERENCES nft_items(id),
+                        FOREIGN KEY (bidder_id) REFERENCES users(user_id)
+                    )
+                ''')
+                
                 # Реферальные выплаты
                 cursor.execute('''
                     CREATE TABLE IF NOT EXISTS referral_payouts (
@@ -326,6 +1465,61 @@ class XTRDatabase:
                     )
                 ''')
                 
+                # Состояния FSM
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS fsm_states (
+                        key TEXT PRIMARY KEY,
+                        state TEXT,
+                        data TEXT,
+                        expires_at REAL NOT NULL
+                    )
+                ''')
+                
+                # Выставленные инвойсы (машина состояний XTRInvoiceTracker)
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS pending_invoices (
+                        key TEXT PRIMARY KEY,
+                        user_id INTEGER NOT NULL,
+                        amount_xtr INTEGER NOT NULL,
+                        state TEXT NOT NULL DEFAULT 'pending'
+                            CHECK (state IN ('pending', 'pre_checked', 'paid', 'expired', 'failed')),
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        charge_id TEXT,
+                        created_at REAL NOT NULL,
+                        expires_at REAL NOT NULL,
+                        updated_at REAL NOT NULL
+                    )
+                ''')
+                
+                # Водяные знаки пакетных заданий
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS job_watermarks (
+                        name TEXT PRIMARY KEY,
+                        value INTEGER NOT NULL DEFAULT 0,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                
+                # Сводная статистика
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS stats_totals (
+                        key TEXT PRIMARY KEY,
+                        value INTEGER NOT NULL DEFAULT 0
+                    )
+                ''')
+                
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS stats_daily (
+                        day TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        value INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (day, key)
+                    )
+                ''')
+                
+                # Индексы
+                self._apply_index_migrations(cursor)
+                
                 # Вставляем начальные данные
                 self._insert_initial_data(cursor)
                 
@@ -336,6 +1530,22 @@ class XTRDatabase:
             logger.error(f"Ошибка инициализации БД: {e}")
             raise
     
+    def _apply_index_migrations(self, cursor):
+        """Применить недостающие версии набора индексов"""
+        current = cursor.execute("PRAGMA user_version").fetchone()[0]
+        
+        for version, statements in self.INDEX_MIGRATIONS:
+            if version <= current:
+                continue
+            for statement in statements:
+                cursor.execute(statement)
+                # Миграции данных (не DDL) видны в логе
+                if cursor.rowcount > 0:
+                    logger.warning(f"Миграция индексов v{version}: затронуто строк {cursor.rowcount}: {statement[:80]}")
+            # PRAGMA не поддерживает параметры
+            cursor.execute(f"PRAGMA user_version = {int(version)}")
+            logger.info(f"Индексы БД обновлены до версии {version}")
+    
     def _insert_initial_data(self, cursor):
         """Вставка начальных данных"""
         try:
@@ -366,28 +1576,44 @@ class XTRDatabase:
     
     @asynccontextmanager
     async def get_connection(self):
-        """Асинхронное соединение с БД"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        """Асинхронное соединение с БД из пула"""
+        async with self.pool.connection() as db:
             yield db
     
+    async def write(self, job: Callable[[aiosqlite.Connection], Awaitable[Any]]) -> Any:
+        """Выполнить задание записи через писателя (групповой коммит)"""
+        started = time.perf_counter()
+        try:
+            return await self.writer.submit(job)
+        finally:
+            metrics.db_latency.observe(time.perf_counter() - started, 'write', metrics.job_name(job))
+    
     async def execute(self, query: str, params: tuple = None):
         """Выполнить запрос"""
-        async with self.get_connection() as db:
-            await db.execute(query, params or ())
-            await db.commit()
+        async def job(conn):
+            await conn.execute(query, params or ())
+        
+        await self.write(job)
     
     async def fetchone(self, query: str, params: tuple = None):
         """Получить одну запись"""
-        async with self.get_connection() as db:
-            async with db.execute(query, params or ()) as cursor:
-                return await cursor.fetchone()
+        started = time.perf_counter()
+        try:
+            async with self.get_connection() as db:
+                async with db.execute(query, params or ()) as cursor:
+                    return await cursor.fetchone()
+        finally:
+            metrics.db_latency.observe(time.perf_counter() - started, 'fetchone', metrics.fingerprint(query))
     
     async def fetchall(self, query: str, params: tuple = None):
         """Получить все записи"""
-        async with self.get_connection() as db:
-            async with db.execute(query, params or ()) as cursor:
-                return await cursor.fetchall()
+        started = time.perf_counter()
+        try:
+            async with self.get_connection() as db:
+                async with db.execute(query, params or ()) as cursor:
+                    return await cursor.fetchall()
+        finally:
+            metrics.db_latency.observe(time.perf_counter() - started, 'fetchall', metrics.fingerprint(query))
     
     async def backup(self):
         """Создать резервную копию"""
@@ -404,41 +1630,1404 @@ class XTRDatabase:
         except Exception as e:
             logger.error(f"Ошибка создания резервной копии: {e}")
             return None
-
-# Инициализация базы данных
-try:
-    XTRConfig.validate()
-    db = XTRDatabase(XTRConfig.DB_FILE)
-    logger.info("Конфигурация XTR загружена успешно")
-except Exception as e:
-    logger.critical(f"Критическая ошибка инициализации: {e}")
-    sys.exit(1)
-
-# ============================================================================
-# СИСТЕМА XTR ПЛАТЕЖЕЙ
-# ============================================================================
-
-class XTRPaymentSystem:
+    
+    async def check_query_plans(self) -> List[str]:
+        """
+        Прогнать EXPLAIN QUERY PLAN по QUERY_PLAN_SUITE.
+        
+        Возвращает запросы с полным сканом (SCAN таблицы или всего индекса,
+        в том числе покрывающего; скан частичного индекса допустим) и
+        индексы idx_*, которые не использует ни один запрос набора.
+        """
+        violations = []
+        used_indexes = set()
+        
+        async with self.get_connection() as conn:
+            partial, unused = set(), set()
+            async with conn.execute(
+                "SELECT name, tbl_name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'"
+            ) as cursor:
+                indexes = await cursor.fetchall()
+            for index in indexes:
+                async with conn.execute(f"PRAGMA index_list({index[1]})") as cursor:
+                    info = {row[1]: row for row in await cursor.fetchall()}[index[0]]
+                if info[4]:
+                    partial.add(index[0])
+                # Уникальные индексы держат ограничение, даже если их не видно в планах
+                if not info[2]:
+                    unused.add(index[0])
+            
+            for name, query, params, allow_scan in self.QUERY_PLAN_SUITE:
+                async with conn.execute(f"EXPLAIN QUERY PLAN {query}", params) as cursor:
+                    plan = [row[3] for row in await cursor.fetchall()]
+                
+                # Скан материализованного подзапроса - это не таблица
+                subqueries = {step.split()[1] for step in plan if step.split()[0] in ("MATERIALIZE", "CO-ROUTINE")}
+                used_indexes.update(self._plan_indexes(plan))
+                scans = [step for step in plan
+                         if self._is_full_scan(step, partial) and step.split()[1] not in subqueries]
+                if scans and not allow_scan:
+                    violations.append(f"{name}: {'; '.join(scans)}")
+        
+        for index in sorted(unused - used_indexes):
+            violations.append(f"unused index: {index}")
+        return violations
+    
+    @staticmethod
+    def _plan_indexes(plan: List[str]) -> List[str]:
+        """Индексы, упомянутые в шагах плана"""
+        names = []
+        for step in plan:
+            words = step.split()
+            if "INDEX" in words and words.index("INDEX") + 1 < len(words):
+                names.append(words[words.index("INDEX") + 1])
+        return names
+    
+    @classmethod
+    def _is_full_scan(cls, step: str, partial: set) -> bool:
+        """
+        Шаг плана читает всю таблицу или весь индекс.
+        
+        'SCAN t USING COVERING INDEX i' - тоже полный проход, только по
+        индексу; исключение - частичный индекс (WHERE в CREATE INDEX).
+        """
+        words = step.split()
+        if not words or words[0] != "SCAN" or "CONSTANT" in words:
+            return False
+        indexes = cls._plan_indexes([step])
+        return not indexes or indexes[0] not in partial
+    
+    def pool_stats(self) -> Dict[str, Any]:
+        """Статистика пула соединений"""
+        return self.pool.stats()
+    
+    def writer_stats(self) -> Dict[str, Any]:
+        """Статистика писателя"""
+        return self.writer.stats()
+    
+    async def close(self):
+        """Закрыть соединения с БД"""
+        await self.writer.close()
+        await self.pool.close()
+
+# Инициализация базы данных
+try:
+    XTRConfig.validate()
+    db = XTRDatabase(XTRConfig.DB_FILE)
+    logger.info("Конфигурация XTR загружена успешно")
+except Exception as e:
+    logger.critical(f"Критическая ошибка инициализации: {e}")
+    sys.exit(1)
+
+# ============================================================================
+# КУРС ОБМЕНА
+# ============================================================================
+
+class XTRRateProvider:
+    """Курс обмена в памяти процесса"""
+    
+    def __init__(self, database: XTRDatabase, ttl: float):
+        self.db = database
+        self.ttl = ttl
+        self._rate: Optional[int] = None
+        self._loaded_at = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+    
+    async def get(self) -> int:
+        """Текущий курс (звезд за 1 XTR)"""
+        if self._rate is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return self._rate
+        return await self.refresh()
+    
+    async def refresh(self) -> int:
+        """Перечитать курс из БД"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        
+        loaded_at = self._loaded_at
+        async with self._lock:
+            # Курс уже перечитан конкурентным вызовом
+            if self._rate is not None and self._loaded_at != loaded_at:
+                return self._rate
+            
+            row = await self.db.fetchone(XTRQueries.EXCHANGE_RATE)
+            self._rate = row['stars_per_xtr'] if row else XTRConfig.STARS_EXCHANGE_RATE
+            self._loaded_at = time.monotonic()
+            return self._rate
+    
+    def invalidate(self):
+        """Сбросить кэш"""
+        self._rate = None
+    
+    async def set_rate(self, stars_per_xtr: int) -> int:
+        """Изменить курс и сразу обновить кэш"""
+        await self.db.execute('''
+            UPDATE exchange_rates 
+            SET stars_per_xtr = ?, last_updated = CURRENT_TIMESTAMP 
+            WHERE id = 1
+        ''', (stars_per_xtr,))
+        
+        self.invalidate()
+        rate = await self.refresh()
+        logger.info(f"Курс обмена изменен: 1 XTR = {rate} ⭐")
+        return rate
+
+rates = XTRRateProvider(db, XTRConfig.EXCHANGE_RATE_TTL)
+
+# ============================================================================
+# СВОДНАЯ СТАТИСТИКА
+# ============================================================================
+
+class XTRStatsRollup:
+    """
+    Инкрементальные счетчики stats_totals / stats_daily.
+    
+    Счетчики обновляются bump() внутри заданий писателя - в той же
+    транзакции, что и сами депозиты, выводы и покупки, - поэтому
+    /admin stats читает готовые значения вместо агрегатов по истории.
+    """
+    
+    # Пересчет счетчиков по истории (ключи совпадают с bump())
+    REBUILD_STATEMENTS = (
+        "DELETE FROM stats_totals",
+        "DELETE FROM stats_daily",
+        XTRQueries.STATS_REBUILD_TOTALS,
+        XTRQueries.STATS_REBUILD_DAILY,
+    )
+    
+    def __init__(self, database: XTRDatabase):
+        self.db = database
+    
+    @staticmethod
+    async def bump(conn: aiosqlite.Connection, **deltas: int):
+        """Изменить счетчики (вызывается внутри задания писателя)"""
+        rows = [(key, value) for key, value in deltas.items() if value]
+        if not rows:
+            return
+        
+        await conn.executemany('''
+            INSERT INTO stats_totals (key, value) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = value + excluded.value
+        ''', rows)
+        await conn.executemany('''
+            INSERT INTO stats_daily (day, key, value) VALUES (date('now'), ?, ?)
+            ON CONFLICT(day, key) DO UPDATE SET value = value + excluded.value
+        ''', rows)
+    
+    async def totals(self) -> Dict[str, int]:
+        """Все счетчики за все время"""
+        rows = await self.db.fetchall(XTRQueries.STATS_TOTALS)
+        return {row['key']: row['value'] for row in rows}
+    
+    async def today(self) -> Dict[str, int]:
+        """Счетчики за текущие сутки (UTC)"""
+        rows = await self.db.fetchall(XTRQueries.STATS_TODAY)
+        return {row['key']: row['value'] for row in rows}
+    
+    async def rebuild(self):
+        """Пересчитать счетчики по истории одной транзакцией"""
+        async def job(conn):
+            for statement in self.REBUILD_STATEMENTS:
+                await conn.execute(statement)
+        
+        await self.db.write(job)
+        logger.info("Сводная статистика пересчитана")
+    
+    async def bootstrap(self):
+        """Заполнить счетчики по истории, если таблица пуста (первый запуск)"""
+        row = await self.db.fetchone("SELECT COUNT(*) as count FROM stats_totals")
+        if not row or not row['count']:
+            await self.rebuild()
+
+rollups = XTRStatsRollup(db)
+
+# ============================================================================
+# ТАБЛИЦА ЛИДЕРОВ
+# ============================================================================
+
+class XTRRankIndex:
+    """
+    Очки пользователей по убыванию с рангом за O(log n).
+    
+    Отсортированный список разбит на подсписки (как в sortedcontainers),
+    длины подсписков лежат в дереве Фенвика: позиция ключа - это сумма
+    длин предыдущих подсписков плюс bisect внутри своего. Хранятся
+    только ненулевые очки; все нулевые делят последнее место.
+    """
+    
+    LOAD = 512  # Целевая длина подсписка
+    
+    def __init__(self):
+        self._lists: List[List[Tuple[int, int]]] = []
+        self._maxes: List[Tuple[int, int]] = []
+        self._tree: List[int] = [0]
+        self._scores: Dict[int, int] = {}
+    
+    def __len__(self) -> int:
+        return len(self._scores)
+    
+    @staticmethod
+    def _key(user_id: int, score: int) -> Tuple[int, int]:
+        """Ключ сортировки: больше очков - раньше, при равенстве - меньший user_id"""
+        return (-score, user_id)
+    
+    def _rebuild_tree(self):
+        """Построить дерево Фенвика по длинам подсписков за O(m)"""
+        size = len(self._lists)
+        tree = [0] * (size + 1)
+        for i, sublist in enumerate(self._lists, start=1):
+            tree[i] += len(sublist)
+            parent = i + (i & -i)
+            if parent <= size:
+                tree[parent] += tree[i]
+        self._tree = tree
+    
+    def _tree_add(self, index: int, delta: int):
+        size = len(self._lists)
+        index += 1
+        while index <= size:
+            self._tree[index] += delta
+            index += index & -index
+    
+    def _prefix(self, index: int) -> int:
+        """Суммарная длина подсписков [0, index)"""
+        total = 0
+        while index > 0:
+            total += self._tree[index]
+            index -= index & -index
+        return total
+    
+    def _locate(self, position: int) -> Tuple[int, int]:
+        """Позиция в общем порядке -> (подсписок, смещение в нем)"""
+        index = 0
+        step = 1 << len(self._lists).bit_length()
+        while step:
+            candidate = index + step
+            if candidate < len(self._tree) and self._tree[candidate] <= position:
+                index = candidate
+                position -= self._tree[candidate]
+            step >>= 1
+        return index, position
+    
+    def _insert(self, key: Tuple[int, int]):
+        if not self._lists:
+            self._lists.append([key])
+            self._maxes.append(key)
+            self._rebuild_tree()
+            return
+        
+        i = bisect.bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+            self._lists[i].append(key)
+            self._maxes[i] = key
+        else:
+            bisect.insort(self._lists[i], key)
+        
+        sublist = self._lists[i]
+        if len(sublist) > 2 * self.LOAD:
+            # Делим переросший подсписок пополам
+            self._lists.insert(i + 1, sublist[self.LOAD:])
+            del sublist[self.LOAD:]
+            self._maxes[i] = sublist[-1]
+            self._maxes.insert(i + 1, self._lists[i + 1][-1])
+            self._rebuild_tree()
+        else:
+            self._tree_add(i, 1)
+    
+    def _remove(self, key: Tuple[int, int]):
+        i = bisect.bisect_left(self._maxes, key)
+        sublist = self._lists[i]
+        del sublist[bisect.bisect_left(sublist, key)]
+        
+        if sublist:
+            self._maxes[i] = sublist[-1]
+            self._tree_add(i, -1)
+        else:
+            del self._lists[i]
+            del self._maxes[i]
+            self._rebuild_tree()
+    
+    def load(self, scores: Dict[int, int]):
+        """Заменить содержимое целиком"""
+        self._scores = {user_id: score for user_id, score in scores.items() if score > 0}
+        keys = sorted(self._key(user_id, score) for user_id, score in self._scores.items())
+        self._lists = [keys[i:i + self.LOAD] for i in range(0, len(keys), self.LOAD)]
+        self._maxes = [sublist[-1] for sublist in self._lists]
+        self._rebuild_tree()
+    
+    def score(self, user_id: int) -> int:
+        return self._scores.get(user_id, 0)
+    
+    def set(self, user_id: int, score: int):
+        """Установить очки пользователя"""
+        old = self._scores.get(user_id)
+        if old == score:
+            return
+        if old is not None:
+            self._remove(self._key(user_id, old))
+        if score > 0:
+            self._insert(self._key(user_id, score))
+            self._scores[user_id] = score
+        else:
+            self._scores.pop(user_id, None)
+    
+    def add(self, user_id: int, delta: int):
+        """Изменить очки на delta"""
+        if delta:
+            self.set(user_id, self._scores.get(user_id, 0) + delta)
+    
+    def rank(self, user_id: int) -> int:
+        """Место пользователя (1 - лучший); без очков - после всех"""
+        score = self._scores.get(user_id)
+        if score is None:
+            return len(self._scores) + 1
+        key = self._key(user_id, score)
+        i = bisect.bisect_left(self._maxes, key)
+        return self._prefix(i) + bisect.bisect_left(self._lists[i], key) + 1
+    
+    def page(self, offset: int, limit: int) -> List[Tuple[int, int]]:
+        """(user_id, очки) на местах offset+1 .. offset+limit"""
+        result = []
+        if offset >= len(self._scores) or limit <= 0:
+            return result
+        
+        i, j = self._locate(offset)
+        while i < len(self._lists) and len(result) < limit:
+            for neg_score, user_id in self._lists[i][j:j + limit - len(result)]:
+                result.append((user_id, -neg_score))
+            i, j = i + 1, 0
+        return result
+
+
+class XTRLeaderboard:
+    """
+    Таблицы лидеров в памяти процесса.
+    
+    Индексы загружаются из БД при старте и дальше меняются приращениями
+    после каждой записи (add()), а раз в resync_interval перечитываются
+    целиком как страховка от расхождений. Первые top_k мест каждой
+    таблицы вместе с именами кэшируются до изменения, которое их задевает.
+    """
+    
+    BOARDS = {
+        'deposits': "💎 Депозиты",
+        'stars': "⭐ Звезды",
+        'nfts': "🎨 NFT",
+        'referrals': "👥 Рефералы",
+    }
+    
+    def __init__(self, database: XTRDatabase, top_k: int, resync_interval: float):
+        self.db = database
+        self.top_k = top_k
+        self.resync_interval = resync_interval
+        
+        self.boards: Dict[str, XTRRankIndex] = {name: XTRRankIndex() for name in self.BOARDS}
+        self._top_cache: Dict[str, List[Dict[str, Any]]] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock: Optional[asyncio.Lock] = None
+    
+    async def load(self):
+        """Перечитать все таблицы из БД"""
+        users = await self.db.fetchall(XTRQueries.LEADERBOARD_LOAD)
+        nfts = await self.db.fetchall(XTRQueries.LEADERBOARD_LOAD_NFTS)
+        
+        self.boards['deposits'].load({row['user_id']: row['total_deposited_xtr'] or 0 for row in users})
+        self.boards['stars'].load({row['user_id']: row['balance_stars'] or 0 for row in users})
+        self.boards['referrals'].load({row['user_id']: row['referrals'] or 0 for row in users})
+        self.boards['nfts'].load({row['user_id']: row['count'] for row in nfts})
+        
+        self._top_cache.clear()
+        self._loaded_at = time.monotonic()
+        logger.info(f"Таблицы лидеров загружены: {len(users)} пользователей с очками")
+    
+    async def ensure_loaded(self):
+        """Загрузить при первом обращении и по истечении resync_interval"""
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.resync_interval:
+            return
+        
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        
+        loaded_at = self._loaded_at
+        async with self._lock:
+            # Уже перечитано конкурентным вызовом
+            if self._loaded_at != loaded_at:
+                return
+            await self.load()
+    
+    def add(self, user_id: int, **deltas: int):
+        """Применить приращения очков после записи"""
+        for name, delta in deltas.items():
+            if not delta:
+                continue
+            board = self.boards[name]
+            was_top = board.rank(user_id) <= self.top_k
+            board.add(user_id, delta)
+            if was_top or board.rank(user_id) <= self.top_k:
+                self._top_cache.pop(name, None)
+    
+    async def _with_names(self, entries: List[Tuple[int, int]], offset: int) -> List[Dict[str, Any]]:
+        """Добавить имена пользователей к странице"""
+        names = {}
+        if entries:
+            rows = await self.db.fetchall(
+                XTRQueries.leaderboard_names(len(entries)),
+                tuple(user_id for user_id, _ in entries)
+            )
+            names = {row['user_id']: row['username'] or row['first_name'] for row in rows}
+        
+        return [
+            {"rank": offset + i + 1, "user_id": user_id, "name": names.get(user_id), "score": score}
+            for i, (user_id, score) in enumerate(entries)
+        ]
+    
+    async def page(self, board: str, offset: int, limit: int) -> List[Dict[str, Any]]:
+        """Места offset+1 .. offset+limit с именами"""
+        await self.ensure_loaded()
+        
+        if offset + limit <= self.top_k:
+            top = self._top_cache.get(board)
+            if top is None:
+                top = await self._with_names(self.boards[board].page(0, self.top_k), 0)
+                self._top_cache[board] = top
+            return top[offset:offset + limit]
+        
+        return await self._with_names(self.boards[board].page(offset, limit), offset)
+    
+    async def rank(self, board: str, user_id: int) -> Tuple[int, int]:
+        """(место, очки) пользователя"""
+        await self.ensure_loaded()
+        index = self.boards[board]
+        return index.rank(user_id), index.score(user_id)
+    
+    async def total(self, board: str) -> int:
+        """Участников с ненулевыми очками"""
+        await self.ensure_loaded()
+        return len(self.boards[board])
+
+leaderboard = XTRLeaderboard(db, XTRConfig.LEADERBOARD_TOP_K, XTRConfig.LEADERBOARD_RESYNC)
+
+# ============================================================================
+# ИСТОРИЯ ОПЕРАЦИЙ
+# ============================================================================
+
+class XTRCursorError(ValueError):
+    """Курсор страницы не разбирается"""
+
+
+class XTRHistory:
+    """
+    Постраничная история пользователя: keyset по (user_id, id).
+    
+    Страница - это строки с id меньше курсора, по убыванию id, поэтому
+    любая страница стоит одного спуска по индексу (user_id) (rowid в
+    хвосте индекса дает порядок по id) вне зависимости от длины истории.
+    Курсор - непрозрачный base64url от последнего id страницы. Фильтры
+    по type и status идут по индексам (user_id, type) и (user_id, status).
+    """
+    
+    SOURCES = XTRQueries.HISTORY_SOURCES
+    MAX_LIMIT = 100
+    
+    def __init__(self, database: XTRDatabase):
+        self.db = database
+    
+    @staticmethod
+    def encode_cursor(last_id: int) -> str:
+        """Курсор следующей страницы"""
+        return base64.urlsafe_b64encode(struct.pack('>q', last_id)).rstrip(b'=').decode()
+    
+    @staticmethod
+    def decode_cursor(cursor: str) -> int:
+        """id, после которого начинается страница"""
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            (last_id,) = struct.unpack('>q', raw)
+        except (ValueError, struct.error):
+            raise XTRCursorError("Invalid cursor")
+        if last_id <= 0:
+            raise XTRCursorError("Invalid cursor")
+        return last_id
+    
+    async def page(self, source: str, user_id: int, cursor: Optional[str] = None, limit: int = 20,
+                   **filters: Optional[str]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Строки страницы и курсор следующей (None - страниц больше нет)"""
+        _, _, allowed = self.SOURCES[source]
+        limit = min(max(1, limit), self.MAX_LIMIT)
+        
+        params: List[Any] = [user_id]
+        if cursor:
+            params.append(self.decode_cursor(cursor))
+        applied = tuple(name for name in allowed if filters.get(name))
+        params.extend(filters[name] for name in applied)
+        params.append(limit + 1)
+        
+        rows = await self.db.fetchall(
+            XTRQueries.history_page(source, bool(cursor), applied),
+            tuple(params)
+        )
+        
+        items = [dict(row) for row in rows[:limit]]
+        next_cursor = self.encode_cursor(items[-1]['id']) if len(rows) > limit else None
+        return items, next_cursor
+
+history = XTRHistory(db)
+
+# ============================================================================
+# РЕЗЕРВИРОВАНИЕ СТОКА NFT
+# ============================================================================
+
+class XTRStockReservations:
+    """
+    Остатки лимитированных NFT в памяти процесса.
+    
+    Покупатель сначала резервирует единицу здесь; когда остаток
+    (за вычетом резервов в полете) исчерпан, отказ происходит без
+    обращения к писателю. Источник истины - nft_items.stock: остаток
+    обновляется по строке товара, прочитанной перед покупкой (так
+    подхватывается пополнение в БД), и по значению, которое вернула запись.
+    """
+    
+    UNLIMITED = -1
+    
+    def __init__(self):
+        self._stock: Dict[int, int] = {}
+        self._reserved: Dict[int, int] = {}
+        
+        # Счетчики для статистики
+        self._rejected_total = 0
+    
+    def try_reserve(self, nft_id: int) -> bool:
+        """Зарезервировать единицу; False - товар закончился"""
+        stock = self._stock.get(nft_id)
+        reserved = self._reserved.get(nft_id, 0)
+        
+        # Остаток неизвестен (первая покупка) или не ограничен
+        if stock is not None and stock != self.UNLIMITED and stock - reserved <= 0:
+            self._rejected_total += 1
+            return False
+        
+        self._reserved[nft_id] = reserved + 1
+        return True
+    
+    def release(self, nft_id: int, stock: Optional[int] = None, forget: bool = False):
+        """
+        Снять резерв.
+        
+        stock - остаток в БД после записи, если известен; forget - итог
+        записи неизвестен, остаток перечитается при следующей покупке.
+        """
+        reserved = self._reserved.get(nft_id, 0) - 1
+        if reserved > 0:
+            self._reserved[nft_id] = reserved
+        else:
+            self._reserved.pop(nft_id, None)
+        
+        if stock is not None:
+            self._stock[nft_id] = stock
+        elif forget:
+            self._stock.pop(nft_id, None)
+    
+    def set_stock(self, nft_id: int, stock: int):
+        """Обновить остаток по прочитанной строке nft_items"""
+        self._stock[nft_id] = stock
+    
+    def in_flight(self, nft_id: int) -> int:
+        """Сколько резервов товара сейчас в записи"""
+        return self._reserved.get(nft_id, 0)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Статистика резервов"""
+        return {
+            "tracked_items": len(self._stock),
+            "in_flight": sum(self._reserved.values()),
+            "rejected_total": self._rejected_total,
+        }
+
+nft_stock = XTRStockReservations()
+
+# ============================================================================
+# ВТОРИЧНЫЙ РЫНОК NFT
+# ============================================================================
+
+@dataclass
+class XTRMarketOrder:
+    """Активная заявка стакана"""
+    side: str  # 'ask' (лот nft_market) или 'bid' (заявка nft_bids)
+    order_id: int
+    nft_id: int
+    user_id: int
+    price: int  # В звездах
+    ownership_id: Optional[int] = None  # Только для ask
+
+
+class XTRMarketStale(Exception):
+    """Заявка стакана больше не действительна в БД"""
+    
+    def __init__(self, side: str, message: str):
+        super().__init__(message)
+        self.side = side
+
+
+class XTRMarketEngine:
+    """
+    Сопоставление заявок вторичного рынка NFT.
+    
+    Для каждого nft_id в памяти держатся две кучи: лоты (ask, по
+    возрастанию цены) и заявки на покупку (bid, по убыванию), при равной
+    цене раньше исполняется более ранняя заявка. Источник истины - таблицы
+    nft_market / nft_bids: стаканы восстанавливаются из них при старте.
+    Звезды покупателя резервируются при выставлении bid, поэтому сделка
+    (деньги и владение) проводится одним заданием писателя.
+    """
+    
+    def __init__(self, database: XTRDatabase):
+        self.db = database
+        
+        self._asks: Dict[int, List[Tuple[int, int, int]]] = {}  # nft_id -> [(цена, seq, id)]
+        self._bids: Dict[int, List[Tuple[int, int, int]]] = {}  # nft_id -> [(-цена, seq, id)]
+        self._orders: Dict[Tuple[str, int], XTRMarketOrder] = {}
+        self._depth: Dict[Tuple[str, int], int] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._seq = 0
+        
+        # Счетчики для статистики
+        self._trades_total = 0
+        self._stale_total = 0
+        self._match_time_total = 0.0
+        self._matches_total = 0
+    
+    # ------------------------------------------------------------------
+    # Стаканы в памяти
+    # ------------------------------------------------------------------
+    
+    def _lock(self, nft_id: int) -> asyncio.Lock:
+        lock = self._locks.get(nft_id)
+        if lock is None:
+            lock = self._locks[nft_id] = asyncio.Lock()
+        return lock
+    
+    def _add(self, order: XTRMarketOrder):
+        """Положить заявку в стакан"""
+        self._seq += 1
+        if order.side == 'ask':
+            heapq.heappush(self._asks.setdefault(order.nft_id, []), (order.price, self._seq, order.order_id))
+        else:
+            heapq.heappush(self._bids.setdefault(order.nft_id, []), (-order.price, self._seq, order.order_id))
+        self._orders[(order.side, order.order_id)] = order
+        depth_key = (order.side, order.nft_id)
+        self._depth[depth_key] = self._depth.get(depth_key, 0) + 1
+    
+    def _drop(self, side: str, order_id: int) -> Optional[XTRMarketOrder]:
+        """Убрать заявку (из кучи она уйдет лениво при следующем просмотре)"""
+        order = self._orders.pop((side, order_id), None)
+        if order is not None:
+            self._depth[(side, order.nft_id)] -= 1
+        return order
+    
+    def _best(self, side: str, nft_id: int) -> Optional[XTRMarketOrder]:
+        """Лучшая живая заявка стороны"""
+        heap = (self._asks if side == 'ask' else self._bids).get(nft_id)
+        while heap:
+            order = self._orders.get((side, heap[0][2]))
+            if order is not None:
+                return order
+            heapq.heappop(heap)
+        return None
+    
+    def book(self, nft_id: int) -> Dict[str, Any]:
+        """Сводка стакана"""
+        best_ask = self._best('ask', nft_id)
+        best_bid = self._best('bid', nft_id)
+        return {
+            "nft_id": nft_id,
+            "best_ask": best_ask.price if best_ask else None,
+            "best_bid": best_bid.price if best_bid else None,
+            "asks": self._depth.get(('ask', nft_id), 0),
+            "bids": self._depth.get(('bid', nft_id), 0),
+        }
+    
+    async def load(self):
+        """Восстановить стаканы из БД"""
+        asks = await self.db.fetchall(XTRQueries.MARKET_LOAD_ASKS)
+        bids = await self.db.fetchall(XTRQueries.MARKET_LOAD_BIDS)
+        
+        self._asks.clear()
+        self._bids.clear()
+        self._orders.clear()
+        self._depth.clear()
+        
+        # Приоритет по времени при равной цене: в порядке id
+        for row in sorted(asks, key=lambda r: r['id']):
+            self._add(XTRMarketOrder('ask', row['id'], row['nft_id'], row['seller_id'],
+                                     row['price_stars'], row['ownership_id']))
+        for row in sorted(bids, key=lambda r: r['id']):
+            self._add(XTRMarketOrder('bid', row['id'], row['nft_id'], row['bidder_id'], row['price_stars']))
+        
+        logger.info(f"Стаканы NFT восстановлены: {len(asks)} лотов, {len(bids)} заявок")
+        
+        # Пересекающиеся заявки могли остаться после аварийной остановки
+        for nft_id in set(self._asks) & set(self._bids):
+            async with self._lock(nft_id):
+                await self._match(nft_id, incoming='ask')
+    
+    # ------------------------------------------------------------------
+    # Сопоставление и расчет
+    # ------------------------------------------------------------------
+    
+    async def _match(self, nft_id: int, incoming: str) -> List[Dict[str, Any]]:
+        """Исполнять пересекающиеся заявки, пока стакан не разойдется"""
+        trades = []
+        while True:
+            started = time.perf_counter()
+            ask = self._best('ask', nft_id)
+            bid = self._best('bid', nft_id)
+            self._match_time_total += time.perf_counter() - started
+            self._matches_total += 1
+            
+            if ask is None or bid is None or bid.price < ask.price:
+                return trades
+            
+            # Цена сделки - цена стоявшей в стакане заявки
+            price = ask.price if incoming == 'bid' else bid.price
+            
+            try:
+                await self.db.write(self._settle_job(ask, bid, price))
+            except XTRMarketStale as e:
+                self._stale_total += 1
+                logger.warning(f"Заявка {e.side} снята со стакана NFT {nft_id}: {e}")
+                if e.side == 'bid':
+                    self._drop('bid', bid.order_id)
+                    if await self.db.write(self._cancel_bid_job(bid.order_id, bid.user_id, bid.price)):
+                        leaderboard.add(bid.user_id, stars=bid.price)
+                else:
+                    self._drop('ask', ask.order_id)
+                continue
+            except Exception as e:
+                logger.error(f"Ошибка расчета сделки NFT {nft_id}: {e}")
+                return trades
+            
+            self._drop('ask', ask.order_id)
+            self._drop('bid', bid.order_id)
+            self._trades_total += 1
+            leaderboard.add(ask.user_id, stars=price, nfts=-1)
+            leaderboard.add(bid.user_id, stars=bid.price - price, nfts=1)
+            
+            trades.append({
+                "nft_id": nft_id,
+                "price": price,
+                "listing_id": ask.order_id,
+                "bid_id": bid.order_id,
+                "seller_id": ask.user_id,
+                "buyer_id": bid.user_id,
+            })
+    
+    def _settle_job(self, ask: XTRMarketOrder, bid: XTRMarketOrder, price: int):
+        """Задание писателя: сделка целиком в одной транзакции"""
+        async def job(conn):
+            async with conn.execute(
+                "SELECT 1 FROM nft_ownership WHERE user_id = ? AND nft_id = ?",
+                (bid.user_id, bid.nft_id)
+            ) as cursor:
+                if await cursor.fetchone():
+                    raise XTRMarketStale('bid', "покупатель уже владеет этим NFT")
+            
+            cursor = await conn.execute('''
+                UPDATE nft_bids SET status = 'filled', fill_price = ?, closed_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'open'
+            ''', (price, bid.order_id))
+            if cursor.rowcount == 0:
+                raise XTRMarketStale('bid', "заявка уже закрыта")
+            
+            # Передача владения
+            cursor = await conn.execute('''
+                UPDATE nft_ownership 
+                SET user_id = ?, is_listed = 0, listing_price = NULL,
+                    purchase_price = ?, purchase_type = 'market', purchased_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND user_id = ? AND is_listed = 1
+            ''', (bid.user_id, price, ask.ownership_id, ask.user_id))
+            if cursor.rowcount == 0:
+                # Откат точки сохранения вернет и заявку покупателя
+                raise XTRMarketStale('ask', "лот больше не выставлен")
+            
+            # В лоте фиксируется цена исполнения
+            await conn.execute(
+                "UPDATE nft_market SET sold_at = CURRENT_TIMESTAMP, buyer_id = ?, price_stars = ? WHERE id = ?",
+                (bid.user_id, price, ask.order_id)
+            )
+            
+            # Продавцу - цена сделки, покупателю - остаток резерва
+            await conn.execute(
+                "UPDATE users SET balance_stars = balance_stars + ? WHERE user_id = ?",
+                (price, ask.user_id)
+            )
+            transactions = [(ask.user_id, price, 'market_sale', f"Продажа NFT #{ask.ownership_id}")]
+            
+            refund = bid.price - price
+            if refund > 0:
+                await conn.execute(
+                    "UPDATE users SET balance_stars = balance_stars + ? WHERE user_id = ?",
+                    (refund, bid.user_id)
+                )
+                transactions.append((bid.user_id, refund, 'market_refund', f"Возврат резерва заявки #{bid.order_id}"))
+            
+            await conn.executemany('''
+                INSERT INTO star_transactions (user_id, amount, type, description)
+                VALUES (?, ?, ?, ?)
+            ''', transactions)
+            
+            await rollups.bump(conn, market_trades=1, market_volume_stars=price)
+        
+        return job
+    
+    @staticmethod
+    def _cancel_bid_job(bid_id: int, user_id: int, price: int):
+        """Задание писателя: снять заявку и вернуть резерв"""
+        async def job(conn):
+            cursor = await conn.execute('''
+                UPDATE nft_bids SET status = 'cancelled', closed_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND bidder_id = ? AND status = 'open'
+            ''', (bid_id, user_id))
+            if cursor.rowcount == 0:
+                return False
+            
+            await conn.execute(
+                "UPDATE users SET balance_stars = balance_stars + ? WHERE user_id = ?",
+                (price, user_id)
+            )
+            await conn.execute('''
+                INSERT INTO star_transactions (user_id, amount, type, description)
+                VALUES (?, ?, 'market_refund', ?)
+            ''', (user_id, price, f"Отмена заявки #{bid_id}"))
+            return True
+        
+        return job
+    
+    # ------------------------------------------------------------------
+    # Операции пользователей
+    # ------------------------------------------------------------------
+    
+    async def list_nft(self, user_id: int, ownership_id: int, price: int) -> Tuple[bool, str, List[Dict[str, Any]]]:
+        """Выставить NFT на продажу"""
+        if price <= 0:
+            return False, "Цена должна быть больше нуля", []
+        
+        async def job(conn):
+            async with conn.execute('''
+                UPDATE nft_ownership SET is_listed = 1, listing_price = ?
+                WHERE id = ? AND user_id = ? AND is_listed = 0
+                RETURNING nft_id
+            ''', (price, ownership_id, user_id)) as cursor:
+                owned = await cursor.fetchone()
+            if not owned:
+                return None, None
+            
+            async with conn.execute('''
+                INSERT INTO nft_market (nft_ownership_id, seller_id, price_stars)
+                VALUES (?, ?, ?)
+                RETURNING id
+            ''', (ownership_id, user_id, price)) as cursor:
+                listing = await cursor.fetchone()
+            return listing['id'], owned['nft_id']
+        
+        try:
+            listing_id, nft_id = await self.db.write(job)
+        except Exception as e:
+            logger.error(f"Ошибка выставления NFT: {e}")
+            return False, f"Ошибка: {str(e)}", []
+        
+        if listing_id is None:
+            return False, "NFT не найден в вашей коллекции или уже выставлен", []
+        
+        async with self._lock(nft_id):
+            self._add(XTRMarketOrder('ask', listing_id, nft_id, user_id, price, ownership_id))
+            trades = await self._match(nft_id, incoming='ask')
+        
+        if trades:
+            return True, f"Лот #{listing_id} продан за {trades[0]['price']} ⭐", trades
+        return True, f"Лот #{listing_id} выставлен за {price} ⭐", trades
+    
+    async def place_bid(self, user_id: int, nft_id: int, price: int) -> Tuple[bool, str, List[Dict[str, Any]]]:
+        """Выставить заявку на покупку (звезды резервируются)"""
+        if price <= 0:
+            return False, "Цена должна быть больше нуля", []
+        
+        async def job(conn):
+            async with conn.execute("SELECT 1 FROM nft_items WHERE id = ?", (nft_id,)) as cursor:
+                if not await cursor.fetchone():
+                    return None, "NFT не найден"
+            
+            async with conn.execute(
+                "SELECT 1 FROM nft_ownership WHERE user_id = ? AND nft_id = ?",
+                (user_id, nft_id)
+            ) as cursor:
+                if await cursor.fetchone():
+                    return None, "Этот NFT уже есть в вашей коллекции"
+            
+            cursor = await conn.execute('''
+                UPDATE users SET balance_stars = balance_stars - ?
+                WHERE user_id = ? AND balance_stars >= ?
+            ''', (price, user_id, price))
+            if cursor.rowcount == 0:
+                return None, "Недостаточно звезд"
+            
+            async with conn.execute('''
+                INSERT INTO nft_bids (nft_id, bidder_id, price_stars)
+                VALUES (?, ?, ?)
+                RETURNING id
+            ''', (nft_id, user_id, price)) as cursor:
+                bid = await cursor.fetchone()
+            
+            await conn.execute('''
+                INSERT INTO star_transactions (user_id, amount, type, description)
+                VALUES (?, ?, 'market_bid', ?)
+            ''', (user_id, -price, f"Резерв заявки #{bid['id']}"))
+            return bid['id'], None
+        
+        try:
+            bid_id, error = await self.db.write(job)
+        except Exception as e:
+            logger.error(f"Ошибка выставления заявки: {e}")
+            return False, f"Ошибка: {str(e)}", []
+        
+        if error:
+            return False, error, []
+        
+        leaderboard.add(user_id, stars=-price)
+        
+        async with self._lock(nft_id):
+            self._add(XTRMarketOrder('bid', bid_id, nft_id, user_id, price))
+            trades = await self._match(nft_id, incoming='bid')
+        
+        if trades:
+            return True, f"Заявка #{bid_id} исполнена по {trades[0]['price']} ⭐", trades
+        return True, f"Заявка #{bid_id} выставлена: {price} ⭐ (зарезервировано)", trades
+    
+    async def cancel_listing(self, user_id: int, listing_id: int) -> Tuple[bool, str]:
+        """Снять лот с продажи"""
+        order = self._orders.get(('ask', listing_id))
+        if order is None or order.user_id != user_id:
+            return False, "Лот не найден"
+        
+        async with self._lock(order.nft_id):
+            async def job(conn):
+                cursor = await conn.execute('''
+                    UPDATE nft_ownership SET is_listed = 0, listing_price = NULL
+                    WHERE id = ? AND user_id = ? AND is_listed = 1
+                ''', (order.ownership_id, user_id))
+                if cursor.rowcount == 0:
+                    return False
+                await conn.execute("DELETE FROM nft_market WHERE id = ? AND sold_at IS NULL", (listing_id,))
+                return True
+            
+            removed = await self.db.write(job)
+            self._drop('ask', listing_id)
+        
+        return (True, f"Лот #{listing_id} снят с продажи") if removed else (False, "Лот уже продан или снят")
+    
+    async def cancel_bid(self, user_id: int, bid_id: int) -> Tuple[bool, str]:
+        """Снять заявку и вернуть резерв"""
+        order = self._orders.get(('bid', bid_id))
+        if order is None or order.user_id != user_id:
+            return False, "Заявка не найдена"
+        
+        async with self._lock(order.nft_id):
+            cancelled = await self.db.write(self._cancel_bid_job(bid_id, user_id, order.price))
+            self._drop('bid', bid_id)
+        
+        if not cancelled:
+            return False, "Заявка уже исполнена или снята"
+        
+        leaderboard.add(user_id, stars=order.price)
+        return True, f"Заявка #{bid_id} снята, {order.price} ⭐ возвращено"
+    
+    def active_books(self) -> List[Dict[str, Any]]:
+        """Сводки непустых стаканов"""
+        nft_ids = {nft_id for (side, nft_id), depth in self._depth.items() if depth > 0}
+        return [self.book(nft_id) for nft_id in sorted(nft_ids)]
+    
+    def stats(self) -> Dict[str, Any]:
+        """Статистика рынка"""
+        return {
+            "books": len(set(self._asks) | set(self._bids)),
+            "open_orders": len(self._orders),
+            "trades_total": self._trades_total,
+            "stale_total": self._stale_total,
+            "avg_match_us": round(self._match_time_total / self._matches_total * 1e6, 2)
+            if self._matches_total else 0.0,
+        }
+
+market = XTRMarketEngine(db)
+
+# ============================================================================
+# РЕФЕРАЛЬНАЯ ПРОГРАММА
+# ============================================================================
+
+class XTRReferralPayouts:
+    """
+    Пакетные реферальные выплаты.
+    
+    Пакет берет следующие batch_size депозитов после водяного знака
+    (id в xtr_transactions), одним INSERT ... SELECT пишет строки
+    referral_payouts по парам (реферер, приглашенный) и одним UPDATE
+    зачисляет суммы рефереров. Водяной знак двигается в той же
+    транзакции, поэтому после перезапуска обработка продолжается с места
+    остановки без повторных выплат.
+    """
+    
+    WATERMARK = 'referral_payouts'
+    
+    def __init__(self, database: XTRDatabase, percent: int, batch_size: int, interval: float):
+        self.db = database
+        self.percent = percent
+        self.batch_size = batch_size
+        self.interval = interval
+        
+        self._task: Optional[asyncio.Task] = None
+        self._watermark = 0
+        
+        # Счетчики для статистики
+        self._batches_total = 0
+        self._deposits_total = 0
+        self._payouts_total = 0
+        self._paid_xtr_total = 0
+        self._last_rate = 0.0
+    
+    @staticmethod
+    def parse_payload(payload: Optional[str]) -> Optional[int]:
+        """ID реферера из параметра /start (ref_<id> или <id>)"""
+        if not payload:
+            return None
+        if payload.startswith('ref_'):
+            payload = payload[4:]
+        return int(payload) if payload.isdigit() else None
+    
+    @staticmethod
+    async def attribute(conn: aiosqlite.Connection, user_id: int, referrer_id: int) -> bool:
+        """Привязать нового пользователя к рефереру (внутри задания писателя)"""
+        if referrer_id == user_id:
+            return False
+        
+        cursor = await conn.execute(
+            "UPDATE users SET referrals = referrals + 1 WHERE user_id = ?",
+            (referrer_id,)
+        )
+        if cursor.rowcount == 0:
+            return False
+        
+        await conn.execute(
+            "UPDATE users SET referral_id = ? WHERE user_id = ? AND referral_id IS NULL",
+            (referrer_id, user_id)
+        )
+        return True
+    
+    def _batch_job(self):
+        """Задание писателя: один пакет выплат"""
+        async def job(conn):
+            async with conn.execute(XTRQueries.REFERRAL_WATERMARK, (self.WATERMARK,)) as cursor:
+                row = await cursor.fetchone()
+            watermark = row['value'] if row else 0
+            
+            # Окно пакета: следующие batch_size депозитов после водяного знака
+            async with conn.execute(XTRQueries.REFERRAL_WINDOW, (watermark, self.batch_size)) as cursor:
+                window = await cursor.fetchall()
+            if not window:
+                return watermark, 0, []
+            high = window[-1]['id']
+            
+            async with conn.execute(
+                XTRQueries.REFERRAL_BATCH,
+                (self.percent, self.percent, watermark, high, self.percent)
+            ) as cursor:
+                payouts = await cursor.fetchall()
+            
+            if payouts:
+                first_id = min(payout['id'] for payout in payouts)
+                
+                # Зачисление рефереров и история - по одному запросу на пакет
+                await conn.execute(XTRQueries.REFERRAL_CREDIT, (first_id,))
+                await conn.execute('''
+                    INSERT INTO xtr_transactions (user_id, amount, type, status, description, completed_at)
+                    SELECT referrer_id, SUM(amount_xtr), 'reward', 'completed',
+                           'Referral payout ' || COUNT(*) || ' deposit(s)', CURRENT_TIMESTAMP
+                    FROM referral_payouts
+                    WHERE id >= ?
+                    GROUP BY referrer_id
+                ''', (first_id,))
+                
+                paid = sum(payout['amount_xtr'] for payout in payouts)
+                await rollups.bump(conn, referral_payouts_xtr=paid, balance_xtr=paid)
+            
+            await conn.execute('''
+                INSERT INTO job_watermarks (name, value) VALUES (?, ?)
+                ON CONFLICT(name) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
+            ''', (self.WATERMARK, high))
+            
+            return high, len(window), [(payout['referrer_id'], payout['amount_xtr']) for payout in payouts]
+        
+        return job
+    
+    async def run_batch(self) -> Tuple[int, Dict[int, int]]:
+        """Обработать один пакет: (депозитов просмотрено, {реферер: зачислено XTR})"""
+        started = time.perf_counter()
+        watermark, scanned, payouts = await self.db.write(self._batch_job())
+        elapsed = time.perf_counter() - started
+        
+        self._watermark = watermark
+        if not scanned:
+            return 0, {}
+        
+        credited: Dict[int, int] = {}
+        for referrer_id, amount in payouts:
+            credited[referrer_id] = credited.get(referrer_id, 0) + amount
+        
+        self._batches_total += 1
+        self._deposits_total += scanned
+        self._payouts_total += len(payouts)
+        self._paid_xtr_total += sum(credited.values())
+        self._last_rate = scanned / elapsed if elapsed > 0 else 0.0
+        
+        logger.info(
+            f"Реферальный пакет: {scanned} депозитов, {len(payouts)} выплат, "
+            f"{sum(credited.values())} XTR, {self._last_rate:.0f} деп/с, водяной знак {watermark}"
+        )
+        return scanned, credited
+    
+    async def _run(self, on_payout: Callable[[Dict[int, int]], None]):
+        """Периодическая обработка: пакеты подряд, пока есть новые депозиты"""
+        while True:
+            try:
+                while True:
+                    scanned, credited = await self.run_batch()
+                    if credited:
+                        on_payout(credited)
+                    if scanned < self.batch_size:
+                        break
+            except Exception as e:
+                logger.error(f"Ошибка реферальных выплат: {e}")
+            await asyncio.sleep(self.interval)
+    
+    def start(self, on_payout: Callable[[Dict[int, int]], None]):
+        """Запустить обработку в текущем цикле событий"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run(on_payout))
+    
+    async def close(self):
+        """Остановить обработку"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+    
+    def stats(self) -> Dict[str, Any]:
+        """Статистика выплат"""
+        return {
+            "watermark": self._watermark,
+            "batches_total": self._batches_total,
+            "deposits_total": self._deposits_total,
+            "payouts_total": self._payouts_total,
+            "paid_xtr_total": self._paid_xtr_total,
+            "last_batch_deposits_per_sec": round(self._last_rate, 1),
+        }
+
+referrals = XTRReferralPayouts(
+    db, XTRConfig.REFERRAL_PERCENT, XTRConfig.REFERRAL_BATCH_SIZE, XTRConfig.REFERRAL_INTERVAL
+)
+
+# ============================================================================
+# ОТСЕВ ПОВТОРНЫХ ПЛАТЕЖЕЙ
+# ============================================================================
+
+class XTRChargeRegistry:
+    """
+    Отсев повторных платежей по telegram_charge_id.
+    
+    Последние dedup_window id держатся в памяти: повтор апдейта
+    (ретрай вебхука, перезапуск polling) отсекается без обращения к БД.
+    Id занимается до записи, поэтому одновременный дубль тоже не дойдет
+    до писателя. Окончательная гарантия - уникальный индекс и
+    INSERT ... ON CONFLICT DO NOTHING в process_deposit.
+    """
+    
+    def __init__(self, database: XTRDatabase, window: int):
+        self.db = database
+        self.window = window
+        
+        self._seen: set = set()
+        self._seen_order: deque = deque()
+        
+        # Счетчики для статистики
+        self._memory_hits_total = 0
+        self._db_conflicts_total = 0
+    
+    def _remember(self, charge_id: str):
+        self._seen.add(charge_id)
+        self._seen_order.append(charge_id)
+        if len(self._seen_order) > self.window:
+            self._seen.discard(self._seen_order.popleft())
+    
+    def claim(self, charge_id: str) -> bool:
+        """Занять id перед зачислением (False - уже виден)"""
+        if charge_id in self._seen:
+            self._memory_hits_total += 1
+            return False
+        self._remember(charge_id)
+        return True
+    
+    def release(self, charge_id: str):
+        """Освободить id после неудачного зачисления, чтобы повтор прошел"""
+        self._seen.discard(charge_id)
+        try:
+            self._seen_order.remove(charge_id)
+        except ValueError:
+            pass
+    
+    def conflict(self):
+        """Дубль отсечен уникальным индексом"""
+        self._db_conflicts_total += 1
+    
+    async def load(self):
+        """Прогреть окно последними зачисленными платежами"""
+        rows = await self.db.fetchall(XTRQueries.CHARGES_RECENT, (self.window,))
+        for row in reversed(rows):
+            if row['telegram_charge_id']:
+                self._remember(row['telegram_charge_id'])
+        logger.info(f"Окно платежей прогрето: {len(self._seen)} charge id")
+    
+    def stats(self) -> Dict[str, Any]:
+        """Статистика отсева"""
+        return {
+            "window": len(self._seen),
+            "memory_hits_total": self._memory_hits_total,
+            "db_conflicts_total": self._db_conflicts_total,
+        }
+
+charges = XTRChargeRegistry(db, XTRConfig.CHARGE_DEDUP_WINDOW)
+
+# ============================================================================
+# PAYLOAD ИНВОЙСОВ
+# ============================================================================
+
+class XTRPayloadError(ValueError):
+    """Payload инвойса поддельный, поврежден или истек"""
+
+
+@dataclass(frozen=True)
+class XTRInvoicePayload:
+    """Содержимое payload инвойса"""
+    kind: int  # XTRPayloadCodec.DEPOSIT или XTRPayloadCodec.BUY_STARS
+    user_id: int
+    amount_xtr: int
+    amount_stars: int
+    issued_at: int  # Unix-время выставления
+    nonce: int
+
+
+class XTRPayloadCodec:
+    """
+    Компактный подписанный payload инвойса.
+    
+    Формат v1: версия, тип, user_id, суммы, время выставления и nonce
+    упакованы struct (26 байт) и подписаны усеченным HMAC-SHA256
+    (10 байт); в payload идет base64url без выравнивания - 48 символов,
+    так что он помещается и в лимит Telegram (128 байт), и в
+    callback_data кнопки проверки. Подпись и срок проверяются без БД.
+    
+    user_id = 0 - общий payload ссылки из кэша (зачисляется плательщику),
+    для него действует свой срок shared_ttl.
+    """
+    
+    VERSION = 1
+    DEPOSIT = 1
+    BUY_STARS = 2
+    
+    _BODY = struct.Struct('>BBqIIII')
+    _MAC_SIZE = 10
+    
+    def __init__(self, secret: bytes, ttl: int, shared_ttl: int):
+        self.ttl = ttl
+        self.shared_ttl = shared_ttl
+        self._mac = hmac.new(secret, digestmod=hashlib.sha256)
+    
+    def _sign(self, body: bytes) -> bytes:
+        mac = self._mac.copy()
+        mac.update(body)
+        return mac.digest()[:self._MAC_SIZE]
+    
+    def encode(self, kind: int, user_id: int, amount_xtr: int, amount_stars: int = 0) -> str:
+        """Выпустить payload для нового инвойса"""
+        body = self._BODY.pack(
+            self.VERSION, kind, user_id, amount_xtr, amount_stars,
+            int(time.time()), secrets.randbits(32)
+        )
+        return base64.urlsafe_b64encode(body + self._sign(body)).rstrip(b'=').decode('ascii')
+    
+    def decode(self, payload: str, check_expiry: bool = True) -> XTRInvoicePayload:
+        """Проверить подпись (и срок) и разобрать payload"""
+        try:
+            raw = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))
+        except (ValueError, TypeError):
+            raise XTRPayloadError("malformed payload")
+        
+        if len(raw) != self._BODY.size + self._MAC_SIZE:
+            raise XTRPayloadError("malformed payload")
+        
+        body, signature = raw[:self._BODY.size], raw[self._BODY.size:]
+        if not hmac.compare_digest(signature, self._sign(body)):
+            raise XTRPayloadError("bad signature")
+        
+        version, kind, user_id, amount_xtr, amount_stars, issued_at, nonce = self._BODY.unpack(body)
+        if version != self.VERSION:
+            raise XTRPayloadError(f"unsupported version {version}")
+        
+        ttl = self.shared_ttl if user_id == 0 else self.ttl
+        if check_expiry and time.time() - issued_at > ttl:
+            raise XTRPayloadError("expired")
+        
+        return XTRInvoicePayload(kind, user_id, amount_xtr, amount_stars, issued_at, nonce)
+
+invoice_payloads = XTRPayloadCodec(
+    XTRConfig.invoice_secret(), XTRConfig.PAYMENT_TIMEOUT, XTRConfig.INVOICE_LINK_TTL
+)
+
+# ============================================================================
+# СИСТЕМА XTR ПЛАТЕЖЕЙ
+# ============================================================================
+
+class XTRPurchaseRejected(Exception):
+    """Покупка отклонена условной записью (изменения задания откатываются)"""
+    
+    def __init__(self, message: str, stock: Optional[int] = None):
+        super().__init__(message)
+        self.stock = stock  # Остаток в БД, если известен
+
+
+class XTRDepositResult(Enum):
+    """Итог зачисления платежа"""
+    CREDITED = "credited"    # Зачислен сейчас
+    DUPLICATE = "duplicate"  # Уже зачислен ранее (повтор апдейта)
+    FAILED = "failed"
+
+
+class XTRPaymentSystem:
     """Система обработки Telegram Stars платежей"""
     
     @staticmethod
     async def create_invoice_link(
         bot: Bot,
-        chat_id: int,
         amount_xtr: int,
         description: str,
         payload: str,
         **kwargs
-    ) -> str:
-        """Создать ссылку на оплату"""
+    ) -> Optional[str]:
+        """Создать ссылку на оплату (createInvoiceLink)"""
         try:
             if not XTRConfig.STARS_PROVIDER_TOKEN:
                 raise ValueError("STARS_PROVIDER_TOKEN not configured")
             
             prices = [LabeledPrice(label=description, amount=amount_xtr)]
             
-            result = await bot.send_invoice(
-                chat_id=chat_id,
+            return await bot.create_invoice_link(
                 title="Golden Cobra XTR Payment",
                 description=description,
                 payload=payload,
@@ -448,8 +3037,6 @@ class XTRPaymentSystem:
                 **kwargs
             )
             
-            return result.url if hasattr(result, 'url') else None
-            
         except Exception as e:
             logger.error(f"Ошибка создания инвойса: {e}")
             return None
@@ -459,36 +3046,57 @@ class XTRPaymentSystem:
         user_id: int,
         amount_xtr: int,
         provider_charge_id: str,
-        telegram_charge_id: str
-    ) -> bool:
-        """Обработать депозит XTR"""
+        telegram_charge_id: str,
+        stars_amount: Optional[int] = None
+    ) -> XTRDepositResult:
+        """
+        Обработать депозит XTR (повтор того же платежа не зачисляется).
+        
+        stars_amount - сколько звезд зачислить; None - amount_xtr по текущему курсу.
+        """
+        if telegram_charge_id and not charges.claim(telegram_charge_id):
+            logger.info(f"Повтор платежа отсеян: {telegram_charge_id}")
+            return XTRDepositResult.DUPLICATE
+        
         try:
             # Конвертируем XTR во внутренние звезды
-            exchange_rate = await db.fetchone(
-                "SELECT stars_per_xtr FROM exchange_rates WHERE id = 1"
-            )
-            stars_per_xtr = exchange_rate['stars_per_xtr'] if exchange_rate else 1000
-            
-            stars_amount = amount_xtr * stars_per_xtr
+            if stars_amount is None:
+                stars_amount = amount_xtr * await rates.get()
             
-            # Начинаем транзакцию
-            async with db.get_connection() as conn:
+            # Задание для писателя (групповой коммит)
+            async def job(conn):
+                # Транзакция первой: конфликт по charge id - платеж уже зачислен
+                async with conn.execute('''
+                    INSERT INTO xtr_transactions 
+                    (user_id, amount, type, status, provider_charge_id, telegram_charge_id, description, completed_at)
+                    VALUES (?, ?, 'deposit', 'completed', ?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(telegram_charge_id) WHERE telegram_charge_id IS NOT NULL DO NOTHING
+                    RETURNING id
+                ''', (user_id, amount_xtr, provider_charge_id, telegram_charge_id or None,
+                      f"Deposit {amount_xtr} XTR")) as cursor:
+                    if await cursor.fetchone() is None:
+                        return False
+                
+                # Плательщик мог не делать /start (общая ссылка из кэша):
+                # строка создается, иначе платеж записан, а баланс не начислен
+                async with conn.execute(
+                    "INSERT INTO users (user_id) VALUES (?) ON CONFLICT(user_id) DO NOTHING RETURNING user_id",
+                    (user_id,)
+                ) as cursor:
+                    if await cursor.fetchone() is not None:
+                        await rollups.bump(conn, users=1)
+                
                 # Обновляем баланс пользователя
-                await conn.execute('''
+                cursor = await conn.execute('''
                     UPDATE users 
                     SET balance_xtr = balance_xtr + ?,
                         balance_stars = balance_stars + ?,
                         total_deposited_xtr = total_deposited_xtr + ?
                     WHERE user_id = ?
                 ''', (amount_xtr, stars_amount, amount_xtr, user_id))
-                
-                # Записываем XTR транзакцию
-                await conn.execute('''
-                    INSERT INTO xtr_transactions 
-                    (user_id, amount, type, status, provider_charge_id, telegram_charge_id, description, completed_at)
-                    VALUES (?, ?, 'deposit', 'completed', ?, ?, ?, CURRENT_TIMESTAMP)
-                ''', (user_id, amount_xtr, provider_charge_id, telegram_charge_id, 
-                      f"Deposit {amount_xtr} XTR"))
+                if cursor.rowcount == 0:
+                    # Исключение откатывает задание, charge id освобождается
+                    raise RuntimeError(f"Баланс пользователя {user_id} не обновлен")
                 
                 # Записываем звездную транзакцию
                 await conn.execute('''
@@ -497,66 +3105,87 @@ class XTRPaymentSystem:
                     VALUES (?, ?, 'deposit', ?)
                 ''', (user_id, stars_amount, f"Deposit from {amount_xtr} XTR"))
                 
-                await conn.commit()
+                await rollups.bump(conn, deposits_xtr=amount_xtr, deposits_count=1, balance_xtr=amount_xtr)
+                return True
+            
+            if not await db.write(job):
+                charges.conflict()
+                logger.info(f"Повтор платежа отсеян БД: {telegram_charge_id}")
+                return XTRDepositResult.DUPLICATE
+            
+            leaderboard.add(user_id, deposits=amount_xtr, stars=stars_amount)
             
             logger.info(f"Депозит обработан: user={user_id}, xtr={amount_xtr}")
-            return True
+            return XTRDepositResult.CREDITED
             
         except Exception as e:
             logger.error(f"Ошибка обработки депозита: {e}")
-            return False
+            if telegram_charge_id:
+                charges.release(telegram_charge_id)
+            return XTRDepositResult.FAILED
     
     @staticmethod
     async def process_withdrawal(
         user_id: int,
         amount_xtr: int,
         wallet_address: str
-    ) -> Tuple[bool, str]:
+    ) -> Tuple[bool, str, Optional[int]]:
         """Обработать вывод XTR"""
         try:
-            # Проверяем баланс
-            user = await db.fetchone(
-                "SELECT balance_xtr, is_verified FROM users WHERE user_id = ?",
-                (user_id,)
-            )
-            
-            if not user:
-                return False, "Пользователь не найден"
-            
-            if user['balance_xtr'] < amount_xtr:
-                return False, "Недостаточно XTR на балансе"
-            
             if amount_xtr < XTRConfig.MIN_WITHDRAWAL:
-                return False, f"Минимальная сумма вывода: {XTRConfig.MIN_WITHDRAWAL} XTR"
+                return False, f"Минимальная сумма вывода: {XTRConfig.MIN_WITHDRAWAL} XTR", None
             
             if amount_xtr > XTRConfig.MAX_WITHDRAWAL:
-                return False, f"Максимальная сумма вывода: {XTRConfig.MAX_WITHDRAWAL} XTR"
-            
-            if not user['is_verified'] and amount_xtr > 500:
-                return False, "Требуется верификация для вывода > 500 XTR"
+                return False, f"Максимальная сумма вывода: {XTRConfig.MAX_WITHDRAWAL} XTR", None
             
             # Рассчитываем комиссию
             fee = int(amount_xtr * XTRConfig.WITHDRAWAL_FEE_PERCENT / 100)
             net_amount = amount_xtr - fee
             
-            # Создаем запрос на вывод
-            withdrawal_id = await db.execute('''
-                INSERT INTO withdrawals 
-                (user_id, amount, fee, net_amount, status, wallet_address)
-                VALUES (?, ?, ?, ?, 'pending', ?)
-            ''', (user_id, amount_xtr, fee, net_amount, wallet_address))
-            
-            # Резервируем средства
-            await db.execute(
-                "UPDATE users SET balance_xtr = balance_xtr - ? WHERE user_id = ?",
-                (amount_xtr, user_id)
-            )
+            async def job(conn):
+                # Проверка и списание одним условным UPDATE: между ними нет окна
+                cursor = await conn.execute('''
+                    UPDATE users SET balance_xtr = balance_xtr - ?
+                    WHERE user_id = ?
+                      AND balance_xtr >= ?
+                      AND (is_verified = 1 OR ? <= ?)
+                ''', (amount_xtr, user_id, amount_xtr, amount_xtr, XTRConfig.UNVERIFIED_WITHDRAWAL_LIMIT))
+                
+                if cursor.rowcount == 0:
+                    # Списания не было - выясняем причину
+                    async with conn.execute(
+                        "SELECT balance_xtr, is_verified FROM users WHERE user_id = ?",
+                        (user_id,)
+                    ) as check:
+                        user = await check.fetchone()
+                    
+                    if not user:
+                        return None, "Пользователь не найден"
+                    if user['balance_xtr'] < amount_xtr:
+                        return None, "Недостаточно XTR на балансе"
+                    return None, f"Требуется верификация для вывода > {XTRConfig.UNVERIFIED_WITHDRAWAL_LIMIT} XTR"
+                
+                # Создаем запрос на вывод
+                cursor = await conn.execute('''
+                    INSERT INTO withdrawals 
+                    (user_id, amount, fee, net_amount, status, wallet_address)
+                    VALUES (?, ?, ?, ?, 'pending', ?)
+                ''', (user_id, amount_xtr, fee, net_amount, wallet_address))
+                
+                await rollups.bump(conn, withdrawals_xtr=amount_xtr, withdrawals_count=1, balance_xtr=-amount_xtr)
+                return cursor.lastrowid, None
+            
+            withdrawal_id, error = await db.write(job)
+            
+            if error:
+                return False, error, None
             
-            return True, f"Заявка на вывод создана: {net_amount} XTR (комиссия: {fee} XTR)"
+            logger.info(f"Заявка на вывод #{withdrawal_id}: user={user_id}, xtr={amount_xtr}")
+            return True, f"Заявка на вывод #{withdrawal_id} создана: {net_amount} XTR (комиссия: {fee} XTR)", withdrawal_id
             
         except Exception as e:
             logger.error(f"Ошибка обработки вывода: {e}")
-            return False, f"Ошибка: {str(e)}"
+            return False, f"Ошибка: {str(e)}", None
     
     @staticmethod
     async def process_nft_purchase(
@@ -566,48 +3195,59 @@ class XTRPaymentSystem:
         amount: int
     ) -> Tuple[bool, str, Optional[int]]:
         """Обработать покупку NFT"""
-        try:
-            # Получаем информацию о NFT
-            nft = await db.fetchone(
-                "SELECT * FROM nft_items WHERE id = ? AND available = 1",
-                (nft_id,)
-            )
-            
-            if not nft:
-                return False, "NFT не найден или недоступен", None
-            
-            if payment_type == 'stars':
-                price = nft['price_stars']
-                user_balance_field = 'balance_stars'
-            elif payment_type == 'xtr':
-                price = nft['price_xtr']
-                user_balance_field = 'balance_xtr'
-            else:
-                return False, "Неверный тип оплаты", None
-            
-            if amount < price:
-                return False, f"Недостаточно средств. Цена: {price}", None
-            
-            # Проверяем баланс
-            user = await db.fetchone(
-                f"SELECT {user_balance_field} FROM users WHERE user_id = ?",
-                (user_id,)
-            )
-            
-            if not user or user[user_balance_field] < amount:
-                return False, "Недостаточно средств", None
-            
-            # Проверяем сток
-            if nft['stock'] == 0:
-                return False, "Товар закончился", None
-            
-            # Начинаем транзакцию
-            async with db.get_connection() as conn:
-                # Списание средств
-                await conn.execute(f'''
+        if payment_type == 'stars':
+            price_field = 'price_stars'
+            user_balance_field = 'balance_stars'
+        elif payment_type == 'xtr':
+            price_field = 'price_xtr'
+            user_balance_field = 'balance_xtr'
+        else:
+            return False, "Неверный тип оплаты", None
+        
+        # Проигравшие покупатели отсекаются до писателя
+        if not nft_stock.try_reserve(nft_id):
+            if nft_stock.in_flight(nft_id):
+                # Остаток занят покупками в полете - часть из них может сорваться
+                return False, "Последние экземпляры сейчас оформляются, попробуйте через несколько секунд", None
+            return False, "Товар закончился", None
+        
+        stock_after = None
+        forget_stock = False
+        try:
+            async def job(conn):
+                # Условное списание стока: -1 - без ограничений
+                async with conn.execute(f'''
+                    UPDATE nft_items 
+                    SET stock = CASE WHEN stock > 0 THEN stock - 1 ELSE stock END
+                    WHERE id = ? AND available = 1 AND stock != 0 AND {price_field} <= ?
+                    RETURNING name, stock, {price_field} AS price
+                ''', (nft_id, amount)) as cursor:
+                    nft = await cursor.fetchone()
+                
+                if not nft:
+                    # Списания не было - выясняем причину
+                    async with conn.execute(
+                        f"SELECT stock, {price_field} AS price FROM nft_items WHERE id = ? AND available = 1",
+                        (nft_id,)
+                    ) as cursor:
+                        item = await cursor.fetchone()
+                    
+                    if not item:
+                        raise XTRPurchaseRejected("NFT не найден или недоступен")
+                    if item['stock'] == 0:
+                        raise XTRPurchaseRejected("Товар закончился", stock=0)
+                    raise XTRPurchaseRejected(f"Недостаточно средств. Цена: {item['price']}", stock=item['stock'])
+                
+                # Условное списание средств по цене из БД
+                cursor = await conn.execute(f'''
                     UPDATE users SET {user_balance_field} = {user_balance_field} - ? 
-                    WHERE user_id = ?
-                ''', (amount, user_id))
+                    WHERE user_id = ? AND {user_balance_field} >= ?
+                ''', (nft['price'], user_id, nft['price']))
+                
+                if cursor.rowcount == 0:
+                    # Исключение откатывает и списание стока
+                    restored = nft['stock'] + 1 if nft['stock'] >= 0 else nft['stock']
+                    raise XTRPurchaseRejected("Недостаточно средств", stock=restored)
                 
                 # Запись транзакции
                 if payment_type == 'stars':
@@ -615,41 +3255,1166 @@ class XTRPaymentSystem:
                         INSERT INTO star_transactions 
                         (user_id, amount, type, description)
                         VALUES (?, ?, 'purchase', ?)
-                    ''', (user_id, -amount, f"Покупка NFT: {nft['name']}"))
+                    ''', (user_id, -nft['price'], f"Покупка NFT: {nft['name']}"))
                 else:
                     await conn.execute('''
                         INSERT INTO xtr_transactions 
                         (user_id, amount, type, status, description, completed_at)
                         VALUES (?, ?, 'purchase', 'completed', ?, CURRENT_TIMESTAMP)
-                    ''', (user_id, -amount, f"Покупка NFT: {nft['name']}"))
+                    ''', (user_id, -nft['price'], f"Покупка NFT: {nft['name']}"))
                 
                 # Создание владения NFT
-                await conn.execute('''
+                async with conn.execute('''
                     INSERT INTO nft_ownership 
                     (user_id, nft_id, purchase_price, purchase_type)
                     VALUES (?, ?, ?, ?)
-                ''', (user_id, nft_id, amount, payment_type))
-                
-                # Обновление стока
-                if nft['stock'] > 0:
-                    await conn.execute(
-                        "UPDATE nft_items SET stock = stock - 1 WHERE id = ?",
-                        (nft_id,)
-                    )
+                    RETURNING id
+                ''', (user_id, nft_id, nft['price'], payment_type)) as cursor:
+                    ownership = await cursor.fetchone()
                 
-                await conn.commit()
+                await rollups.bump(
+                    conn,
+                    nft_sales=1,
+                    balance_xtr=-nft['price'] if payment_type == 'xtr' else 0
+                )
+                return ownership['id'], nft['name'], nft['stock'], nft['price']
             
-            # Получаем ID владения
-            ownership = await db.fetchone(
-                "SELECT id FROM nft_ownership WHERE user_id = ? AND nft_id = ? ORDER BY id DESC LIMIT 1",
-                (user_id, nft_id)
-            )
+            ownership_id, name, stock_after, price = await db.write(job)
+            leaderboard.add(user_id, nfts=1, stars=-price if payment_type == 'stars' else 0)
             
-            return True, f"NFT '{nft['name']}' успешно куплен!", ownership['id'] if ownership else None
+            return True, f"NFT '{name}' успешно куплен!", ownership_id
             
+        except XTRPurchaseRejected as e:
+            stock_after = e.stock
+            return False, str(e), None
+        except sqlite3.IntegrityError:
+            # UNIQUE(user_id, nft_id)
+            return False, "Этот NFT уже есть в вашей коллекции", None
         except Exception as e:
             logger.error(f"Ошибка покупки NFT: {e}")
+            forget_stock = True
             return False, f"Ошибка: {str(e)}", None
+        finally:
+            nft_stock.release(nft_id, stock_after, forget=forget_stock)
+
+# ============================================================================
+# ИНВОЙСЫ
+# ============================================================================
+
+@dataclass
+class XTRPendingInvoice:
+    """Строка pending_invoices"""
+    user_id: int
+    amount_xtr: int
+    state: str
+    attempts: int
+    expires_at: float
+
+
+class XTRInvoiceTracker:
+    """
+    Машина состояний выставленных инвойсов (pending_invoices).
+    
+    pending -> pre_checked -> paid; открытый инвойс (pending или
+    pre_checked) истекает по expires_at или уходит в failed после
+    MAX_PAYMENT_ATTEMPTS подтверждений без оплаты. paid допустим из
+    любого состояния: деньги уже списаны. Открытые инвойсы держатся в
+    памяти, поэтому кнопка проверки отвечает без запроса к БД. Очистка
+    истекает их одним UPDATE по частичному индексу и удаляет закрытые
+    старше retention секунд.
+    """
+    
+    OPEN = ('pending', 'pre_checked')
+    TRANSITIONS = {
+        'pending': {'pre_checked', 'paid', 'expired', 'failed'},
+        'pre_checked': {'pre_checked', 'paid', 'expired', 'failed'},
+        'expired': {'paid'},
+        'failed': {'paid'},
+        'paid': set(),
+    }
+    
+    def __init__(self, database: XTRDatabase, timeout: int, max_attempts: int,
+                 retention: int, sweep_interval: float):
+        self.db = database
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.sweep_interval = sweep_interval
+        
+        self._invoices: Dict[str, XTRPendingInvoice] = {}
+        self._task: Optional[asyncio.Task] = None
+        
+        # Счетчики для статистики
+        self._registered_total = 0
+        self._paid_total = 0
+        self._expired_total = 0
+        self._failed_total = 0
+        self._purged_total = 0
+    
+    @staticmethod
+    def key(payload: str, user_id: int) -> str:
+        """Ключ инвойса: payload, для общей ссылки из кэша - с плательщиком"""
+        decoded = invoice_payloads.decode(payload, check_expiry=False)
+        return payload if decoded.user_id else f"{payload}:{user_id}"
+    
+    async def register(self, key: str, user_id: int, amount_xtr: int):
+        """Новый инвойс в состоянии pending"""
+        now = time.time()
+        invoice = XTRPendingInvoice(user_id, amount_xtr, 'pending', 0, now + self.timeout)
+        
+        async def job(conn):
+            # Повторный клик по общей ссылке начинает новый цикл того же ключа
+            await conn.execute('''
+                INSERT INTO pending_invoices (key, user_id, amount_xtr, state, created_at, expires_at, updated_at)
+                VALUES (?, ?, ?, 'pending', ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    state = 'pending', attempts = 0, charge_id = NULL,
+                    expires_at = excluded.expires_at, updated_at = excluded.updated_at
+            ''', (key, user_id, amount_xtr, now, invoice.expires_at, now))
+        
+        await self.db.write(job)
+        self._invoices[key] = invoice
+        self._registered_total += 1
+    
+    async def get(self, key: str) -> Optional[XTRPendingInvoice]:
+        """Инвойс из памяти, при промахе - по первичному ключу"""
+        invoice = self._invoices.get(key)
+        if invoice is not None:
+            return invoice
+        
+        row = await self.db.fetchone(XTRQueries.INVOICE_BY_KEY, (key,))
+        if not row:
+            return None
+        invoice = XTRPendingInvoice(row['user_id'], row['amount_xtr'], row['state'], row['attempts'], row['expires_at'])
+        self._invoices[key] = invoice
+        return invoice
+    
+    async def _transition(self, key: str, invoice: XTRPendingInvoice, state: str, charge_id: Optional[str] = None):
+        """Перевести инвойс в новое состояние (память и БД)"""
+        if state not in self.TRANSITIONS[invoice.state]:
+            raise ValueError(f"invalid invoice transition {invoice.state} -> {state}")
+        
+        attempts = invoice.attempts + 1 if state == 'pre_checked' else invoice.attempts
+        
+        async def job(conn):
+            await conn.execute('''
+                UPDATE pending_invoices
+                SET state = ?, attempts = ?, charge_id = COALESCE(?, charge_id), updated_at = ?
+                WHERE key = ?
+            ''', (state, attempts, charge_id, time.time(), key))
+        
+        await self.db.write(job)
+        invoice.state = state
+        invoice.attempts = attempts
+    
+    async def pre_checkout(self, key: str, user_id: int, amount_xtr: int) -> Optional[str]:
+        """Подтверждение перед оплатой: None - можно платить, иначе причина отказа"""
+        invoice = await self.get(key)
+        shared = ':' in key
+        if invoice is None or (shared and (invoice.state in ('paid', 'expired') or invoice.expires_at < time.time())):
+            # Новый цикл: инвойс до появления учета или оплата по общей ссылке без клика
+            await self.register(key, user_id, amount_xtr)
+            invoice = self._invoices[key]
+        
+        if invoice.state == 'paid':
+            return "Этот счет уже оплачен"
+        if invoice.state == 'expired' or invoice.expires_at < time.time():
+            return "Счет устарел. Создайте новый: /deposit"
+        if invoice.state == 'failed':
+            return "Превышено число попыток оплаты. Создайте новый счет: /deposit"
+        if invoice.attempts >= self.max_attempts:
+            await self._transition(key, invoice, 'failed')
+            self._failed_total += 1
+            return "Превышено число попыток оплаты. Создайте новый счет: /deposit"
+        
+        await self._transition(key, invoice, 'pre_checked')
+        return None
+    
+    async def mark_paid(self, key: str, user_id: int, amount_xtr: int, charge_id: str):
+        """Платеж зачислен"""
+        invoice = await self.get(key)
+        if invoice is None:
+            await self.register(key, user_id, amount_xtr)
+            invoice = self._invoices[key]
+        if invoice.state != 'paid':
+            await self._transition(key, invoice, 'paid', charge_id)
+            self._paid_total += 1
+    
+    async def sweep(self) -> Tuple[int, int]:
+        """Истечь открытые инвойсы и удалить старые закрытые: (истекло, удалено)"""
+        now = time.time()
+        
+        async def job(conn):
+            async with conn.execute(XTRQueries.INVOICES_EXPIRE, (now, now)) as cursor:
+                expired = [row['key'] for row in await cursor.fetchall()]
+            cursor = await conn.execute(XTRQueries.INVOICES_PURGE, (now - self.retention,))
+            return expired, cursor.rowcount
+        
+        expired, purged = await self.db.write(job)
+        
+        for key in expired:
+            invoice = self._invoices.get(key)
+            if invoice is not None:
+                invoice.state = 'expired'
+        
+        # В памяти остаются открытые инвойсы и недавно закрытые (для кнопки проверки)
+        horizon = now - self.timeout
+        for key in [key for key, invoice in self._invoices.items()
+                    if invoice.state not in self.OPEN and invoice.expires_at < horizon]:
+            del self._invoices[key]
+        
+        self._expired_total += len(expired)
+        self._purged_total += purged
+        return len(expired), purged
+    
+    async def load(self):
+        """Загрузить открытые инвойсы"""
+        rows = await self.db.fetchall(XTRQueries.INVOICES_LOAD)
+        self._invoices = {
+            row['key']: XTRPendingInvoice(row['user_id'], row['amount_xtr'], row['state'], row['attempts'], row['expires_at'])
+            for row in rows
+        }
+        logger.info(f"Открытых инвойсов: {len(self._invoices)}")
+    
+    async def _run(self):
+        """Периодическая очистка"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                expired, purged = await self.sweep()
+                if expired or purged:
+                    logger.info(f"Инвойсы: истекло {expired}, удалено {purged}")
+            except Exception as e:
+                logger.error(f"Ошибка очистки инвойсов: {e}")
+    
+    def start(self):
+        """Запустить очистку в текущем цикле событий"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+    
+    async def close(self):
+        """Остановить очистку"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+    
+    def stats(self) -> Dict[str, Any]:
+        """Статистика инвойсов"""
+        return {
+            "tracked": len(self._invoices),
+            "open": sum(1 for invoice in self._invoices.values() if invoice.state in self.OPEN),
+            "registered_total": self._registered_total,
+            "paid_total": self._paid_total,
+            "expired_total": self._expired_total,
+            "failed_total": self._failed_total,
+            "purged_total": self._purged_total,
+        }
+
+invoices = XTRInvoiceTracker(
+    db,
+    timeout=XTRConfig.PAYMENT_TIMEOUT,
+    max_attempts=XTRConfig.MAX_PAYMENT_ATTEMPTS,
+    retention=XTRConfig.INVOICE_RETENTION,
+    sweep_interval=XTRConfig.INVOICE_SWEEP_INTERVAL
+)
+
+
+class XTRInvoiceLinkCache:
+    """
+    Готовые ссылки на оплату для фиксированных сумм пополнения.
+    
+    Ссылки createInvoiceLink для сумм из DEPOSIT_PRESETS выпускаются
+    при старте и перевыпускаются каждые ttl / 2 секунд. Payload у них
+    общий (user_id = 0, зачисляется плательщику) и живет ttl секунд,
+    поэтому выданная ссылка действует еще минимум ttl / 2. Клик по
+    фиксированной сумме не обращается к Bot API; отдельные ссылки
+    создаются только для произвольных сумм.
+    """
+    
+    def __init__(self, bot: Bot, presets: Tuple[int, ...], ttl: int):
+        self.bot = bot
+        self.presets = presets
+        self.ttl = ttl
+        
+        self._links: Dict[int, Tuple[str, str]] = {}  # сумма -> (ссылка, payload)
+        self._task: Optional[asyncio.Task] = None
+        
+        # Счетчики для статистики
+        self._hits_total = 0
+        self._misses_total = 0
+        self._api_calls_total = 0
+    
+    @staticmethod
+    def description(amount: int) -> str:
+        return f"Пополнение баланса на {amount} XTR"
+    
+    async def create(self, amount: int, payload: str, description: Optional[str] = None) -> Optional[str]:
+        """Выпустить ссылку через Bot API"""
+        self._api_calls_total += 1
+        return await XTRPaymentSystem.create_invoice_link(
+            self.bot, amount, description or self.description(amount), payload
+        )
+    
+    async def refresh(self):
+        """Перевыпустить ссылки фиксированных сумм"""
+        for amount in self.presets:
+            payload = invoice_payloads.encode(XTRPayloadCodec.DEPOSIT, 0, amount)
+            url = await self.create(amount, payload)
+            if url:
+                self._links[amount] = (url, payload)
+            else:
+                # Старая ссылка еще действует, но к следующему обновлению истечет
+                self._links.pop(amount, None)
+        logger.info(f"Ссылки на оплату обновлены: {len(self._links)}/{len(self.presets)}")
+    
+    async def get(self, user_id: int, amount: int) -> Tuple[Optional[str], Optional[str]]:
+        """(ссылка, payload): из кэша для фиксированной суммы, иначе новая"""
+        cached = self._links.get(amount)
+        if cached:
+            self._hits_total += 1
+            return cached
+        
+        self._misses_total += 1
+        payload = invoice_payloads.encode(XTRPayloadCodec.DEPOSIT, user_id, amount)
+        return await self.create(amount, payload), payload
+    
+    async def _run(self):
+        """Периодический перевыпуск"""
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Ошибка обновления ссылок на оплату: {e}")
+            await asyncio.sleep(self.ttl / 2)
+    
+    def start(self):
+        """Запустить перевыпуск в текущем цикле событий"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+    
+    async def close(self):
+        """Остановить перевыпуск"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+    
+    def stats(self) -> Dict[str, Any]:
+        """Статистика кэша"""
+        return {
+            "cached": len(self._links),
+            "hits_total": self._hits_total,
+            "misses_total": self._misses_total,
+            "api_calls_total": self._api_calls_total,
+        }
+
+# ============================================================================
+# КОНТЕКСТ ПОЛЬЗОВАТЕЛЯ
+# ============================================================================
+
+@dataclass
+class XTRUser:
+    """Строка users"""
+    user_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    balance_stars: int
+    balance_xtr: int
+    total_deposited_xtr: int
+    total_withdrawn_xtr: int
+    referrals: int
+    referral_id: Optional[int]
+    is_verified: bool
+    is_banned: bool
+    
+    @classmethod
+    def from_row(cls, row) -> 'XTRUser':
+        """Собрать из строки БД"""
+        return cls(
+            user_id=row['user_id'],
+            username=row['username'],
+            first_name=row['first_name'],
+            balance_stars=row['balance_stars'] or 0,
+            balance_xtr=row['balance_xtr'] or 0,
+            total_deposited_xtr=row['total_deposited_xtr'] or 0,
+            total_withdrawn_xtr=row['total_withdrawn_xtr'] or 0,
+            referrals=row['referrals'] or 0,
+            referral_id=row['referral_id'],
+            is_verified=bool(row['is_verified']),
+            is_banned=bool(row['is_banned']),
+        )
+
+
+class XTRUserContext:
+    """
+    Пользователь на время одного апдейта.
+    
+    Строка читается при первом обращении и переиспользуется всеми
+    обработчиками апдейта. После записи в users обработчик вызывает
+    invalidate(), и следующий get() перечитывает строку.
+    """
+    
+    # Счетчик чтений users через контекст (для статистики)
+    loads_total = 0
+    
+    def __init__(self, user_id: Optional[int]):
+        self.user_id = user_id
+        self._user: Optional[XTRUser] = None
+        self._loaded = False
+    
+    async def get(self) -> Optional[XTRUser]:
+        """Пользователь из БД (None - не зарегистрирован)"""
+        if not self._loaded:
+            row = None
+            if self.user_id is not None:
+                row = await db.fetchone(XTRQueries.USER_BY_ID, (self.user_id,))
+                XTRUserContext.loads_total += 1
+            self._user = XTRUser.from_row(row) if row else None
+            self._loaded = True
+        return self._user
+    
+    def invalidate(self):
+        """Апдейт изменил users - перечитать при следующем get()"""
+        self._loaded = False
+
+
+class XTRActivityTracker:
+    """
+    Отложенная запись users.last_active.
+    
+    touch() только запоминает время последнего апдейта пользователя в
+    словаре; раз в flush_interval секунд накопленное уходит в БД одним
+    executemany UPDATE. Повторные апдейты одного пользователя между
+    сбросами ничего не стоят, last_active отстает не больше чем на
+    flush_interval.
+    """
+    
+    def __init__(self, database: XTRDatabase, flush_interval: float):
+        self.db = database
+        self.flush_interval = flush_interval
+        
+        self._pending: Dict[int, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        
+        # Счетчики для статистики
+        self._touches_total = 0
+        self._flushes_total = 0
+        self._written_total = 0
+        self._errors_total = 0
+    
+    def touch(self, user_id: int):
+        """Пользователь активен сейчас"""
+        self._pending[user_id] = int(time.time())
+        self._touches_total += 1
+    
+    async def flush(self) -> int:
+        """Записать накопленную активность; возвращает число пользователей"""
+        if not self._pending:
+            return 0
+        
+        pending, self._pending = self._pending, {}
+        rows = [(touched_at, user_id) for user_id, touched_at in pending.items()]
+        
+        async def job(conn):
+            await conn.executemany(
+                "UPDATE users SET last_active = datetime(?, 'unixepoch') WHERE user_id = ?",
+                rows
+            )
+        
+        try:
+            await self.db.write(job)
+        except Exception:
+            # Возвращаем в очередь, не затирая более свежие касания
+            for user_id, touched_at in pending.items():
+                self._pending.setdefault(user_id, touched_at)
+            self._errors_total += 1
+            raise
+        
+        self._flushes_total += 1
+        self._written_total += len(rows)
+        return len(rows)
+    
+    async def _run(self):
+        """Периодический сброс"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи активности: {e}")
+    
+    def start(self):
+        """Запустить сброс в текущем цикле событий"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+    
+    async def close(self):
+        """Остановить сброс и записать остаток"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Ошибка записи активности при остановке: {e}")
+    
+    def stats(self) -> Dict[str, Any]:
+        """Статистика активности"""
+        return {
+            "pending": len(self._pending),
+            "touches_total": self._touches_total,
+            "flushes_total": self._flushes_total,
+            "written_total": self._written_total,
+            "errors_total": self._errors_total,
+        }
+
+activity = XTRActivityTracker(db, XTRConfig.ACTIVITY_FLUSH_INTERVAL)
+
+
+class XTRProfileCache:
+    """
+    Отпечатки профилей (username, first_name) зарегистрированных пользователей.
+    
+    Повторный /start с тем же профилем не идет ни в БД, ни в писатель.
+    LRU на size записей; промах лишь означает сверку со строкой users.
+    """
+    
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self._cache: 'OrderedDict[int, int]' = OrderedDict()
+        
+        # Счетчики для статистики
+        self._hits = 0
+        self._misses = 0
+    
+    @staticmethod
+    def fingerprint(username: Optional[str], first_name: Optional[str]) -> int:
+        """Отпечаток профиля (в пределах процесса)"""
+        return hash((username, first_name))
+    
+    def unchanged(self, user_id: int, fingerprint: int) -> bool:
+        """Профиль уже записан в users"""
+        if self._cache.get(user_id) == fingerprint:
+            self._cache.move_to_end(user_id)
+            self._hits += 1
+            return True
+        self._misses += 1
+        return False
+    
+    def remember(self, user_id: int, fingerprint: int):
+        """Профиль совпадает с users"""
+        self._cache[user_id] = fingerprint
+        self._cache.move_to_end(user_id)
+        if len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Статистика кэша профилей"""
+        return {
+            "size": len(self._cache),
+            "hits": self._hits,
+            "misses": self._misses,
+        }
+
+profiles = XTRProfileCache(XTRConfig.PROFILE_CACHE_SIZE)
+
+
+class XTRUserMiddleware(BaseMiddleware):
+    """Outer middleware: кладет XTRUserContext в data['user_ctx'] и отмечает активность"""
+    
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        if 'user_ctx' not in data:
+            from_user = data.get('event_from_user')
+            data['user_ctx'] = XTRUserContext(from_user.id if from_user else None)
+            if from_user:
+                activity.touch(from_user.id)
+        return await handler(event, data)
+
+# ============================================================================
+# ПРИЕМ АПДЕЙТОВ ЧЕРЕЗ WEBHOOK
+# ============================================================================
+
+class XTRUpdateIngestor:
+    """
+    Очередь апдейтов webhook с пулом обработчиков.
+    
+    Апдейты распределяются по очередям обработчиков по user_id, поэтому
+    апдейты одного пользователя обрабатываются строго по порядку.
+    Повторные update_id отбрасываются. Очереди ограничены: при
+    переполнении submit() возвращает False, и Telegram повторит доставку.
+    """
+    
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, workers: int, queue_size: int, dedup_window: int):
+        self.dp = dispatcher
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.queue_size = max(self.workers, queue_size)
+        
+        shard_size = self.queue_size // self.workers
+        self._queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=shard_size) for _ in range(self.workers)]
+        self._tasks: List[asyncio.Task] = []
+        
+        # Окно последних update_id для отсева повторов
+        self._seen: set = set()
+        self._seen_order: deque = deque()
+        self.dedup_window = dedup_window
+        
+        # Счетчики для статистики
+        self._accepted_total = 0
+        self._duplicates_total = 0
+        self._rejected_total = 0
+        self._processed_total = 0
+        self._failed_total = 0
+        self._queue_wait_total = 0.0
+        self._handle_time_total = 0.0
+    
+    @staticmethod
+    def _shard_key(update: Update) -> int:
+        """Ключ очереди: пользователь, иначе чат, иначе сам апдейт"""
+        try:
+            event = update.event
+        except Exception:
+            # Тип апдейта неизвестен этой версии aiogram
+            return update.update_id
+        
+        from_user = getattr(event, 'from_user', None)
+        if from_user:
+            return from_user.id
+        chat = getattr(event, 'chat', None)
+        if chat:
+            return chat.id
+        return update.update_id
+    
+    def _remember(self, update_id: int):
+        """Запомнить update_id в окне повторов"""
+        self._seen.add(update_id)
+        self._seen_order.append(update_id)
+        if len(self._seen_order) > self.dedup_window:
+            self._seen.discard(self._seen_order.popleft())
+    
+    def submit(self, update: Update) -> bool:
+        """Поставить апдейт в очередь; False - очередь переполнена"""
+        if update.update_id in self._seen:
+            self._duplicates_total += 1
+            return True
+        
+        queue = self._queues[self._shard_key(update) % self.workers]
+        try:
+            queue.put_nowait((update, time.perf_counter()))
+        except asyncio.QueueFull:
+            self._rejected_total += 1
+            return False
+        
+        self._remember(update.update_id)
+        self._accepted_total += 1
+        return True
+    
+    async def _worker(self, queue: asyncio.Queue):
+        """Обработчик одной очереди"""
+        while True:
+            update, enqueued_at = await queue.get()
+            started = time.perf_counter()
+            self._queue_wait_total += started - enqueued_at
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                self._failed_total += 1
+                logger.error(f"Ошибка обработки апдейта {update.update_id}: {e}")
+            finally:
+                self._processed_total += 1
+                self._handle_time_total += time.perf_counter() - started
+                queue.task_done()
+    
+    async def run(self):
+        """Запустить обработчики и ждать их завершения"""
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+        try:
+            await asyncio.gather(*self._tasks)
+        finally:
+            for task in self._tasks:
+                task.cancel()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Статистика приема (backpressure)"""
+        depths = [queue.qsize() for queue in self._queues]
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "queue_depth": sum(depths),
+            "max_shard_depth": max(depths),
+            "accepted_total": self._accepted_total,
+            "duplicates_total": self._duplicates_total,
+            "rejected_total": self._rejected_total,
+            "processed_total": self._processed_total,
+            "failed_total": self._failed_total,
+            "avg_queue_wait_ms": round(self._queue_wait_total / self._processed_total * 1000, 3)
+            if self._processed_total else 0.0,
+            "avg_handle_ms": round(self._handle_time_total / self._processed_total * 1000, 3)
+            if self._processed_total else 0.0,
+        }
+
+# ============================================================================
+# ИСХОДЯЩИЕ СООБЩЕНИЯ
+# ============================================================================
+
+class XTRTokenBucket:
+    """Token bucket с резервированием: токены могут уходить в минус"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+    
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def reserve(self) -> float:
+        """Занять токен; вернуть, сколько секунд ждать до его появления"""
+        self._refill(time.monotonic())
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+    
+    def wait_time(self) -> float:
+        """Через сколько секунд появится токен (без резервирования)"""
+        self._refill(time.monotonic())
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+    
+    def is_idle(self) -> bool:
+        """Корзина полна - состояние можно забыть"""
+        self._refill(time.monotonic())
+        return self._tokens >= self.capacity
+    
+    async def acquire(self):
+        """Дождаться токена"""
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+@dataclass
+class XTROutgoing:
+    """Сообщение в очереди чата"""
+    text: str
+    kwargs: Dict[str, Any]
+    not_before: float = 0.0  # monotonic: RetryAfter или пауза перед повтором
+    attempts: int = 0  # Повторы после сетевых ошибок
+    retry_afters: int = 0  # Повторы после RetryAfter
+
+
+class XTROutbox:
+    """
+    Очередь исходящих сообщений Telegram.
+    
+    send() ставит сообщение в очередь чата и сразу возвращает управление.
+    Воркеры берут из общей очереди готовый чат и отправляют одно его
+    сообщение. Чат, которому надо ждать (лимит чата, RetryAfter, пауза
+    перед повтором), возвращается в очередь по таймеру и воркера не
+    занимает, поэтому ожидание одного чата не задерживает остальные.
+    Чат стоит в очереди не больше одного раза - сообщения одного чата
+    доставляются по порядку. RetryAfter и сетевые ошибки повторяются не
+    больше max_retries раз каждые.
+    """
+    
+    # Лимиты Bot API: ~30 сообщений/сек всего, 1/сек в личный чат, 20/мин в группу
+    GLOBAL_RATE = 30
+    PRIVATE_CHAT_RATE = 1
+    GROUP_CHAT_RATE = 20 / 60
+    MAX_CHAT_BUCKETS = 10000
+    
+    def __init__(self, bot: Bot, workers: int, queue_size: int, max_retries: int):
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.max_retries = max_retries
+        
+        # Чат есть в _chats, пока у него есть сообщения: он либо в _ready,
+        # либо ждет таймера, либо его обрабатывает воркер
+        self._chats: Dict[int, deque] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._pending = 0
+        self._delayed = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks: List[asyncio.Task] = []
+        
+        self._global_bucket = XTRTokenBucket(self.GLOBAL_RATE, self.GLOBAL_RATE)
+        self._chat_buckets: Dict[int, XTRTokenBucket] = {}
+        
+        # Счетчики для статистики
+        self._queued_total = 0
+        self._sent_total = 0
+        self._dropped_total = 0
+        self._failed_total = 0
+        self._retries_total = 0
+        self._retry_after_total = 0
+        self._send_time_total = 0.0
+    
+    def _ensure_started(self):
+        """Запустить доставку в текущем цикле событий"""
+        if self._tasks and not any(task.done() for task in self._tasks):
+            return
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+    
+    def send(self, chat_id: int, text: str, **kwargs) -> bool:
+        """Поставить сообщение в очередь; False - очередь переполнена"""
+        self._ensure_started()
+        if self._pending >= self.queue_size:
+            self._dropped_total += 1
+            logger.error(f"Очередь исходящих переполнена, сообщение в {chat_id} отброшено")
+            return False
+        
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            queue = self._chats[chat_id] = deque()
+            self._ready.put_nowait(chat_id)
+        queue.append(XTROutgoing(text, kwargs))
+        
+        self._pending += 1
+        self._idle.clear()
+        self._queued_total += 1
+        return True
+    
+    def _chat_bucket(self, chat_id: int) -> XTRTokenBucket:
+        """Корзина чата (группы - отрицательные chat_id)"""
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                # Полные корзины ничем не отличаются от новых
+                for idle_id in [cid for cid, b in self._chat_buckets.items() if b.is_idle()]:
+                    del self._chat_buckets[idle_id]
+            rate = self.GROUP_CHAT_RATE if chat_id < 0 else self.PRIVATE_CHAT_RATE
+            bucket = self._chat_buckets[chat_id] = XTRTokenBucket(rate, 1)
+        return bucket
+    
+    def _wake(self, chat_id: int):
+        """Таймер ожидания чата истек"""
+        self._delayed -= 1
+        self._ready.put_nowait(chat_id)
+    
+    def _schedule(self, chat_id: int, delay: float):
+        """Вернуть чат в очередь готовых сейчас или через delay секунд"""
+        if delay > 0:
+            self._delayed += 1
+            asyncio.get_running_loop().call_later(delay, self._wake, chat_id)
+        else:
+            self._ready.put_nowait(chat_id)
+    
+    def _finish(self, chat_id: int, queue: deque):
+        """Снять головное сообщение чата (доставлено или брошено)"""
+        queue.popleft()
+        self._pending -= 1
+        if not self._pending:
+            self._idle.set()
+    
+    async def _deliver(self, chat_id: int, queue: deque):
+        """Одна попытка отправить головное сообщение чата"""
+        message = queue[0]
+        started = time.perf_counter()
+        try:
+            await self.bot.send_message(chat_id, message.text, **message.kwargs)
+            self._sent_total += 1
+            self._send_time_total += time.perf_counter() - started
+            self._finish(chat_id, queue)
+        except TelegramRetryAfter as e:
+            # Флуд-контроль Telegram: чат ждет столько, сколько сказано
+            self._retry_after_total += 1
+            message.retry_afters += 1
+            if message.retry_afters > self.max_retries:
+                raise
+            message.not_before = time.monotonic() + e.retry_after
+        except (TelegramNetworkError, TelegramServerError):
+            message.attempts += 1
+            if message.attempts > self.max_retries:
+                raise
+            self._retries_total += 1
+            message.not_before = time.monotonic() + min(30, 2 ** message.attempts) * random.uniform(0.5, 1.5)
+    
+    async def _worker(self):
+        """Доставка: по одному сообщению готового чата за раз"""
+        while True:
+            chat_id = await self._ready.get()
+            queue = self._chats[chat_id]
+            
+            # Ждет чат, а не воркер
+            bucket = self._chat_bucket(chat_id)
+            wait = max(bucket.wait_time(), queue[0].not_before - time.monotonic())
+            if wait > 0:
+                self._schedule(chat_id, wait)
+                continue
+            
+            bucket.reserve()
+            await self._global_bucket.acquire()
+            try:
+                await self._deliver(chat_id, queue)
+            except Exception as e:
+                self._failed_total += 1
+                logger.warning(f"Сообщение в {chat_id} не доставлено: {e}")
+                self._finish(chat_id, queue)
+            
+            if queue:
+                self._schedule(chat_id, queue[0].not_before - time.monotonic())
+            else:
+                del self._chats[chat_id]
+    
+    async def close(self, timeout: float = 10):
+        """Дослать очередь (не дольше timeout) и остановить доставку"""
+        if self._tasks:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Не все исходящие сообщения доставлены до остановки")
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+    
+    def stats(self) -> Dict[str, Any]:
+        """Статистика исходящих"""
+        return {
+            "queue_depth": self._pending,
+            "chats_pending": len(self._chats),
+            "chats_waiting": self._delayed,
+            "queued_total": self._queued_total,
+            "sent_total": self._sent_total,
+            "dropped_total": self._dropped_total,
+            "failed_total": self._failed_total,
+            "retries_total": self._retries_total,
+            "retry_after_total": self._retry_after_total,
+            "chat_buckets": len(self._chat_buckets),
+            "avg_send_ms": round(self._send_time_total / self._sent_total * 1000, 3)
+            if self._sent_total else 0.0,
+        }
+
+# ============================================================================
+# ХРАНИЛИЩЕ FSM
+# ============================================================================
+
+@dataclass
+class XTRFSMRecord:
+    """Состояние и данные FSM одного ключа"""
+    state: Optional[str]
+    data: Dict[str, Any]
+    expires_at: float
+    checked_at: float = 0.0  # time.monotonic() последнего чтения из БД или локальной записи
+
+
+class XTRFSMStorage(BaseStorage):
+    """
+    FSM-хранилище в таблице fsm_states.
+    
+    Перед таблицей стоит LRU-кэш: изменения пишутся в кэш сразу и
+    сбрасываются в SQLite пачкой раз в flush_interval (последнее значение
+    ключа побеждает). Брошенные состояния истекают через ttl и удаляются
+    одним DELETE по индексу expires_at. Отсутствие записи тоже кэшируется.
+    
+    Несколько процессов на одной БД: запись из кэша отдается без запроса
+    только revalidate секунд после чтения из БД или локальной записи, затем
+    перечитывается по первичному ключу. Несброшенные локальные изменения
+    всегда свежее БД и не перечитываются. Изменение, сделанное другим
+    процессом, видно не позже чем через flush_interval + revalidate.
+    """
+    
+    def __init__(self, database: XTRDatabase, cache_size: int, ttl: float, flush_interval: float,
+                 revalidate: float):
+        self.db = database
+        self.cache_size = max(1, cache_size)
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.revalidate = revalidate
+        
+        self._cache: 'OrderedDict[str, XTRFSMRecord]' = OrderedDict()
+        self._dirty: Dict[str, XTRFSMRecord] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._last_sweep = 0.0
+        
+        # Счетчики для статистики
+        self._hits_total = 0
+        self._misses_total = 0
+        self._revalidated_total = 0
+        self._absent_total = 0
+        self._flushed_total = 0
+        self._expired_total = 0
+    
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        """Строковый ключ строки fsm_states"""
+        return (
+            f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:"
+            f"{key.business_connection_id or ''}:{key.destiny}"
+        )
+    
+    def _ensure_started(self):
+        """Запустить сброс в текущем цикле событий"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+    
+    def _remember(self, key: str, record: XTRFSMRecord):
+        """Положить запись в LRU"""
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            # Несброшенная запись остается в _dirty до ближайшего сброса
+            self._cache.popitem(last=False)
+    
+    async def _load(self, key: str) -> Optional[XTRFSMRecord]:
+        """Запись из очереди на сброс, кэша или БД (None - нет или истекла)"""
+        record = self._dirty.get(key)
+        if record is not None:
+            self._hits_total += 1
+        else:
+            record = self._cache.get(key)
+            if record is None:
+                self._misses_total += 1
+            elif time.monotonic() - record.checked_at > self.revalidate:
+                # Ключ мог изменить другой процесс
+                self._revalidated_total += 1
+                record = None
+            else:
+                self._hits_total += 1
+                self._cache.move_to_end(key)
+        
+        if record is None:
+            row = await self.db.fetchone(XTRQueries.FSM_LOAD, (key,))
+            if row:
+                record = XTRFSMRecord(
+                    row['state'], json.loads(row['data']) if row['data'] else {}, row['expires_at'], time.monotonic()
+                )
+            else:
+                # Запоминаем и отсутствие: пользователь без состояния не должен
+                # ходить в БД на каждый апдейт. Запись заменит первый set_state/set_data
+                record = XTRFSMRecord(None, {}, float('inf'), time.monotonic())
+                self._absent_total += 1
+            self._remember(key, record)
+        
+        if record is not None and record.expires_at <= time.time():
+            return None
+        return record
+    
+    async def _update(self, key: str, state: Optional[str] = None, data: Optional[Dict[str, Any]] = None,
+                      set_state: bool = False, set_data: bool = False):
+        """Изменить запись и поставить ее в очередь на сброс"""
+        record = await self._load(key)
+        if record is None:
+            record = XTRFSMRecord(None, {}, 0.0)
+        
+        record = XTRFSMRecord(
+            state if set_state else record.state,
+            dict(data) if set_data else record.data,
+            time.time() + self.ttl,
+            time.monotonic()
+        )
+        
+        self._remember(key, record)
+        self._dirty[key] = record
+        self._ensure_started()
+    
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._update(
+            self._key(key),
+            state=state.state if isinstance(state, State) else state,
+            set_state=True
+        )
+    
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await self._load(self._key(key))
+        return record.state if record else None
+    
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._update(self._key(key), data=data, set_data=True)
+    
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await self._load(self._key(key))
+        return dict(record.data) if record else {}
+    
+    async def flush(self):
+        """Сбросить накопленные изменения одной транзакцией"""
+        if not self._dirty:
+            return
+        
+        # Записи остаются в _dirty до конца транзакции: до этого в БД старое значение
+        batch = dict(self._dirty)
+        upserts = []
+        deletes = []
+        for key, record in batch.items():
+            if record.state is None and not record.data:
+                deletes.append((key,))
+            else:
+                upserts.append((key, record.state, json.dumps(record.data, ensure_ascii=False), record.expires_at))
+        
+        async def job(conn):
+            if upserts:
+                await conn.executemany('''
+                    INSERT INTO fsm_states (key, state, data, expires_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET
+                        state = excluded.state,
+                        data = excluded.data,
+                        expires_at = excluded.expires_at
+                ''', upserts)
+            if deletes:
+                await conn.executemany("DELETE FROM fsm_states WHERE key = ?", deletes)
+        
+        await self.db.write(job)
+        
+        for key, record in batch.items():
+            # Изменения, сделанные во время сброса, уйдут следующей пачкой
+            if self._dirty.get(key) is record:
+                del self._dirty[key]
+        self._flushed_total += len(batch)
+    
+    async def sweep_expired(self) -> int:
+        """Удалить истекшие состояния из БД и кэша"""
+        now = time.time()
+        
+        async def job(conn):
+            cursor = await conn.execute(XTRQueries.FSM_SWEEP, (now,))
+            return cursor.rowcount
+        
+        removed = await self.db.write(job)
+        
+        for key in [key for key, record in self._cache.items() if record.expires_at < now]:
+            del self._cache[key]
+        
+        self._expired_total += removed
+        return removed
+    
+    async def _run(self):
+        """Периодический сброс и очистка"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - self._last_sweep >= self.ttl:
+                    self._last_sweep = time.monotonic()
+                    await self.sweep_expired()
+            except Exception as e:
+                logger.error(f"Ошибка сброса FSM: {e}")
+    
+    async def close(self) -> None:
+        """Остановить сброс и дописать изменения"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Статистика хранилища"""
+        return {
+            "cached": len(self._cache),
+            "dirty": len(self._dirty),
+            "hits_total": self._hits_total,
+            "misses_total": self._misses_total,
+            "revalidated_total": self._revalidated_total,
+            "absent_cached_total": self._absent_total,
+            "flushed_total": self._flushed_total,
+            "expired_total": self._expired_total,
+        }
 
 # ============================================================================
 # ОСНОВНОЙ БОТ XTR
@@ -658,18 +4423,58 @@ class XTRPaymentSystem:
 class XTRBot:
     """Основной бот с поддержкой XTR"""
     
-    def __init__(self):
+    def __init__(self, session: Optional[BaseSession] = None):
+        # session подменяется в нагрузочном тесте (loadtest.py), иначе aiohttp по умолчанию
         self.bot = Bot(
             token=XTRConfig.BOT_TOKEN,
+            session=session,
             default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN)
         )
-        self.storage = MemoryStorage()
+        self.storage = XTRFSMStorage(
+            db,
+            cache_size=XTRConfig.FSM_CACHE_SIZE,
+            ttl=XTRConfig.FSM_TTL,
+            flush_interval=XTRConfig.FSM_FLUSH_INTERVAL,
+            revalidate=XTRConfig.FSM_REVALIDATE
+        )
         self.dp = Dispatcher(storage=self.storage)
         self.router = Router()
         self.dp.include_router(self.router)
         
+        # Один SELECT users на апдейт
+        self.router.message.outer_middleware(XTRUserMiddleware())
+        self.router.callback_query.outer_middleware(XTRUserMiddleware())
+        
+        # Время обработчиков и запросов к Bot API для /metrics
+        self.router.message.middleware(XTRHandlerMetricsMiddleware())
+        self.router.callback_query.middleware(XTRHandlerMetricsMiddleware())
+        self.router.pre_checkout_query.middleware(XTRHandlerMetricsMiddleware())
+        self.bot.session.middleware(XTRApiMetricsMiddleware())
+        
+        # Прием апдейтов в режиме webhook
+        self.ingestor = XTRUpdateIngestor(
+            self.dp,
+            self.bot,
+            workers=XTRConfig.WEBHOOK_WORKERS,
+            queue_size=XTRConfig.WEBHOOK_QUEUE_SIZE,
+            dedup_window=XTRConfig.WEBHOOK_DEDUP_WINDOW
+        )
+        
+        # Исходящие сообщения
+        self.outbox = XTROutbox(
+            self.bot,
+            workers=XTRConfig.OUTBOX_WORKERS,
+            queue_size=XTRConfig.OUTBOX_QUEUE_SIZE,
+            max_retries=XTRConfig.OUTBOX_MAX_RETRIES
+        )
+        
         # Система платежей
         self.payment_system = XTRPaymentSystem()
+        self.invoice_links = XTRInvoiceLinkCache(
+            self.bot,
+            presets=XTRConfig.DEPOSIT_PRESETS,
+            ttl=XTRConfig.INVOICE_LINK_TTL
+        )
         
         # Состояния FSM
         class States(StatesGroup):
@@ -683,27 +4488,46 @@ class XTRBot:
         
         # Регистрация обработчиков
         self.register_handlers()
+        self.register_metrics()
         
         logger.info("XTR Bot initialized")
     
+    def register_metrics(self):
+        """Датчики глубины очередей для /metrics"""
+        metrics.gauge(
+            "xtr_queue_depth", "Элементов в очереди", ("queue",),
+            lambda: {
+                ("db_writer",): db.writer_stats()['queue_depth'],
+                ("webhook",): self.ingestor.stats()['queue_depth'],
+                ("outbox",): self.outbox.stats()['queue_depth'],
+                ("log",): XTRLogger.stats().get('queued', 0),
+                ("fsm_dirty",): self.storage.stats()['dirty'],
+                ("activity",): activity.stats()['pending'],
+            }
+        )
+        metrics.gauge(
+            "xtr_db_pool_connections", "Соединения пула чтения", ("state",),
+            lambda: {("idle",): db.pool_stats()['idle'], ("in_use",): db.pool_stats()['in_use']}
+        )
+    
     def register_handlers(self):
         """Регистрация всех обработчиков"""
         
         @self.router.message(Command("start"))
-        async def cmd_start(message: Message, command: CommandObject = None):
-            await self.handle_start(message, command)
+        async def cmd_start(message: Message, user_ctx: XTRUserContext, command: CommandObject = None):
+            await self.handle_start(message, command, user_ctx)
         
         @self.router.message(Command("deposit"))
         async def cmd_deposit(message: Message, command: CommandObject = None):
             await self.handle_deposit(message, command)
         
         @self.router.message(Command("withdraw"))
-        async def cmd_withdraw(message: Message, command: CommandObject = None):
-            await self.handle_withdraw(message, command)
+        async def cmd_withdraw(message: Message, user_ctx: XTRUserContext, command: CommandObject = None):
+            await self.handle_withdraw(message, command, user_ctx)
         
         @self.router.message(Command("balance"))
-        async def cmd_balance(message: Message):
-            await self.handle_balance(message)
+        async def cmd_balance(message: Message, user_ctx: XTRUserContext):
+            await self.handle_balance(message, user_ctx)
         
         @self.router.message(Command("buy_stars"))
         async def cmd_buy_stars(message: Message, command: CommandObject = None):
@@ -721,6 +4545,34 @@ class XTRBot:
         async def cmd_exchange(message: Message, command: CommandObject = None):
             await self.handle_exchange(message, command)
         
+        @self.router.message(Command("market"))
+        async def cmd_market(message: Message):
+            await self.handle_market(message, message.from_user.id)
+        
+        @self.router.message(Command("sell"))
+        async def cmd_sell(message: Message, user_ctx: XTRUserContext, command: CommandObject = None):
+            await self.handle_sell(message, command, user_ctx)
+        
+        @self.router.message(Command("bid"))
+        async def cmd_bid(message: Message, user_ctx: XTRUserContext, command: CommandObject = None):
+            await self.handle_bid(message, command, user_ctx)
+        
+        @self.router.message(Command("unlist"))
+        async def cmd_unlist(message: Message, command: CommandObject = None):
+            await self.handle_unlist(message, command)
+        
+        @self.router.message(Command("cancel_bid"))
+        async def cmd_cancel_bid(message: Message, user_ctx: XTRUserContext, command: CommandObject = None):
+            await self.handle_cancel_bid(message, command, user_ctx)
+        
+        @self.router.message(Command("leaderboard"))
+        async def cmd_leaderboard(message: Message, user_ctx: XTRUserContext):
+            await self.send_leaderboard(message, user_ctx, 'deposits', 0)
+        
+        @self.router.message(Command("history"))
+        async def cmd_history(message: Message):
+            await self.send_history(message, message.from_user.id, 'xtr')
+        
         @self.router.message(Command("help"))
         async def cmd_help(message: Message):
             await self.handle_help(message)
@@ -735,34 +4587,80 @@ class XTRBot:
             await self.handle_pre_checkout(pre_checkout_query)
         
         @self.router.message(F.successful_payment)
-        async def successful_payment_handler(message: Message):
-            await self.handle_successful_payment(message)
+        async def successful_payment_handler(message: Message, user_ctx: XTRUserContext):
+            await self.handle_successful_payment(message, user_ctx)
         
         # Callback обработчики
         @self.router.callback_query(F.data.startswith("deposit_"))
         async def deposit_callback(callback: CallbackQuery):
             await self.handle_deposit_callback(callback)
         
+        @self.router.callback_query(F.data.startswith("check_deposit_"))
+        async def check_deposit_callback(callback: CallbackQuery):
+            await self.handle_deposit_callback(callback)
+        
         @self.router.callback_query(F.data.startswith("nft_"))
-        async def nft_callback(callback: CallbackQuery):
-            await self.handle_nft_callback(callback)
+        async def nft_callback(callback: CallbackQuery, user_ctx: XTRUserContext):
+            await self.handle_nft_callback(callback, user_ctx)
+        
+        @self.router.callback_query(F.data.startswith("leaderboard_"))
+        async def leaderboard_callback(callback: CallbackQuery, user_ctx: XTRUserContext):
+            await self.handle_leaderboard_callback(callback, user_ctx)
+        
+        @self.router.callback_query(F.data.startswith("history_"))
+        async def history_callback(callback: CallbackQuery):
+            await self.handle_history_callback(callback)
         
         @self.router.callback_query(F.data.startswith("withdraw_"))
-        async def withdraw_callback(callback: CallbackQuery):
-            await self.handle_withdraw_callback(callback)
+        async def withdraw_callback(callback: CallbackQuery, user_ctx: XTRUserContext):
+            await self.handle_withdraw_callback(callback, user_ctx)
     
-    async def handle_start(self, message: Message, command: CommandObject):
+    async def handle_start(self, message: Message, command: CommandObject, user_ctx: XTRUserContext):
         """Обработка команды /start"""
         try:
             user_id = message.from_user.id
             username = message.from_user.username or message.from_user.first_name
+            first_name = message.from_user.first_name
+            referrer_id = XTRReferralPayouts.parse_payload(command.args if command else None)
             
-            # Создаем/обновляем пользователя
-            await db.execute('''
-                INSERT OR REPLACE INTO users 
-                (user_id, username, first_name, last_active) 
-                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-            ''', (user_id, username, message.from_user.first_name))
+            # Регистрация: запись только для нового пользователя или измененного профиля
+            fingerprint = XTRProfileCache.fingerprint(username, first_name)
+            if not profiles.unchanged(user_id, fingerprint):
+                user = await user_ctx.get()
+                
+                if user is None or (user.username, user.first_name) != (username, first_name):
+                    async def job(conn):
+                        async with conn.execute(
+                            "SELECT username, referral_id FROM users WHERE user_id = ?", (user_id,)
+                        ) as cursor:
+                            row = await cursor.fetchone()
+                        is_new = row is None
+                        # Первый вход: строки нет или ее без профиля создал платеж по общей ссылке
+                        first_entry = is_new or (row['username'] is None and row['referral_id'] is None)
+                        
+                        # Балансы и created_at не трогаются; без изменений профиля строка не пишется
+                        await conn.execute('''
+                            INSERT INTO users (user_id, username, first_name)
+                            VALUES (?, ?, ?)
+                            ON CONFLICT(user_id) DO UPDATE SET
+                                username = excluded.username,
+                                first_name = excluded.first_name
+                            WHERE username IS NOT excluded.username
+                               OR first_name IS NOT excluded.first_name
+                        ''', (user_id, username, first_name))
+                        
+                        if is_new:
+                            await rollups.bump(conn, users=1)
+                        
+                        # Реферал засчитывается только при первом входе
+                        return first_entry and referrer_id is not None and await referrals.attribute(conn, user_id, referrer_id)
+                    
+                    if await db.write(job):
+                        leaderboard.add(referrer_id, referrals=1)
+                        self.outbox.send(referrer_id, "👥 По вашей ссылке зарегистрировался новый пользователь!")
+                    user_ctx.invalidate()
+                
+                profiles.remember(user_id, fingerprint)
             
             # Приветственное сообщение
             welcome_text = """
@@ -780,7 +4678,7 @@ class XTRBot:
 💎 **Быстрый старт:**
 1. /deposit - Пополнить баланс XTR
 2. /balance - Проверить баланс
-3. /nft_shop - Магазин NFT
+3. /nft\\_shop - Магазин NFT
 4. /withdraw - Вывести XTR
 
 🚀 **Начните зарабатывать реальные деньги уже сегодня!**
@@ -819,19 +4717,13 @@ class XTRBot:
                         )
                         return
                     
-                    # Создаем инвойс
-                    payload = f"deposit_{message.from_user.id}_{amount}_{int(time.time())}"
-                    
-                    invoice_url = await self.payment_system.create_invoice_link(
-                        bot=self.bot,
-                        chat_id=message.chat.id,
-                        amount_xtr=amount,
-                        description=f"Пополнение баланса на {amount} XTR",
-                        payload=payload,
-                        start_parameter="deposit"
-                    )
+                    # Ссылка из кэша для фиксированной суммы, иначе новый инвойс
+                    invoice_url, payload = await self.invoice_links.get(message.chat.id, amount)
                     
                     if invoice_url:
+                        await invoices.register(invoices.key(payload, message.chat.id), message.chat.id, amount)
+                        stars_per_xtr = await rates.get()
+                        
                         keyboard = InlineKeyboardBuilder()
                         keyboard.button(text="💳 Оплатить", url=invoice_url)
                         keyboard.button(text="🔄 Проверить оплату", callback_data=f"check_deposit_{payload}")
@@ -839,8 +4731,8 @@ class XTRBot:
                         await message.answer(
                             f"💎 **Пополнение баланса**\n\n"
                             f"Сумма: {amount} XTR\n"
-                            f"Курс: 1 XTR = 1000 внутренних звезд\n"
-                            f"Вы получите: {amount * 1000} ⭐\n\n"
+                            f"Курс: 1 XTR = {stars_per_xtr} внутренних звезд\n"
+                            f"Вы получите: {amount * stars_per_xtr} ⭐\n\n"
                             f"*Нажмите кнопку ниже для оплаты:*",
                             reply_markup=keyboard.as_markup()
                         )
@@ -870,16 +4762,13 @@ class XTRBot:
             logger.error(f"Ошибка в handle_deposit: {e}")
             await message.answer("❌ Ошибка обработки запроса")
     
-    async def handle_withdraw(self, message: Message, command: CommandObject):
+    async def handle_withdraw(self, message: Message, command: CommandObject, user_ctx: XTRUserContext):
         """Обработка команды /withdraw"""
         try:
-            user_id = message.from_user.id
+            user_id = user_ctx.user_id
             
             # Получаем баланс
-            user = await db.fetchone(
-                "SELECT balance_xtr, is_verified FROM users WHERE user_id = ?",
-                (user_id,)
-            )
+            user = await user_ctx.get()
             
             if not user:
                 await message.answer("❌ Пользователь не найден")
@@ -896,26 +4785,24 @@ class XTRBot:
                     wallet_address = args[1]
                     
                     # Обрабатываем вывод
-                    success, result = await self.payment_system.process_withdrawal(
+                    success, result, withdrawal_id = await self.payment_system.process_withdrawal(
                         user_id, amount, wallet_address
                     )
                     
                     if success:
+                        user_ctx.invalidate()
                         await message.answer(f"✅ {result}")
                         
                         # Уведомляем админов
                         for admin_id in XTRConfig.ADMIN_IDS:
-                            try:
-                                await self.bot.send_message(
-                                    admin_id,
-                                    f"🔄 **НОВЫЙ ВЫВОД**\n\n"
-                                    f"👤 Пользователь: @{message.from_user.username or user_id}\n"
-                                    f"💰 Сумма: {amount} XTR\n"
-                                    f"🎯 Кошелек: {wallet_address}\n"
-                                    f"🆔 ID: {user_id}"
-                                )
-                            except:
-                                pass
+                            self.outbox.send(
+                                admin_id,
+                                f"🔄 **НОВЫЙ ВЫВОД #{withdrawal_id}**\n\n"
+                                f"👤 Пользователь: @{message.from_user.username or user_id}\n"
+                                f"💰 Сумма: {amount} XTR\n"
+                                f"🎯 Кошелек: {wallet_address}\n"
+                                f"🆔 ID: {user_id}"
+                            )
                     else:
                         await message.answer(f"❌ {result}")
                         
@@ -928,15 +4815,15 @@ class XTRBot:
                 withdrawal_info = f"""
 💸 **Вывод XTR**
 
-💰 Ваш баланс: {user['balance_xtr']} XTR
-✅ Статус верификации: {'Пройдена' if user['is_verified'] else 'Требуется'}
+💰 Ваш баланс: {user.balance_xtr} XTR
+✅ Статус верификации: {'Пройдена' if user.is_verified else 'Требуется'}
 
 📊 **Условия вывода:**
 • Минимум: {XTRConfig.MIN_WITHDRAWAL} XTR
 • Максимум: {XTRConfig.MAX_WITHDRAWAL} XTR
 • Комиссия: {XTRConfig.WITHDRAWAL_FEE_PERCENT}%
 
-⚠️ **Для вывода > 500 XTR требуется верификация**
+⚠️ **Для вывода > {XTRConfig.UNVERIFIED_WITHDRAWAL_LIMIT} XTR требуется верификация**
 
 📝 **Использование:**
 `/withdraw <amount> <wallet_address>`
@@ -945,7 +4832,7 @@ class XTRBot:
                 """
                 
                 keyboard = InlineKeyboardBuilder()
-                if not user['is_verified']:
+                if not user.is_verified:
                     keyboard.button(text="✅ Пройти верификацию", callback_data="verify_request")
                 keyboard.button(text="📋 Мои заявки", callback_data="withdraw_requests")
                 keyboard.adjust(1)
@@ -956,65 +4843,61 @@ class XTRBot:
             logger.error(f"Ошибка в handle_withdraw: {e}")
             await message.answer("❌ Ошибка обработки запроса")
     
-    async def handle_balance(self, message: Message):
+    async def handle_balance(self, message: Message, user_ctx: XTRUserContext):
         """Обработка команды /balance"""
         try:
-            user_id = message.from_user.id
+            user_id = user_ctx.user_id
             
             # Получаем данные пользователя
-            user = await db.fetchone('''
-                SELECT balance_stars, balance_xtr, total_deposited_xtr, 
-                       total_withdrawn_xtr, referrals, is_verified
-                FROM users WHERE user_id = ?
-            ''', (user_id,))
+            user = await user_ctx.get()
             
             if not user:
                 await message.answer("❌ Пользователь не найден")
                 return
             
             # Получаем курс
-            exchange = await db.fetchone("SELECT stars_per_xtr FROM exchange_rates WHERE id = 1")
-            stars_per_xtr = exchange['stars_per_xtr'] if exchange else 1000
+            stars_per_xtr = await rates.get()
             
             # Получаем последние транзакции
-            last_xtr = await db.fetchall('''
-                SELECT * FROM xtr_transactions 
-                WHERE user_id = ? 
-                ORDER BY created_at DESC 
-                LIMIT 5
-            ''', (user_id,))
+            last_xtr = await db.fetchall(XTRQueries.LAST_TRANSACTIONS, (user_id,))
+            
+            # Подчеркивания в ссылке (ref_, имя бота) ломают Markdown
+            invite_link = f"https://t.me/{(await self.bot.me()).username}?start=ref_{user_id}".replace('_', '\\_')
             
             # Формируем сообщение
             balance_text = f"""
 💰 **ВАШ БАЛАНС**
 
 💎 **Telegram Stars (XTR):**
-• Доступно: {user['balance_xtr']} XTR
-• Всего пополнено: {user['total_deposited_xtr']} XTR
-• Всего выведено: {user['total_withdrawn_xtr']} XTR
+• Доступно: {user.balance_xtr} XTR
+• Всего пополнено: {user.total_deposited_xtr} XTR
+• Всего выведено: {user.total_withdrawn_xtr} XTR
 
 ⭐ **Внутренние звезды:**
-• Баланс: {user['balance_stars']} ⭐
+• Баланс: {user.balance_stars} ⭐
 • Курс: 1 XTR = {stars_per_xtr} ⭐
 
 👥 **Рефералы:**
-• Приглашено: {user['referrals']} пользователей
-• Статус: {'✅ Верифицирован' if user['is_verified'] else '❌ Требуется верификация'}
+• Приглашено: {user.referrals} пользователей
+• Ваша ссылка: {invite_link}
+• Вознаграждение: {XTRConfig.REFERRAL_PERCENT}% от их пополнений
+• Статус: {'✅ Верифицирован' if user.is_verified else '❌ Требуется верификация'}
 
 💸 **Примерная стоимость:**
-• Ваш баланс в XTR: ≈${user['balance_xtr'] * 0.01:.2f} USD
+• Ваш баланс в XTR: ≈${user.balance_xtr * 0.01:.2f} USD
             """
             
             if last_xtr:
                 balance_text += "\n\n📊 **Последние транзакции:**\n"
                 for tx in last_xtr:
-                    emoji = "⬆️" if tx['type'] == 'deposit' else "⬇️"
+                    emoji = "⬆️" if tx['type'] in ('deposit', 'reward') else "⬇️"
                     balance_text += f"{emoji} {tx['type']}: {tx['amount']} XTR\n"
             
             keyboard = InlineKeyboardBuilder()
             keyboard.button(text="💰 Пополнить", callback_data="deposit_menu")
             keyboard.button(text="💸 Вывести", callback_data="withdraw_menu")
             keyboard.button(text="📊 Подробная статистика", callback_data="stats_detailed")
+            keyboard.button(text="📜 История", callback_data="history_xtr_")
             keyboard.adjust(2)
             
             await message.answer(balance_text, reply_markup=keyboard.as_markup())
@@ -1035,8 +4918,7 @@ class XTRBot:
                         return
                     
                     # Рассчитываем стоимость в XTR
-                    exchange = await db.fetchone("SELECT stars_per_xtr FROM exchange_rates WHERE id = 1")
-                    stars_per_xtr = exchange['stars_per_xtr'] if exchange else 1000
+                    stars_per_xtr = await rates.get()
                     
                     xtr_amount = amount // stars_per_xtr
                     if amount % stars_per_xtr != 0:
@@ -1046,20 +4928,16 @@ class XTRBot:
                         xtr_amount = XTRConfig.MIN_STARS_PURCHASE
                     
                     # Создаем инвойс
-                    payload = f"buy_stars_{message.from_user.id}_{amount}_{xtr_amount}"
+                    payload = invoice_payloads.encode(XTRPayloadCodec.BUY_STARS, message.from_user.id, xtr_amount, amount)
                     
-                    invoice_url = await self.payment_system.create_invoice_link(
-                        bot=self.bot,
-                        chat_id=message.chat.id,
-                        amount_xtr=xtr_amount,
-                        description=f"Покупка {amount} звезд",
-                        payload=payload,
-                        start_parameter="buy_stars"
-                    )
+                    invoice_url = await self.invoice_links.create(xtr_amount, payload, f"Покупка {amount} звезд")
                     
                     if invoice_url:
+                        await invoices.register(payload, message.from_user.id, xtr_amount)
+                        
                         keyboard = InlineKeyboardBuilder()
                         keyboard.button(text="💳 Купить", url=invoice_url)
+                        keyboard.button(text="🔄 Проверить оплату", callback_data=f"check_deposit_{payload}")
                         
                         await message.answer(
                             f"⭐ **Покупка звезд**\n\n"
@@ -1073,7 +4951,7 @@ class XTRBot:
                         await message.answer("❌ Ошибка создания платежа")
                         
                 except ValueError:
-                    await message.answer("❌ Неверная сумма. Использование: /buy_stars <amount>")
+                    await message.answer("❌ Неверная сумма. Использование: /buy\\_stars <amount>")
             else:
                 await message.answer(
                     "⭐ **Покупка внутренних звезд**\n\n"
@@ -1091,11 +4969,7 @@ class XTRBot:
         """Обработка команды /nft_shop"""
         try:
             # Получаем NFT из магазина
-            nfts = await db.fetchall('''
-                SELECT * FROM nft_items 
-                WHERE available = 1 
-                ORDER BY price_xtr ASC
-            ''')
+            nfts = await db.fetchall(XTRQueries.NFT_SHOP)
             
             if not nfts:
                 await message.answer("🛒 Магазин NFT пуст!")
@@ -1139,18 +5013,12 @@ class XTRBot:
             user_id = message.from_user.id
             
             # Получаем NFT пользователя
-            nfts = await db.fetchall('''
-                SELECT no.*, ni.name, ni.description, ni.rarity, ni.emoji
-                FROM nft_ownership no
-                JOIN nft_items ni ON no.nft_id = ni.id
-                WHERE no.user_id = ?
-                ORDER BY no.purchased_at DESC
-            ''', (user_id,))
+            nfts = await db.fetchall(XTRQueries.USER_NFTS, (user_id,))
             
             if not nfts:
                 await message.answer(
                     "🎒 **Ваша коллекция NFT пуста!**\n\n"
-                    "Посетите магазин: /nft_shop\n"
+                    "Посетите магазин: /nft\\_shop\n"
                     "Купите свой первый NFT за XTR или внутренние звезды!"
                 )
                 return
@@ -1166,7 +5034,10 @@ class XTRBot:
                 nfts_text += f"*{nft['description']}*\n"
                 nfts_text += f"🎯 Редкость: {nft['rarity']}\n"
                 nfts_text += f"💰 Куплено за: {nft['purchase_price']} {nft['purchase_type']}\n"
-                nfts_text += f"📅 Дата: {nft['purchased_at'][:10]}\n\n"
+                nfts_text += f"📅 Дата: {nft['purchased_at'][:10]}\n"
+                if nft['is_listed']:
+                    nfts_text += f"🏷️ На продаже за {nft['listing_price']} ⭐\n"
+                nfts_text += "\n"
                 
                 if nft['purchase_type'] == 'xtr':
                     total_value_xtr += nft['purchase_price']
@@ -1190,6 +5061,198 @@ class XTRBot:
             logger.error(f"Ошибка в handle_my_nfts: {e}")
             await message.answer("❌ Ошибка загрузки коллекции")
     
+    async def handle_market(self, message: Message, user_id: int):
+        """Обработка команды /market"""
+        try:
+            books = market.active_books()
+            
+            market_text = "🎯 **ТОРГОВАЯ ПЛОЩАДКА NFT**\n\n"
+            
+            if books:
+                placeholders = ",".join("?" * len(books))
+                items = await db.fetchall(
+                    f"SELECT id, name, emoji FROM nft_items WHERE id IN ({placeholders})",
+                    tuple(book['nft_id'] for book in books)
+                )
+                names = {item['id']: f"{item['emoji']} {item['name']}" for item in items}
+                
+                for book in books:
+                    market_text += f"{names.get(book['nft_id'], '🎁 NFT')} (#{book['nft_id']})\n"
+                    market_text += f"📉 Продажа: {book['best_ask'] or '—'} ⭐ ({book['asks']} лот.)\n"
+                    market_text += f"📈 Покупка: {book['best_bid'] or '—'} ⭐ ({book['bids']} заяв.)\n\n"
+            else:
+                market_text += "Пока нет ни лотов, ни заявок.\n\n"
+            
+            listings = await db.fetchall(XTRQueries.MARKET_MY_LISTINGS, (user_id,))
+            bids = await db.fetchall(XTRQueries.MARKET_MY_BIDS, (user_id,))
+            
+            if listings:
+                market_text += "🏷️ **Ваши лоты:**\n"
+                for listing in listings:
+                    market_text += f"#{listing['id']} {listing['emoji']} {listing['name']} - {listing['price_stars']} ⭐\n"
+                market_text += "\n"
+            
+            if bids:
+                market_text += "🛎️ **Ваши заявки:**\n"
+                for bid in bids:
+                    market_text += f"#{bid['id']} {bid['emoji']} {bid['name']} - {bid['price_stars']} ⭐\n"
+                market_text += "\n"
+            
+            market_text += (
+                "Продать: /sell <id владения> <цена>\n"
+                "Купить: /bid <id NFT> <цена>\n"
+                "Снять: /unlist <id лота>, /cancel\\_bid <id заявки>"
+            )
+            
+            await message.answer(market_text)
+        
+        except Exception as e:
+            logger.error(f"Ошибка в handle_market: {e}")
+            await message.answer("❌ Ошибка загрузки торговой площадки")
+    
+    async def handle_sell_menu(self, message: Message, user_id: int):
+        """Список NFT пользователя для выставления на продажу"""
+        try:
+            nfts = await db.fetchall(XTRQueries.USER_NFTS, (user_id,))
+            
+            if not nfts:
+                await message.answer("🎒 Вам пока нечего продать. Загляните в /nft\\_shop")
+                return
+            
+            sell_text = "📊 **ПРОДАЖА NFT**\n\n"
+            for nft in nfts:
+                book = market.book(nft['nft_id'])
+                sell_text += f"{nft['emoji']} **{nft['name']}** - id владения: `{nft['id']}`\n"
+                if nft['is_listed']:
+                    sell_text += f"🏷️ Уже на продаже за {nft['listing_price']} ⭐\n"
+                elif book['best_bid']:
+                    sell_text += f"📈 Лучшая заявка: {book['best_bid']} ⭐\n"
+                sell_text += "\n"
+            
+            sell_text += "Выставить: /sell <id владения> <цена в звездах>"
+            
+            await message.answer(sell_text)
+        
+        except Exception as e:
+            logger.error(f"Ошибка в handle_sell_menu: {e}")
+            await message.answer("❌ Ошибка загрузки коллекции")
+    
+    @staticmethod
+    def parse_market_args(command: CommandObject) -> Optional[List[int]]:
+        """Целочисленные аргументы команды рынка"""
+        if not command or not command.args:
+            return None
+        try:
+            return [int(arg) for arg in command.args.split()]
+        except ValueError:
+            return None
+    
+    def notify_referral_payouts(self, credited: Dict[int, int]):
+        """Уведомить рефереров о пакетной выплате"""
+        for referrer_id, amount in credited.items():
+            self.outbox.send(
+                referrer_id,
+                f"👥 **Реферальная выплата!**\n\n"
+                f"💎 Зачислено: {amount} XTR\n"
+                f"*{XTRConfig.REFERRAL_PERCENT}% от пополнений приглашенных*"
+            )
+    
+    def notify_trades(self, trades: List[Dict[str, Any]]):
+        """Уведомить стороны сделок"""
+        for trade in trades:
+            self.outbox.send(
+                trade['seller_id'],
+                f"💰 **NFT продан!**\n\n"
+                f"Лот #{trade['listing_id']} исполнен по {trade['price']} ⭐\n"
+                f"Звезды зачислены на баланс."
+            )
+            self.outbox.send(
+                trade['buyer_id'],
+                f"🎁 **NFT куплен!**\n\n"
+                f"Заявка #{trade['bid_id']} исполнена по {trade['price']} ⭐\n"
+                f"NFT добавлен в коллекцию: /my\\_nfts"
+            )
+    
+    async def handle_sell(self, message: Message, command: CommandObject, user_ctx: XTRUserContext):
+        """Обработка команды /sell"""
+        try:
+            args = self.parse_market_args(command)
+            if not args or len(args) != 2:
+                await message.answer("📊 Использование: /sell <id владения> <цена в звездах>\nId владения: /my\\_nfts → Продать NFT")
+                return
+            
+            ownership_id, price = args
+            success, result, trades = await market.list_nft(user_ctx.user_id, ownership_id, price)
+            
+            if trades:
+                user_ctx.invalidate()
+                self.notify_trades(trades)
+            elif success:
+                await message.answer(f"✅ {result}")
+            else:
+                await message.answer(f"❌ {result}")
+        
+        except Exception as e:
+            logger.error(f"Ошибка в handle_sell: {e}")
+            await message.answer("❌ Ошибка выставления лота")
+    
+    async def handle_bid(self, message: Message, command: CommandObject, user_ctx: XTRUserContext):
+        """Обработка команды /bid"""
+        try:
+            args = self.parse_market_args(command)
+            if not args or len(args) != 2:
+                await message.answer("📈 Использование: /bid <id NFT> <цена в звездах>\nId NFT: /market или /nft\\_shop")
+                return
+            
+            nft_id, price = args
+            success, result, trades = await market.place_bid(user_ctx.user_id, nft_id, price)
+            
+            if success:
+                user_ctx.invalidate()
+            
+            if trades:
+                self.notify_trades(trades)
+            elif success:
+                await message.answer(f"✅ {result}")
+            else:
+                await message.answer(f"❌ {result}")
+        
+        except Exception as e:
+            logger.error(f"Ошибка в handle_bid: {e}")
+            await message.answer("❌ Ошибка размещения заявки")
+    
+    async def handle_unlist(self, message: Message, command: CommandObject):
+        """Обработка команды /unlist"""
+        try:
+            args = self.parse_market_args(command)
+            if not args or len(args) != 1:
+                await message.answer("🏷️ Использование: /unlist <id лота>")
+                return
+            
+            success, result = await market.cancel_listing(message.from_user.id, args[0])
+            await message.answer(f"{'✅' if success else '❌'} {result}")
+        
+        except Exception as e:
+            logger.error(f"Ошибка в handle_unlist: {e}")
+            await message.answer("❌ Ошибка снятия лота")
+    
+    async def handle_cancel_bid(self, message: Message, command: CommandObject, user_ctx: XTRUserContext):
+        """Обработка команды /cancel_bid"""
+        try:
+            args = self.parse_market_args(command)
+            if not args or len(args) != 1:
+                await message.answer("🛎️ Использование: /cancel\\_bid <id заявки>")
+                return
+            
+            success, result = await market.cancel_bid(user_ctx.user_id, args[0])
+            if success:
+                user_ctx.invalidate()
+            await message.answer(f"{'✅' if success else '❌'} {result}")
+        
+        except Exception as e:
+            logger.error(f"Ошибка в handle_cancel_bid: {e}")
+            await message.answer("❌ Ошибка отмены заявки")
+    
     async def handle_exchange(self, message: Message, command: CommandObject):
         """Обработка команды /exchange"""
         try:
@@ -1204,8 +5267,7 @@ class XTRBot:
                     from_currency = args[1].lower()
                     
                     # Получаем курс
-                    exchange = await db.fetchone("SELECT stars_per_xtr FROM exchange_rates WHERE id = 1")
-                    stars_per_xtr = exchange['stars_per_xtr'] if exchange else 1000
+                    stars_per_xtr = await rates.get()
                     
                     if from_currency in ['stars', '⭐']:
                         # Конвертация звезд в XTR
@@ -1237,8 +5299,7 @@ class XTRBot:
                     await message.answer("❌ Неверная сумма")
             else:
                 # Показываем информацию об обмене
-                exchange = await db.fetchone("SELECT stars_per_xtr FROM exchange_rates WHERE id = 1")
-                stars_per_xtr = exchange['stars_per_xtr'] if exchange else 1000
+                stars_per_xtr = await rates.get()
                 
                 exchange_text = f"""
 💱 **ОБМЕННЫЙ КУРС**
@@ -1279,11 +5340,20 @@ class XTRBot:
 /deposit - Пополнить XTR
 /withdraw - Вывести XTR
 /exchange - Курс обмена
+/leaderboard - Таблица лидеров
+/history - История операций
 
 *NFT система:*
-/nft_shop - Магазин NFT
-/my_nfts - Ваша коллекция
-/buy_stars - Купить звезды
+/nft\\_shop - Магазин NFT
+/my\\_nfts - Ваша коллекция
+/buy\\_stars - Купить звезды
+
+*Торговая площадка (в звездах):*
+/market - Стаканы, ваши лоты и заявки
+/sell <id владения> <цена> - Выставить NFT
+/bid <id NFT> <цена> - Заявка на покупку (звезды резервируются)
+/unlist <id лота> - Снять лот
+/cancel\\_bid <id заявки> - Снять заявку
 
 *Администрация:*
 /admin - Панель администратора
@@ -1319,6 +5389,8 @@ class XTRBot:
 *Основные команды:*
 /admin stats - Статистика системы
 /admin backup - Создать бэкап
+/admin plans - Проверить планы запросов
+/admin rebuild_stats - Пересчитать статистику
 /admin users - Список пользователей
 /admin user <id> - Инфо о пользователе
 /admin verify <id> - Верифицировать
@@ -1330,6 +5402,7 @@ class XTRBot:
 /admin approve <id> - Одобрить вывод
 /admin reject <id> <reason> - Отклонить вывод
 /admin addxtr <id> <amount> - Добавить XTR
+/admin rate <stars> - Изменить курс (звезд за 1 XTR)
 
 *NFT:*
 /admin nfts - Управление NFT
@@ -1345,6 +5418,10 @@ class XTRBot:
                 await self.handle_admin_stats(message)
             elif cmd == "backup":
                 await self.handle_admin_backup(message)
+            elif cmd == "plans":
+                await self.handle_admin_plans(message)
+            elif cmd == "rebuild_stats":
+                await self.handle_admin_rebuild_stats(message)
             elif cmd == "users":
                 await self.handle_admin_users(message, args[1:] if len(args) > 1 else [])
             elif cmd == "verify":
@@ -1359,6 +5436,11 @@ class XTRBot:
                     await message.answer("Использование: /admin approve <withdrawal_id>")
                     return
                 await self.handle_admin_approve(message, args[1])
+            elif cmd == "rate":
+                if len(args) < 2:
+                    await message.answer("Использование: /admin rate <stars_per_xtr>")
+                    return
+                await self.handle_admin_rate(message, args[1])
             else:
                 await message.answer("❌ Неизвестная команда")
                 
@@ -1370,35 +5452,30 @@ class XTRBot:
         """Статистика системы"""
         try:
             # Общая статистика
-            total_users = await db.fetchone("SELECT COUNT(*) as count FROM users")
-            active_users = await db.fetchone('''
-                SELECT COUNT(*) as count FROM users 
-                WHERE datetime(last_active) > datetime('now', '-7 days')
-            ''')
-            
-            total_deposits = await db.fetchone("SELECT SUM(amount) as total FROM xtr_transactions WHERE type = 'deposit'")
-            total_withdrawals = await db.fetchone("SELECT SUM(amount) as total FROM xtr_transactions WHERE type = 'withdrawal'")
-            
-            # Балансы системы
-            system_balance = await db.fetchone("SELECT SUM(balance_xtr) as total FROM users")
-            
-            # NFT статистика
-            nft_sales = await db.fetchone("SELECT COUNT(*) as count FROM nft_ownership")
+            totals = await rollups.totals()
+            today = await rollups.today()
+            active_users = await db.fetchone(XTRQueries.ACTIVE_USERS)
             
             stats_text = f"""
 📊 **СТАТИСТИКА СИСТЕМЫ XTR**
 
 👥 **Пользователи:**
-• Всего: {total_users['count'] if total_users else 0}
+• Всего: {totals.get('users', 0)}
 • Активных (7 дней): {active_users['count'] if active_users else 0}
+• Новых сегодня: {today.get('users', 0)}
 
 💰 **Финансы:**
-• Всего депозитов: {total_deposits['total'] or 0} XTR
-• Всего выводов: {total_withdrawals['total'] or 0} XTR
-• Баланс системы: {system_balance['total'] or 0} XTR
+• Всего депозитов: {totals.get('deposits_xtr', 0)} XTR ({totals.get('deposits_count', 0)} шт.)
+• Всего выводов: {totals.get('withdrawals_xtr', 0)} XTR ({totals.get('withdrawals_count', 0)} шт.)
+• Баланс системы: {totals.get('balance_xtr', 0)} XTR
+
+📅 **Сегодня:**
+• Депозиты: {today.get('deposits_xtr', 0)} XTR
+• Выводы: {today.get('withdrawals_xtr', 0)} XTR
+• Продано NFT: {today.get('nft_sales', 0)}
 
 🎨 **NFT:**
-• Продано NFT: {nft_sales['count'] if nft_sales else 0}
+• Продано NFT: {totals.get('nft_sales', 0)}
 
 💸 **В ожидании:**
 • Заявок на вывод: {await self.get_pending_withdrawals_count()}
@@ -1422,15 +5499,89 @@ class XTRBot:
             logger.error(f"Ошибка в handle_admin_backup: {e}")
             await message.answer("❌ Ошибка создания бэкапа")
     
+    async def handle_admin_rebuild_stats(self, message: Message):
+        """Пересчет сводной статистики по истории"""
+        try:
+            started = time.perf_counter()
+            await rollups.rebuild()
+            await message.answer(f"✅ Статистика пересчитана за {time.perf_counter() - started:.2f} сек")
+        except Exception as e:
+            logger.error(f"Ошибка в handle_admin_rebuild_stats: {e}")
+            await message.answer("❌ Ошибка пересчета статистики")
+    
+    async def handle_admin_plans(self, message: Message):
+        """Проверка планов запросов на полные сканы"""
+        try:
+            violations = await db.check_query_plans()
+            if violations:
+                text = "⚠️ **Полные сканы и лишние индексы:**\n\n" + "\n".join(f"• `{v}`" for v in violations)
+            else:
+                text = f"✅ Все {len(db.QUERY_PLAN_SUITE)} запросов используют индексы, неиспользуемых индексов нет"
+            await message.answer(text)
+        except Exception as e:
+            logger.error(f"Ошибка в handle_admin_plans: {e}")
+            await message.answer("❌ Ошибка проверки планов")
+    
+    async def handle_admin_rate(self, message: Message, value: str):
+        """Изменение курса обмена"""
+        try:
+            stars_per_xtr = int(value)
+            if stars_per_xtr <= 0:
+                raise ValueError
+        except ValueError:
+            await message.answer("❌ Курс должен быть положительным целым числом")
+            return
+        
+        try:
+            rate = await rates.set_rate(stars_per_xtr)
+            await message.answer(f"✅ Новый курс: 1 XTR = {rate} ⭐")
+        except Exception as e:
+            logger.error(f"Ошибка в handle_admin_rate: {e}")
+            await message.answer("❌ Ошибка изменения курса")
+    
     async def get_pending_withdrawals_count(self):
         """Количество ожидающих выводов"""
-        result = await db.fetchone("SELECT COUNT(*) as count FROM withdrawals WHERE status = 'pending'")
+        result = await db.fetchone(XTRQueries.PENDING_WITHDRAWALS_COUNT)
         return result['count'] if result else 0
     
     # Обработчики платежей
     async def handle_pre_checkout(self, pre_checkout_query: PreCheckoutQuery):
         """Обработка предварительной проверки платежа"""
         try:
+            # Подпись, срок и сумма проверяются без обращения к БД
+            try:
+                payload = invoice_payloads.decode(pre_checkout_query.invoice_payload)
+            except XTRPayloadError as e:
+                logger.warning(f"Pre-checkout rejected ({e}): {pre_checkout_query.id}")
+                await self.bot.answer_pre_checkout_query(
+                    pre_checkout_query.id,
+                    ok=False,
+                    error_message="Счет устарел или недействителен. Создайте новый: /deposit"
+                )
+                return
+            
+            if (pre_checkout_query.currency != XTRConfig.STARS_CURRENCY
+                    or pre_checkout_query.total_amount != payload.amount_xtr):
+                logger.warning(f"Pre-checkout amount mismatch: {pre_checkout_query.id}")
+                await self.bot.answer_pre_checkout_query(
+                    pre_checkout_query.id,
+                    ok=False,
+                    error_message="Сумма платежа не совпадает со счетом"
+                )
+                return
+            
+            # Состояние инвойса: оплачен, истек, исчерпаны попытки
+            payer_id = pre_checkout_query.from_user.id
+            reason = await invoices.pre_checkout(
+                invoices.key(pre_checkout_query.invoice_payload, payer_id),
+                payload.user_id or payer_id,
+                payload.amount_xtr
+            )
+            if reason:
+                logger.warning(f"Pre-checkout rejected ({reason}): {pre_checkout_query.id}")
+                await self.bot.answer_pre_checkout_query(pre_checkout_query.id, ok=False, error_message=reason)
+                return
+            
             await self.bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
             logger.info(f"Pre-checkout approved: {pre_checkout_query.id}")
         except Exception as e:
@@ -1441,72 +5592,89 @@ class XTRBot:
                 error_message="Payment processing failed"
             )
     
-    async def handle_successful_payment(self, message: Message):
+    async def handle_successful_payment(self, message: Message, user_ctx: XTRUserContext):
         """Обработка успешного платежа"""
         try:
             payment = message.successful_payment
-            payload = payment.invoice_payload
             
-            logger.info(f"Успешный платеж: {payload}")
+            logger.info(f"Успешный платеж: {payment.telegram_payment_charge_id}")
+            
+            # Разбираем payload: деньги уже списаны, поэтому срок не проверяется
+            try:
+                payload = invoice_payloads.decode(payment.invoice_payload, check_expiry=False)
+            except XTRPayloadError as e:
+                logger.error(f"Платеж с недействительным payload ({e}): {payment.telegram_payment_charge_id}")
+                await message.answer("❌ Платеж не распознан. Обратитесь к администратору.")
+                return
+            
+            if payment.total_amount != payload.amount_xtr:
+                logger.error(f"Сумма платежа не совпадает со счетом: {payment.telegram_payment_charge_id}")
+                await message.answer("❌ Сумма платежа не совпадает со счетом. Обратитесь к администратору.")
+                return
+            
+            # Общий payload ссылки из кэша зачисляется плательщику
+            user_id = payload.user_id or message.from_user.id
+            amount_xtr = payload.amount_xtr
+            
+            # Покупка звезд зачисляет обещанное в счете, депозит - по текущему курсу;
+            # уведомления ниже сообщают ровно это число
+            if payload.kind == XTRPayloadCodec.BUY_STARS:
+                stars_amount = payload.amount_stars
+            else:
+                stars_amount = amount_xtr * await rates.get()
+            
+            result = await self.payment_system.process_deposit(
+                user_id,
+                amount_xtr,
+                payment.provider_payment_charge_id,
+                payment.telegram_payment_charge_id,
+                stars_amount
+            )
+            
+            if result is XTRDepositResult.DUPLICATE:
+                return
+            
+            if result is XTRDepositResult.CREDITED:
+                await invoices.mark_paid(
+                    invoices.key(payment.invoice_payload, message.from_user.id),
+                    user_id,
+                    amount_xtr,
+                    payment.telegram_payment_charge_id
+                )
             
-            # Разбираем payload
-            if payload.startswith("deposit_"):
+            if payload.kind == XTRPayloadCodec.DEPOSIT:
                 # Обработка депозита
-                parts = payload.split("_")
-                if len(parts) >= 4:
-                    user_id = int(parts[1])
-                    amount_xtr = int(parts[2])
+                if result is XTRDepositResult.CREDITED:
+                    # Уведомляем пользователя
+                    payer = await self.reload_payer(user_ctx, user_id)
                     
-                    success = await self.payment_system.process_deposit(
+                    self.outbox.send(
                         user_id,
-                        amount_xtr,
-                        payment.provider_payment_charge_id,
-                        payment.telegram_payment_charge_id
+                        f"✅ **Депозит успешен!**\n\n"
+                        f"💎 Получено: {amount_xtr} XTR\n"
+                        f"⭐ Начислено: {stars_amount} звезд\n"
+                        f"💰 Новый баланс XTR: {payer.balance_xtr if payer else 0}\n\n"
+                        f"*Спасибо за пополнение!* 🖤"
+                    )
+                else:
+                    self.outbox.send(
+                        user_id,
+                        "❌ Ошибка обработки депозита. Обратитесь к администратору."
                     )
-                    
-                    if success:
-                        # Уведомляем пользователя
-                        exchange = await db.fetchone("SELECT stars_per_xtr FROM exchange_rates WHERE id = 1")
-                        stars_per_xtr = exchange['stars_per_xtr'] if exchange else 1000
-                        
-                        await self.bot.send_message(
-                            user_id,
-                            f"✅ **Депозит успешен!**\n\n"
-                            f"💎 Получено: {amount_xtr} XTR\n"
-                            f"⭐ Начислено: {amount_xtr * stars_per_xtr} звезд\n"
-                            f"💰 Новый баланс XTR: {await self.get_user_xtr_balance(user_id)}\n\n"
-                            f"*Спасибо за пополнение!* 🖤"
-                        )
-                    else:
-                        await self.bot.send_message(
-                            user_id,
-                            "❌ Ошибка обработки депозита. Обратитесь к администратору."
-                        )
             
-            elif payload.startswith("buy_stars_"):
+            elif payload.kind == XTRPayloadCodec.BUY_STARS:
                 # Обработка покупки звезд
-                parts = payload.split("_")
-                if len(parts) >= 5:
-                    user_id = int(parts[2])
-                    amount_stars = int(parts[3])
-                    amount_xtr = int(parts[4])
+                if result is XTRDepositResult.CREDITED:
+                    payer = await self.reload_payer(user_ctx, user_id)
                     
-                    success = await self.payment_system.process_deposit(
+                    self.outbox.send(
                         user_id,
-                        amount_xtr,
-                        payment.provider_payment_charge_id,
-                        payment.telegram_payment_charge_id
+                        f"✅ **Звезды куплены!**\n\n"
+                        f"⭐ Получено: {stars_amount} звезд\n"
+                        f"💎 Зачислено на баланс: {amount_xtr} XTR\n"
+                        f"💰 Новый баланс звезд: {payer.balance_stars if payer else 0}\n\n"
+                        f"*Спасибо за покупку!* ✨"
                     )
-                    
-                    if success:
-                        await self.bot.send_message(
-                            user_id,
-                            f"✅ **Звезды куплены!**\n\n"
-                            f"⭐ Получено: {amount_stars} звезд\n"
-                            f"💎 Потрачено: {amount_xtr} XTR\n"
-                            f"💰 Новый баланс звезд: {await self.get_user_stars_balance(user_id)}\n\n"
-                            f"*Спасибо за покупку!* ✨"
-                        )
             
             # Подтверждаем получение платежа
             await message.answer("✅ Платеж успешно обработан!")
@@ -1515,6 +5683,12 @@ class XTRBot:
             logger.error(f"Ошибка обработки платежа: {e}")
             await message.answer("❌ Ошибка обработки платежа")
     
+    async def reload_payer(self, user_ctx: XTRUserContext, user_id: int) -> Optional[XTRUser]:
+        """Пользователь после зачисления платежа (одно чтение после записи)"""
+        ctx = user_ctx if user_ctx.user_id == user_id else XTRUserContext(user_id)
+        ctx.invalidate()
+        return await ctx.get()
+    
     async def get_user_xtr_balance(self, user_id: int) -> int:
         """Получить баланс XTR пользователя"""
         user = await db.fetchone(
@@ -1553,8 +5727,15 @@ class XTRBot:
                         await callback.answer("❌ Неверная сумма")
             
             elif data.startswith("check_deposit_"):
-                await callback.answer("✅ Проверка платежа...")
-                # Здесь можно реализовать проверку статуса платежа
+                try:
+                    key = invoices.key(data[len("check_deposit_"):], callback.from_user.id)
+                except XTRPayloadError:
+                    await callback.answer("❌ Неизвестный счет", show_alert=True)
+                    return
+                
+                invoice = await invoices.get(key)
+                await callback.answer(self.invoice_status_text(invoice), show_alert=True)
+                return
             
             await callback.answer()
             
@@ -1562,7 +5743,24 @@ class XTRBot:
             logger.error(f"Ошибка в handle_deposit_callback: {e}")
             await callback.answer("❌ Ошибка обработки")
     
-    async def handle_nft_callback(self, callback: CallbackQuery):
+    @staticmethod
+    def invoice_status_text(invoice: Optional[XTRPendingInvoice]) -> str:
+        """Ответ кнопки проверки оплаты"""
+        if invoice is None:
+            return "❌ Счет не найден. Создайте новый: /deposit"
+        if invoice.state == 'paid':
+            return f"✅ Счет на {invoice.amount_xtr} XTR оплачен и зачислен"
+        if invoice.state == 'failed':
+            return "❌ Превышено число попыток оплаты. Создайте новый счет: /deposit"
+        
+        left = int(invoice.expires_at - time.time())
+        if invoice.state == 'expired' or left <= 0:
+            return "⌛ Счет истек. Создайте новый: /deposit"
+        if invoice.state == 'pre_checked':
+            return "⏳ Платеж подтвержден, ожидаем зачисление"
+        return f"⏳ Ожидает оплаты: {invoice.amount_xtr} XTR, осталось {left // 60} мин {left % 60} с"
+    
+    async def handle_nft_callback(self, callback: CallbackQuery, user_ctx: XTRUserContext):
         """Обработка callback для NFT"""
         try:
             data = callback.data
@@ -1570,34 +5768,37 @@ class XTRBot:
             if data == "nft_shop_menu":
                 await self.handle_nft_shop(callback.message)
             
+            elif data == "nft_sell_menu":
+                await self.handle_sell_menu(callback.message, user_ctx.user_id)
+            
+            elif data == "nft_marketplace":
+                await self.handle_market(callback.message, user_ctx.user_id)
+            
             elif data.startswith("nft_buy_"):
                 parts = data.split("_")
                 if len(parts) >= 4:
                     payment_type = parts[2]  # xtr или stars
                     nft_id = int(parts[3])
                     
-                    user_id = callback.from_user.id
+                    user_id = user_ctx.user_id
                     
                     # Получаем информацию о NFT
-                    nft = await db.fetchone(
-                        "SELECT * FROM nft_items WHERE id = ?",
-                        (nft_id,)
-                    )
+                    nft = await db.fetchone(XTRQueries.NFT_ITEM, (nft_id,))
                     
                     if not nft:
                         await callback.answer("❌ NFT не найден")
                         return
                     
+                    # Свежий остаток из БД: до резерва в nft_stock
+                    nft_stock.set_stock(nft_id, nft['stock'])
+                    
                     if payment_type == "xtr":
                         price = nft['price_xtr']
                         
                         # Проверяем баланс
-                        user = await db.fetchone(
-                            "SELECT balance_xtr FROM users WHERE user_id = ?",
-                            (user_id,)
-                        )
+                        user = await user_ctx.get()
                         
-                        if not user or user['balance_xtr'] < price:
+                        if not user or user.balance_xtr < price:
                             await callback.answer("❌ Недостаточно XTR")
                             return
                         
@@ -1607,6 +5808,7 @@ class XTRBot:
                         )
                         
                         if success:
+                            user_ctx.invalidate()
                             await callback.message.answer(f"✅ {message}")
                         else:
                             await callback.message.answer(f"❌ {message}")
@@ -1615,12 +5817,9 @@ class XTRBot:
                         price = nft['price_stars']
                         
                         # Проверяем баланс
-                        user = await db.fetchone(
-                            "SELECT balance_stars FROM users WHERE user_id = ?",
-                            (user_id,)
-                        )
+                        user = await user_ctx.get()
                         
-                        if not user or user['balance_stars'] < price:
+                        if not user or user.balance_stars < price:
                             await callback.answer("❌ Недостаточно звезд")
                             return
                         
@@ -1630,6 +5829,7 @@ class XTRBot:
                         )
                         
                         if success:
+                            user_ctx.invalidate()
                             await callback.message.answer(f"✅ {message}")
                         else:
                             await callback.message.answer(f"❌ {message}")
@@ -1640,47 +5840,146 @@ class XTRBot:
             logger.error(f"Ошибка в handle_nft_callback: {e}")
             await callback.answer("❌ Ошибка обработки")
     
-    async def handle_withdraw_callback(self, callback: CallbackQuery):
+    async def render_leaderboard(self, user_ctx: XTRUserContext, board: str, page: int) -> Tuple[str, InlineKeyboardMarkup]:
+        """Текст и клавиатура страницы таблицы лидеров"""
+        page_size = XTRConfig.LEADERBOARD_PAGE_SIZE
+        total = await leaderboard.total(board)
+        pages = max(1, (total + page_size - 1) // page_size)
+        page = min(max(0, page), pages - 1)
+        
+        entries = await leaderboard.page(board, page * page_size, page_size)
+        my_rank, my_score = await leaderboard.rank(board, user_ctx.user_id)
+        
+        text = f"📊 **ТАБЛИЦА ЛИДЕРОВ** - {XTRLeaderboard.BOARDS[board]}\n\n"
+        if not entries:
+            text += "Пока пусто - станьте первым!\n"
+        for entry in entries:
+            medal = {1: "🥇", 2: "🥈", 3: "🥉"}.get(entry['rank'], f"{entry['rank']}.")
+            name = entry['name'] or f"id{entry['user_id']}"
+            text += f"{medal} {name} - {entry['score']}\n"
+        text += f"\n🎯 Ваше место: #{my_rank} ({my_score})\n"
+        text += f"📄 Страница {page + 1} из {pages}"
+        
+        keyboard = InlineKeyboardBuilder()
+        for name, title in XTRLeaderboard.BOARDS.items():
+            keyboard.button(text=title, callback_data=f"leaderboard_{name}_0")
+        if page > 0:
+            keyboard.button(text="⬅️", callback_data=f"leaderboard_{board}_{page - 1}")
+        if page < pages - 1:
+            keyboard.button(text="➡️", callback_data=f"leaderboard_{board}_{page + 1}")
+        keyboard.adjust(2, 2, 2)
+        
+        return text, keyboard.as_markup()
+    
+    async def send_leaderboard(self, message: Message, user_ctx: XTRUserContext, board: str, page: int):
+        """Отправить таблицу лидеров новым сообщением"""
+        try:
+            text, markup = await self.render_leaderboard(user_ctx, board, page)
+            await message.answer(text, reply_markup=markup)
+        except Exception as e:
+            logger.error(f"Ошибка в send_leaderboard: {e}")
+            await message.answer("❌ Ошибка загрузки таблицы лидеров")
+    
+    async def handle_leaderboard_callback(self, callback: CallbackQuery, user_ctx: XTRUserContext):
+        """Обработка callback таблицы лидеров"""
+        try:
+            data = callback.data
+            
+            if data == "leaderboard_menu":
+                await self.send_leaderboard(callback.message, user_ctx, 'deposits', 0)
+            else:
+                parts = data.split("_")
+                if len(parts) == 3 and parts[1] in XTRLeaderboard.BOARDS and parts[2].isdigit():
+                    text, markup = await self.render_leaderboard(user_ctx, parts[1], int(parts[2]))
+                    await callback.message.edit_text(text, reply_markup=markup)
+            
+            await callback.answer()
+        
+        except Exception as e:
+            logger.error(f"Ошибка в handle_leaderboard_callback: {e}")
+            await callback.answer("❌ Ошибка обработки")
+    
+    HISTORY_TITLES = {'xtr': "💎 XTR", 'stars': "⭐ Звезды", 'withdrawals': "💸 Выводы"}
+    WITHDRAWAL_STATUS_EMOJI = {
+        'pending': '🔄',
+        'processing': '⏳',
+        'completed': '✅',
+        'rejected': '❌',
+        'cancelled': '🚫'
+    }
+    
+    async def render_history(self, user_id: int, source: str, cursor: Optional[str]) -> Tuple[str, InlineKeyboardMarkup]:
+        """Текст (HTML: типы вроде market_bid ломают Markdown) и клавиатура страницы истории"""
+        items, next_cursor = await history.page(source, user_id, cursor, XTRConfig.HISTORY_PAGE_SIZE)
+        
+        text = f"📜 <b>ИСТОРИЯ</b> - {self.HISTORY_TITLES[source]}\n\n"
+        if not items:
+            text += "📭 Операций нет\n" if not cursor else "Больше операций нет\n"
+        for item in items:
+            if source == 'withdrawals':
+                emoji = self.WITHDRAWAL_STATUS_EMOJI.get(item['status'], '❓')
+                text += (
+                    f"{emoji} Заявка #{item['id']}: {item['amount']} XTR "
+                    f"(комиссия {item['fee']}, к получению {item['net_amount']}) - {html.quote(item['status'])}\n"
+                    f"📅 {html.quote(item['created_at'][:16])}\n"
+                )
+            else:
+                emoji = "⬆️" if item['amount'] >= 0 else "⬇️"
+                unit = "XTR" if source == 'xtr' else "⭐"
+                status = f" ({html.quote(item['status'])})" if source == 'xtr' and item['status'] != 'completed' else ""
+                text += (
+                    f"{emoji} {html.quote(item['type'])}: {item['amount']} {unit}{status} - "
+                    f"{html.quote(item['created_at'][:16])}\n"
+                )
+        
+        keyboard = InlineKeyboardBuilder()
+        for name, title in self.HISTORY_TITLES.items():
+            keyboard.button(text=title, callback_data=f"history_{name}_")
+        if cursor:
+            keyboard.button(text="⏮ В начало", callback_data=f"history_{source}_")
+        if next_cursor:
+            keyboard.button(text="➡️ Дальше", callback_data=f"history_{source}_{next_cursor}")
+        keyboard.adjust(3, 2)
+        
+        return text, keyboard.as_markup()
+    
+    async def send_history(self, message: Message, user_id: int, source: str):
+        """Отправить первую страницу истории новым сообщением"""
+        try:
+            text, markup = await self.render_history(user_id, source, None)
+            await message.answer(text, reply_markup=markup, parse_mode=ParseMode.HTML)
+        except Exception as e:
+            logger.error(f"Ошибка в send_history: {e}")
+            await message.answer("❌ Ошибка загрузки истории")
+    
+    async def handle_history_callback(self, callback: CallbackQuery):
+        """Обработка callback истории: history_<источник>_<курсор>"""
+        try:
+            parts = callback.data.split("_", 2)
+            if len(parts) == 3 and parts[1] in XTRHistory.SOURCES:
+                try:
+                    text, markup = await self.render_history(callback.from_user.id, parts[1], parts[2] or None)
+                except XTRCursorError:
+                    await callback.answer("❌ Страница устарела")
+                    return
+                await callback.message.edit_text(text, reply_markup=markup, parse_mode=ParseMode.HTML)
+            
+            await callback.answer()
+        
+        except Exception as e:
+            logger.error(f"Ошибка в handle_history_callback: {e}")
+            await callback.answer("❌ Ошибка обработки")
+    
+    async def handle_withdraw_callback(self, callback: CallbackQuery, user_ctx: XTRUserContext):
         """Обработка callback для выводов"""
         try:
             data = callback.data
             
             if data == "withdraw_menu":
-                await self.handle_withdraw(callback.message, None)
+                await self.handle_withdraw(callback.message, None, user_ctx)
             
             elif data == "withdraw_requests":
-                user_id = callback.from_user.id
-                
-                withdrawals = await db.fetchall('''
-                    SELECT * FROM withdrawals 
-                    WHERE user_id = ? 
-                    ORDER BY created_at DESC 
-                    LIMIT 10
-                ''', (user_id,))
-                
-                if not withdrawals:
-                    await callback.message.answer("📭 У вас нет заявок на вывод")
-                    return
-                
-                text = "📋 **ВАШИ ЗАЯВКИ НА ВЫВОД**\n\n"
-                
-                for w in withdrawals:
-                    status_emoji = {
-                        'pending': '🔄',
-                        'processing': '⏳',
-                        'completed': '✅',
-                        'rejected': '❌',
-                        'cancelled': '🚫'
-                    }.get(w['status'], '❓')
-                    
-                    text += f"{status_emoji} Заявка #{w['id']}\n"
-                    text += f"💰 Сумма: {w['amount']} XTR\n"
-                    text += f"💸 Комиссия: {w['fee']} XTR\n"
-                    text += f"🎯 К получению: {w['net_amount']} XTR\n"
-                    text += f"📅 Дата: {w['created_at'][:10]}\n"
-                    text += f"📝 Статус: {w['status']}\n\n"
-                
-                await callback.message.answer(text)
+                await self.send_history(callback.message, user_ctx.user_id, 'withdrawals')
             
             await callback.answer()
             
@@ -1700,7 +5999,10 @@ class XTRBot:
             BotCommand(command="balance", description="💰 Мой баланс"),
             BotCommand(command="nft_shop", description="🛒 Магазин NFT"),
             BotCommand(command="my_nfts", description="🎒 Мои NFT"),
+            BotCommand(command="market", description="🎯 Торговая площадка"),
             BotCommand(command="exchange", description="💱 Курс обмена"),
+            BotCommand(command="leaderboard", description="📊 Таблица лидеров"),
+            BotCommand(command="history", description="📜 История операций"),
             BotCommand(command="help", description="❓ Помощь"),
         ]
         
@@ -1709,8 +6011,22 @@ class XTRBot:
         
         await self.bot.set_my_commands(commands)
         
-        # Запускаем бота
-        await self.dp.start_polling(self.bot)
+        # Ссылки на оплату фиксированных сумм
+        self.invoice_links.start()
+        
+        if XTRConfig.BOT_MODE == 'webhook':
+            # Апдейты принимает XTRWebApp, обработчики разбирают очередь
+            await self.bot.set_webhook(
+                url=XTRConfig.WEBHOOK_URL.rstrip('/') + XTRConfig.WEBHOOK_PATH,
+                secret_token=XTRConfig.WEBHOOK_SECRET,
+                allowed_updates=self.dp.resolve_used_update_types()
+            )
+            logger.info(f"Webhook mode: {XTRConfig.WEBHOOK_WORKERS} workers")
+            await self.ingestor.run()
+        else:
+            # Запускаем бота
+            await self.bot.delete_webhook()
+            await self.dp.start_polling(self.bot)
 
 # ============================================================================
 # ВЕБ-ИНТЕРФЕЙС XTR
@@ -1757,13 +6073,76 @@ class XTRWebApp:
         async def get_balance(user_id: int):
             return await self.api_get_balance(user_id)
         
+        @self.app.get("/api/leaderboard")
+        async def get_leaderboard(board: str = 'deposits', page: int = 1, per_page: int = 50,
+                                  user_id: Optional[int] = None):
+            return await self.api_get_leaderboard(board, page, per_page, user_id)
+        
+        @self.app.get("/api/transactions/{user_id}")
+        async def get_transactions(user_id: int, currency: str = 'xtr', cursor: Optional[str] = None,
+                                   limit: int = 20, type: Optional[str] = None, status: Optional[str] = None):
+            if currency not in ('xtr', 'stars'):
+                raise HTTPException(status_code=400, detail="Unknown currency, expected one of: xtr, stars")
+            return await self.api_get_history(currency, user_id, cursor, limit, type=type, status=status)
+        
+        @self.app.get("/api/withdrawals/{user_id}")
+        async def get_withdrawals(user_id: int, cursor: Optional[str] = None, limit: int = 20,
+                                  status: Optional[str] = None):
+            return await self.api_get_history('withdrawals', user_id, cursor, limit, status=status)
+        
         @self.app.get("/api/nfts")
         async def get_nfts():
             return await self.api_get_nfts()
         
+        if XTRConfig.BOT_MODE == 'webhook':
+            @self.app.post(XTRConfig.WEBHOOK_PATH)
+            async def telegram_webhook(request: Request):
+                return await self.handle_webhook(request)
+        
+        @self.app.get("/metrics")
+        async def metrics_endpoint():
+            return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+        
         @self.app.get("/health")
         async def health_check():
-            return {"status": "healthy", "version": "5.0.0", "currency": "XTR"}
+            return {
+                "status": "healthy",
+                "version": "5.0.0",
+                "currency": "XTR",
+                "db_pool": db.pool_stats(),
+                "db_writer": db.writer_stats(),
+                "nft_stock": nft_stock.stats(),
+                "market": market.stats(),
+                "referrals": referrals.stats(),
+                "charges": charges.stats(),
+                "invoice_links": self.bot.invoice_links.stats(),
+                "invoices": invoices.stats(),
+                "activity": activity.stats(),
+                "profiles": profiles.stats(),
+                "user_loads": XTRUserContext.loads_total,
+                "webhook": self.bot.ingestor.stats(),
+                "outbox": self.bot.outbox.stats(),
+                "fsm": self.bot.storage.stats(),
+                "log": XTRLogger.stats()
+            }
+    
+    async def handle_webhook(self, request: Request):
+        """Webhook: проверить секрет и поставить апдейт в очередь"""
+        secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secret.encode(), XTRConfig.WEBHOOK_SECRET.encode()):
+            raise HTTPException(status_code=403, detail="Forbidden")
+        
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot.bot})
+        except Exception as e:
+            logger.warning(f"Некорректный апдейт: {e}")
+            raise HTTPException(status_code=400, detail="Bad update")
+        
+        if not self.bot.ingestor.submit(update):
+            # Очередь полна - Telegram повторит доставку
+            return JSONResponse(status_code=503, content={"ok": False, "detail": "Overloaded"})
+        
+        return {"ok": True}
     
     async def get_homepage(self) -> str:
         """Главная страница"""
@@ -1952,13 +6331,7 @@ class XTRWebApp:
     async def api_get_user(self, user_id: int):
         """API: Получить данные пользователя"""
         try:
-            user = await db.fetchone('''
-                SELECT u.*, 
-                       (SELECT COUNT(*) FROM nft_ownership WHERE user_id = u.user_id) as nft_count,
-                       (SELECT SUM(amount) FROM xtr_transactions WHERE user_id = u.user_id AND type = 'deposit') as total_deposited
-                FROM users u 
-                WHERE user_id = ?
-            ''', (user_id,))
+            user = await db.fetchone(XTRQueries.API_USER, (user_id,))
             
             if not user:
                 raise HTTPException(status_code=404, detail="User not found")
@@ -1998,14 +6371,53 @@ class XTRWebApp:
             logger.error(f"API error in get_balance: {e}")
             raise HTTPException(status_code=500, detail="Internal server error")
     
+    async def api_get_history(self, source: str, user_id: int, cursor: Optional[str], limit: int,
+                              **filters: Optional[str]):
+        """API: История пользователя (keyset-пагинация, next_cursor - следующая страница)"""
+        try:
+            items, next_cursor = await history.page(source, user_id, cursor, limit, **filters)
+        except XTRCursorError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        except Exception as e:
+            logger.error(f"API error in get_history ({source}): {e}")
+            raise HTTPException(status_code=500, detail="Internal server error")
+        
+        return {
+            "user_id": user_id,
+            "items": items,
+            "next_cursor": next_cursor
+        }
+    
+    async def api_get_leaderboard(self, board: str, page: int, per_page: int, user_id: Optional[int]):
+        """API: Таблица лидеров (постранично)"""
+        if board not in XTRLeaderboard.BOARDS:
+            raise HTTPException(status_code=400, detail=f"Unknown board, expected one of: {', '.join(XTRLeaderboard.BOARDS)}")
+        
+        page = max(1, page)
+        per_page = min(max(1, per_page), 100)
+        
+        try:
+            result = {
+                "board": board,
+                "page": page,
+                "per_page": per_page,
+                "total": await leaderboard.total(board),
+                "entries": await leaderboard.page(board, (page - 1) * per_page, per_page)
+            }
+            
+            if user_id is not None:
+                rank, score = await leaderboard.rank(board, user_id)
+                result["user"] = {"user_id": user_id, "rank": rank, "score": score}
+            
+            return result
+        except Exception as e:
+            logger.error(f"API error in get_leaderboard: {e}")
+            raise HTTPException(status_code=500, detail="Internal server error")
+    
     async def api_get_nfts(self):
         """API: Получить список NFT"""
         try:
-            nfts = await db.fetchall('''
-                SELECT * FROM nft_items 
-                WHERE available = 1 
-                ORDER BY price_xtr ASC
-            ''')
+            nfts = await db.fetchall(XTRQueries.NFT_SHOP)
             
             return {
                 "nfts": [
@@ -2043,15 +6455,47 @@ class XTRWebApp:
 
 async def main():
     """Главная функция запуска"""
+    bot = None
     try:
         logger.info("=" * 60)
         logger.info("🖤 STARTING GOLDEN COBRA XTR v5.0 🖤")
         logger.info("=" * 60)
         
+        # Проверяем планы запросов
+        for violation in await db.check_query_plans():
+            logger.warning(f"Полный скан таблицы: {violation}")
+        
+        # Сводная статистика для существующей истории
+        await rollups.bootstrap()
+        
+        # Окно отсева повторных платежей
+        await charges.load()
+        
+        # Открытые инвойсы
+        await invoices.load()
+        
+        # Таблицы лидеров
+        await leaderboard.load()
+        
+        # Стаканы вторичного рынка (после таблиц лидеров: сведение обновляет их)
+        await market.load()
+        
         # Создаем экземпляры
         bot = XTRBot()
         web_app = XTRWebApp(bot)
         
+        # Пакетные реферальные выплаты
+        referrals.start(bot.notify_referral_payouts)
+        
+        # Истечение неоплаченных инвойсов
+        invoices.start()
+        
+        # Отложенная запись last_active
+        activity.start()
+        
+        # Замер лага цикла событий для /metrics
+        metrics.start()
+        
         # Запускаем параллельно
         await asyncio.gather(
             bot.start(),
@@ -2064,6 +6508,15 @@ async def main():
         logger.critical(f"Fatal error: {e}")
         raise
     finally:
+        await referrals.close()
+        await invoices.close()
+        await activity.close()
+        await metrics.close()
+        if bot is not None:
+            await bot.invoice_links.close()
+            await bot.outbox.close()
+            await bot.storage.close()
+        await db.close()
         logger.info("Golden Cobra XTR shutdown complete")
 
 if __name__ == "__main__":
@@ -2073,5 +6526,19 @@ if __name__ == "__main__":
         f"Uncaught exception: {exc_type.__name__}: {exc_value}"
     )
     
+    # Проверка планов запросов (для CI): код возврата 1 при полном скане
+    if "--check-query-plans" in sys.argv:
+        async def check_plans():
+            try:
+                return await db.check_query_plans()
+            finally:
+                await db.close()
+        
+        violations = asyncio.run(check_plans())
+        for violation in violations:
+            print(f"PLAN: {violation}")
+        print(f"{len(db.QUERY_PLAN_SUITE)} queries checked, {len(violations)} violations")
+        sys.exit(1 if violations else 0)
+    
     # Запуск
     asyncio.run(main())
@@ -0,0 +1,644 @@
+#!/usr/bin/env python3
+"""
+🖤 GOLDEN COBRA XTR - НАГРУЗОЧНЫЙ ТЕСТ 🖤
+Прогон синтетических апдейтов через Dispatcher.feed_update без сети.
+
+Bot API заменяется локальной сессией aiogram (XTRFakeSession), база -
+временным файлом. Сценарии: шторм /start, воронка пополнения, дроп NFT,
+страницы истории, рынок NFT, статистика админа под нагрузкой. Отчет: апдейтов в секунду и p50/p99
+по каждому обработчику; сравнение с loadtest_baseline.json.
+
+    python loadtest.py                      # прогон и сравнение с базовой линией
+    python loadtest.py --save-baseline      # записать новую базовую линию
+    python loadtest.py --scenario start_storm --users 2000 --concurrency 64
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import shutil
+import asyncio
+import tempfile
+import argparse
+import platform
+from html.parser import HTMLParser
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# Окружение задается до импорта bot: БД, логи, токен и админ берутся при импорте
+_TMP_DIR = tempfile.mkdtemp(prefix="xtr_loadtest_")
+atexit.register(shutil.rmtree, _TMP_DIR, ignore_errors=True)
+LOADTEST_ADMIN_ID = 1
+os.environ['DB_FILE'] = os.path.join(_TMP_DIR, 'loadtest.db')
+os.environ['LOGS_DIR'] = os.path.join(_TMP_DIR, 'logs')
+os.environ['BOT_TOKEN'] = '123456789:LOADTEST-fake-token-not-for-telegram'
+os.environ['ADMIN_IDS'] = str(LOADTEST_ADMIN_ID)
+os.environ['BOT_MODE'] = 'polling'
+os.environ.setdefault('STARS_PROVIDER_TOKEN', 'loadtest')
+
+from aiogram import BaseMiddleware
+from aiogram.client.default import Default
+from aiogram.client.session.base import BaseSession
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods.base import Response, TelegramMethod
+from aiogram.types import Message, TelegramObject, Update
+
+import bot as app
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'loadtest_baseline.json')
+
+# ============================================================================
+# ЛОКАЛЬНЫЙ BOT API
+# ============================================================================
+
+class XTRHtmlEntityCheck(HTMLParser):
+    """Разбор HTML-разметки по правилам Bot API: только поддерживаемые теги, все закрыты"""
+    
+    TAGS = {'b', 'strong', 'i', 'em', 'u', 'ins', 's', 'strike', 'del', 'a', 'code', 'pre',
+            'tg-spoiler', 'tg-emoji', 'span', 'blockquote'}
+    
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack: List[str] = []
+    
+    def handle_starttag(self, tag, attrs):
+        if tag not in self.TAGS:
+            raise ValueError(f"Unsupported start tag \"{tag}\"")
+        self.stack.append(tag)
+    
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack.pop() != tag:
+            raise ValueError(f"Unmatched end tag \"{tag}\"")
+    
+    @classmethod
+    def check(cls, text: str):
+        parser = cls()
+        parser.feed(text)
+        parser.close()
+        if parser.stack:
+            raise ValueError(f"Can't find end tag corresponding to start tag \"{parser.stack[-1]}\"")
+
+
+def check_markdown(text: str):
+    """Разбор legacy Markdown как в Bot API: у каждой сущности должен быть конец"""
+    index = 0
+    while index < len(text):
+        char = text[index]
+        if char == '\\':
+            index += 2
+            continue
+        if char in '*_`[':
+            if char == '`' and text.startswith('```', index):
+                end = text.find('```', index + 3)
+                width = 3
+            elif char == '[':
+                end = text.find(']', index + 1)
+                width = 1
+            else:
+                end = text.find(char, index + 1)
+                width = 1
+            if end < 0:
+                raise ValueError(f"Can't find end of the entity starting at byte offset {len(text[:index].encode('utf-16-le')) // 2}")
+            index = end + width
+            continue
+        index += 1
+
+
+class XTRFakeSession(BaseSession):
+    """Сессия aiogram, отвечающая на методы Bot API локально с задержкой latency"""
+    
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self._message_id = 0
+        self._calls: Dict[str, int] = {}
+        self.rejected: List[str] = []
+    
+    def _result(self, bot, method: TelegramMethod) -> Any:
+        """Сырой результат метода в формате ответа Bot API"""
+        returning = getattr(method.__returning__, '__args__', None) or (method.__returning__,)
+        name = type(method).__name__
+        
+        if name == 'GetMe':
+            return {"id": bot.id, "is_bot": True, "first_name": "XTR LoadTest", "username": "xtr_loadtest_bot"}
+        if name == 'CreateInvoiceLink':
+            return f"https://t.me/$loadtest{self._message_id}"
+        
+        chat_id = getattr(method, 'chat_id', None)
+        if Message in returning and chat_id is not None:
+            self._message_id += 1
+            return {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": bot.id, "is_bot": True, "first_name": "XTR LoadTest"},
+                "text": getattr(method, 'text', None) or "loadtest",
+            }
+        if bool in returning:
+            return True
+        if str in returning:
+            return "loadtest"
+        return []
+    
+    def _check_entities(self, bot, method: TelegramMethod):
+        """Разметка текста разбирается как в Telegram: ошибка - 400 can't parse entities"""
+        text = getattr(method, 'text', None) or getattr(method, 'caption', None)
+        parse_mode = getattr(method, 'parse_mode', None)
+        if isinstance(parse_mode, Default):
+            parse_mode = bot.default[parse_mode.name]
+        if not text or not parse_mode:
+            return
+        try:
+            if parse_mode == ParseMode.HTML:
+                XTRHtmlEntityCheck.check(text)
+            elif parse_mode == ParseMode.MARKDOWN:
+                check_markdown(text)
+        except ValueError as e:
+            self.rejected.append(f"{type(method).__name__}: {e}")
+            raise TelegramBadRequest(method=method, message=f"Bad Request: can't parse entities: {e}")
+    
+    async def make_request(self, bot, method: TelegramMethod, timeout: Optional[int] = None) -> Any:
+        name = type(method).__name__
+        self._calls[name] = self._calls.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self._check_entities(bot, method)
+        
+        response = Response[method.__returning__].model_validate(
+            {"ok": True, "result": self._result(bot, method)},
+            context={"bot": bot}
+        )
+        return response.result
+    
+    async def stream_content(self, url: str, headers=None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True):
+        yield b""
+    
+    async def close(self):
+        pass
+    
+    def stats(self) -> Dict[str, int]:
+        return dict(sorted(self._calls.items()))
+
+
+class XTRTimingMiddleware(BaseMiddleware):
+    """Inner middleware: сырые замеры времени обработчиков для перцентилей"""
+    
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+    
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object is not None else 'unknown'
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.samples.setdefault(name, []).append(time.perf_counter() - started)
+    
+    def reset(self):
+        self.samples = {}
+
+# ============================================================================
+# СИНТЕТИЧЕСКИЕ АПДЕЙТЫ
+# ============================================================================
+
+class XTRUpdateFactory:
+    """Апдейты в формате Bot API с уникальными update_id"""
+    
+    def __init__(self):
+        self._update_id = 0
+        self._charge_id = 0
+    
+    def _next(self) -> int:
+        self._update_id += 1
+        return self._update_id
+    
+    @staticmethod
+    def _user(user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": f"Load{user_id}", "username": f"load{user_id}"}
+    
+    def _message(self, user_id: int, **fields) -> Dict[str, Any]:
+        return {
+            "message_id": self._update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            **fields,
+        }
+    
+    def command(self, user_id: int, text: str) -> Update:
+        update_id = self._next()
+        entity = {"type": "bot_command", "offset": 0, "length": len(text.split()[0])}
+        return Update.model_validate({
+            "update_id": update_id,
+            "message": self._message(user_id, text=text, entities=[entity]),
+        })
+    
+    def callback(self, user_id: int, data: str) -> Update:
+        update_id = self._next()
+        return Update.model_validate({
+            "update_id": update_id,
+            "callback_query": {
+                "id": f"lt{update_id}",
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": self._message(user_id, text="menu"),
+            },
+        })
+    
+    def pre_checkout(self, user_id: int, payload: str, amount: int) -> Update:
+        update_id = self._next()
+        return Update.model_validate({
+            "update_id": update_id,
+            "pre_checkout_query": {
+                "id": f"lt{update_id}",
+                "from": self._user(user_id),
+                "currency": app.XTRConfig.STARS_CURRENCY,
+                "total_amount": amount,
+                "invoice_payload": payload,
+            },
+        })
+    
+    def payment(self, user_id: int, payload: str, amount: int) -> Update:
+        update_id = self._next()
+        self._charge_id += 1
+        return Update.model_validate({
+            "update_id": update_id,
+            "message": self._message(user_id, successful_payment={
+                "currency": app.XTRConfig.STARS_CURRENCY,
+                "total_amount": amount,
+                "invoice_payload": payload,
+                "telegram_payment_charge_id": f"loadtest-{self._charge_id}",
+                "provider_payment_charge_id": "",
+            }),
+        })
+
+# ============================================================================
+# СЦЕНАРИИ
+# ============================================================================
+# Сценарий - список фаз, фаза - список потоков, поток - апдейты одного
+# пользователя по порядку. Потоки фазы идут параллельно, фазы - по очереди.
+
+Flow = List[Update]
+Phase = List[Flow]
+
+
+async def scenario_start_storm(xtr: app.XTRBot, factory: XTRUpdateFactory, users: List[int]) -> List[Phase]:
+    """Шторм /start: новые пользователи, каждый пятый по реферальной ссылке"""
+    flows = []
+    for index, user_id in enumerate(users):
+        text = f"/start ref_{users[0]}" if index and index % 5 == 0 else "/start"
+        flows.append([factory.command(user_id, text)])
+    return [flows]
+
+
+async def scenario_deposit_funnel(xtr: app.XTRBot, factory: XTRUpdateFactory, users: List[int]) -> List[Phase]:
+    """Воронка пополнения: меню, ссылка из кэша, pre-checkout, платеж, баланс"""
+    amount = app.XTRConfig.DEPOSIT_PRESETS[0]
+    flows = []
+    for user_id in users:
+        _, payload = await xtr.invoice_links.get(user_id, amount)
+        flows.append([
+            factory.command(user_id, "/start"),
+            factory.callback(user_id, "deposit_menu"),
+            factory.command(user_id, f"/deposit {amount}"),
+            factory.pre_checkout(user_id, payload, amount),
+            factory.payment(user_id, payload, amount),
+            factory.command(user_id, "/balance"),
+        ])
+    return [flows]
+
+
+async def scenario_nft_drop(xtr: app.XTRBot, factory: XTRUpdateFactory, users: List[int]) -> List[Phase]:
+    """Дроп NFT: пополнение, затем одновременная покупка одного предмета"""
+    nft = await app.db.fetchone("SELECT id, price_xtr FROM nft_items ORDER BY price_xtr LIMIT 1")
+    amount = max(nft['price_xtr'], app.XTRConfig.MIN_STARS_PURCHASE)
+    
+    funding = []
+    for user_id in users:
+        payload = app.invoice_payloads.encode(app.XTRPayloadCodec.DEPOSIT, user_id, amount)
+        funding.append([factory.command(user_id, "/start"), factory.payment(user_id, payload, amount)])
+    
+    drop = [[factory.callback(user_id, f"nft_buy_xtr_{nft['id']}")] for user_id in users]
+    return [funding, drop]
+
+
+async def scenario_history_pages(xtr: app.XTRBot, factory: XTRUpdateFactory, users: List[int]) -> List[Phase]:
+    """История: две страницы звезд с операциями рынка (market_* ломали Markdown) и выводы"""
+    page_size = app.XTRConfig.HISTORY_PAGE_SIZE
+    kinds = ('market_bid', 'market_refund', 'market_sale', 'purchase')
+    
+    async def job(conn):
+        for user_id in users:
+            await conn.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)", (user_id, f"load{user_id}"))
+        await conn.executemany(
+            "INSERT INTO star_transactions (user_id, amount, type, description) VALUES (?, ?, ?, ?)",
+            [(user_id, -100 if kind == 'market_bid' else 100, kind, f"Loadtest {kind}")
+             for user_id in users for kind in kinds * (page_size // len(kinds) + 2)]
+        )
+    
+    await app.db.write(job)
+    
+    flows = []
+    for user_id in users:
+        _, next_cursor = await app.history.page('stars', user_id, None, page_size)
+        flows.append([
+            factory.command(user_id, "/history"),
+            factory.callback(user_id, "history_stars_"),
+            factory.callback(user_id, f"history_stars_{next_cursor}"),
+            factory.callback(user_id, "withdraw_requests"),
+        ])
+    return [flows]
+
+
+async def scenario_market(xtr: app.XTRBot, factory: XTRUpdateFactory, users: List[int]) -> List[Phase]:
+    """Рынок: половина продает NFT, половина ставит заявки по той же цене; подсказки с /cancel_bid ломали Markdown"""
+    nft = await app.db.fetchone("SELECT id, price_stars FROM nft_items ORDER BY price_stars LIMIT 1")
+    price = nft['price_stars']
+    sellers, bidders = users[::2], users[1::2]
+    
+    async def job(conn):
+        for user_id in users:
+            await conn.execute(
+                "INSERT OR IGNORE INTO users (user_id, username, balance_stars) VALUES (?, ?, ?)",
+                (user_id, f"load{user_id}", price * 2)
+            )
+        await conn.executemany(
+            "INSERT OR IGNORE INTO nft_ownership (user_id, nft_id, purchase_price, purchase_type) VALUES (?, ?, ?, 'stars')",
+            [(user_id, nft['id'], price) for user_id in sellers]
+        )
+    
+    await app.db.write(job)
+    rows = await app.db.fetchall("SELECT id, user_id FROM nft_ownership WHERE nft_id = ?", (nft['id'],))
+    ownership = {row['user_id']: row['id'] for row in rows}
+    
+    flows = []
+    for user_id in sellers:
+        flows.append([
+            factory.command(user_id, "/market"),
+            factory.callback(user_id, "nft_sell_menu"),
+            factory.command(user_id, f"/sell {ownership[user_id]} {price}"),
+            factory.command(user_id, "/market"),
+        ])
+    for user_id in bidders:
+        flows.append([
+            factory.command(user_id, "/market"),
+            factory.callback(user_id, "nft_sell_menu"),
+            factory.command(user_id, "/sell"),
+            factory.command(user_id, f"/bid {nft['id']} {price}"),
+            factory.command(user_id, "/market"),
+        ])
+    return [flows]
+
+
+async def scenario_admin_stats(xtr: app.XTRBot, factory: XTRUpdateFactory, users: List[int]) -> List[Phase]:
+    """Статистика админа на фоне шторма /start: каждый десятый поток - /admin stats"""
+    flows = []
+    for index, user_id in enumerate(users):
+        flows.append([factory.command(user_id, "/start")])
+        if index % 10 == 0:
+            flows.append([factory.command(LOADTEST_ADMIN_ID, "/admin stats")])
+    return [flows]
+
+
+SCENARIOS = {
+    'start_storm': scenario_start_storm,
+    'deposit_funnel': scenario_deposit_funnel,
+    'nft_drop': scenario_nft_drop,
+    'history_pages': scenario_history_pages,
+    'market': scenario_market,
+    'admin_stats': scenario_admin_stats,
+}
+
+# ============================================================================
+# ПРОГОН И ОТЧЕТ
+# ============================================================================
+
+def percentile(samples: List[float], q: float) -> float:
+    """Перцентиль по ближайшему рангу (samples отсортирован)"""
+    if not samples:
+        return 0.0
+    rank = max(0, min(len(samples) - 1, int(round(q * len(samples) + 0.5)) - 1))
+    return samples[rank]
+
+
+class XTRLoadRunner:
+    """Прогон сценариев через Dispatcher.feed_update с ограничением параллелизма"""
+    
+    def __init__(self, concurrency: int, api_latency: float):
+        self.concurrency = concurrency
+        self.session = XTRFakeSession(api_latency)
+        self.timing = XTRTimingMiddleware()
+        self.factory = XTRUpdateFactory()
+        self.xtr: Optional[app.XTRBot] = None
+        self._next_user = 10_000_000
+    
+    async def setup(self):
+        """Инициализация как в main(), но без polling и веб-сервера"""
+        await app.rollups.bootstrap()
+        await app.charges.load()
+        await app.invoices.load()
+        await app.leaderboard.load()
+        await app.market.load()
+        
+        self.xtr = app.XTRBot(session=self.session)
+        for observer in (self.xtr.router.message, self.xtr.router.callback_query, self.xtr.router.pre_checkout_query):
+            observer.middleware(self.timing)
+        await self.xtr.invoice_links.refresh()
+    
+    async def teardown(self):
+        if self.xtr is not None:
+            await self.xtr.invoice_links.close()
+            await self.xtr.outbox.close()
+            await self.xtr.storage.close()
+        await app.db.close()
+    
+    def _users(self, count: int) -> List[int]:
+        users = list(range(self._next_user, self._next_user + count))
+        self._next_user += count
+        return users
+    
+    async def _run_flows(self, flows: Phase, latencies: List[float]) -> int:
+        """Параллельный прогон потоков фазы, возвращает число ошибок"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        errors = 0
+        
+        async def run_flow(flow: Flow):
+            nonlocal errors
+            async with semaphore:
+                for update in flow:
+                    started = time.perf_counter()
+                    try:
+                        await self.xtr.dp.feed_update(self.xtr.bot, update)
+                    except Exception as e:
+                        errors += 1
+                        app.logger.error(f"Load test update {update.update_id} failed: {e}")
+                    latencies.append(time.perf_counter() - started)
+        
+        await asyncio.gather(*(run_flow(flow) for flow in flows))
+        return errors
+    
+    async def run(self, name: str, users: int) -> Dict[str, Any]:
+        """Один сценарий: апдейтов в секунду, ошибки, p50/p99 по обработчикам"""
+        phases = await SCENARIOS[name](self.xtr, self.factory, self._users(users))
+        self.timing.reset()
+        latencies: List[float] = []
+        errors = 0
+        rejected_before = len(self.session.rejected)
+        
+        started = time.perf_counter()
+        for phase in phases:
+            errors += await self._run_flows(phase, latencies)
+        elapsed = time.perf_counter() - started
+        
+        handlers = {}
+        for handler, samples in sorted(self.timing.samples.items()):
+            samples.sort()
+            handlers[handler] = {
+                "count": len(samples),
+                "p50_ms": round(percentile(samples, 0.50) * 1000, 3),
+                "p99_ms": round(percentile(samples, 0.99) * 1000, 3),
+            }
+        latencies.sort()
+        return {
+            "updates": len(latencies),
+            "errors": errors,
+            "rejected": len(self.session.rejected) - rejected_before,
+            "seconds": round(elapsed, 3),
+            "updates_per_sec": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+            "handlers": handlers,
+        }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float, floor_ms: float) -> List[str]:
+    """Регрессии относительно базовой линии: падение пропускной способности или рост p99"""
+    regressions = []
+    for name, current in results['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+        if not base:
+            continue
+        
+        if current['updates_per_sec'] < base['updates_per_sec'] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {current['updates_per_sec']} upd/s < {base['updates_per_sec']} upd/s"
+            )
+        
+        # Рост p99 меньше floor_ms считается шумом
+        for handler, stats in current['handlers'].items():
+            base_stats = base['handlers'].get(handler)
+            if not base_stats:
+                continue
+            limit = max(base_stats['p99_ms'] * (1 + tolerance), base_stats['p99_ms'] + floor_ms)
+            if stats['p99_ms'] > limit:
+                regressions.append(
+                    f"{name}/{handler}: p99 {stats['p99_ms']} ms > {base_stats['p99_ms']} ms"
+                )
+    return regressions
+
+
+def print_report(results: Dict[str, Any]):
+    for name, scenario in results['scenarios'].items():
+        print(
+            f"\n{name}: {scenario['updates']} updates in {scenario['seconds']}s, "
+            f"{scenario['updates_per_sec']} upd/s, p50 {scenario['p50_ms']} ms, "
+            f"p99 {scenario['p99_ms']} ms, errors {scenario['errors']}, "
+            f"rejected by Bot API {scenario['rejected']}"
+        )
+        for handler, stats in scenario['handlers'].items():
+            print(f"  {handler:<32} n={stats['count']:<6} p50 {stats['p50_ms']:>9} ms  p99 {stats['p99_ms']:>9} ms")
+    print(f"\nBot API calls: {results['api_calls']}")
+
+
+async def run_load_test(args) -> Dict[str, Any]:
+    runner = XTRLoadRunner(args.concurrency, args.api_latency / 1000)
+    try:
+        await runner.setup()
+        names = list(SCENARIOS) if args.scenario == 'all' else [args.scenario]
+        scenarios = {}
+        for name in names:
+            scenarios[name] = await runner.run(name, args.users)
+        return {
+            "meta": {
+                "users": args.users,
+                "concurrency": args.concurrency,
+                "api_latency_ms": args.api_latency,
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+            },
+            "scenarios": scenarios,
+            "api_calls": runner.session.stats(),
+            "api_rejected": sorted(set(runner.session.rejected)),
+        }
+    finally:
+        await runner.teardown()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест XTR-бота с локальным Bot API")
+    parser.add_argument('--scenario', choices=['all', *SCENARIOS], default='all')
+    parser.add_argument('--users', type=int, default=500, help="пользователей на сценарий")
+    parser.add_argument('--concurrency', type=int, default=32, help="параллельных потоков апдейтов")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="задержка ответа Bot API (мс)")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="файл базовой линии")
+    parser.add_argument('--save-baseline', action='store_true', help="записать результат как базовую линию")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="допустимое ухудшение (доля)")
+    parser.add_argument('--floor-ms', type=float, default=1.0, help="рост p99 меньше этого не считается")
+    parser.add_argument('--json', help="записать результат в файл")
+    args = parser.parse_args()
+    
+    results = asyncio.run(run_load_test(args))
+    print_report(results)
+    
+    # Сообщение, которое Telegram не примет, - ошибка независимо от базовой линии
+    if results['api_rejected']:
+        for rejected in results['api_rejected']:
+            print(f"REJECTED: {rejected}")
+        print(f"\n{len(results['api_rejected'])} distinct messages would be rejected by Telegram")
+        return 1
+    
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+        print(f"\nBaseline saved: {args.baseline}")
+        return 0
+    
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline}; run with --save-baseline")
+        return 0
+    
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    meta = baseline.get('meta', {})
+    if meta.get('users') != args.users or meta.get('concurrency') != args.concurrency:
+        # Пропускная способность и p99 зависят от нагрузки: сравнение дало бы ложные регрессии
+        print(
+            f"\n⚠️ Baseline was recorded with --users {meta.get('users')} --concurrency {meta.get('concurrency')}; "
+            f"comparison skipped (rerun with the same options or --save-baseline)"
+        )
+        return 0
+    
+    regressions = compare(results, baseline, args.tolerance, args.floor_ms)
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    print(f"\n{len(results['scenarios'])} scenarios compared, {len(regressions)} regressions")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())